@@ -1,28 +1,33 @@
 from __future__ import print_function
+import os
+import re
 import sys
+import uuid
 
-from django.contrib import admin
+from django.conf import settings
+from django.contrib import admin, messages
 from django.contrib.admin.models import LogEntry, DELETION
 from django.contrib.contenttypes import generic
-from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import SuspiciousOperation
 from django.core.urlresolvers import reverse
-from django.http import HttpResponseRedirect
-from django.utils.html import escape
+from django.http import HttpResponseRedirect, StreamingHttpResponse
+from django.template.response import TemplateResponse
+from django.utils.html import escape, format_html
 from django.utils.translation import ugettext_lazy as _
 
 from import_export.admin import ImportExportModelAdmin
+from import_export.formats import base_formats
+from import_export.forms import ImportForm, ConfirmImportForm, ExportForm
 
 from lims.models import Apparatus, ApparatusSubdivision, Collaborator, Sample, SampleType, SampleLocation, \
     Protocol, ExtractedCell, ExtractedDNA, QPCR, RTMDA, SAGPlate, \
     SAGPlateDilution, DNALibrary, SequencingRun, Metagenome, Primer, \
-    Amplicon, SAG, DNAFromPureCulture, ReadFile, Container, ContainerType, BarcodePrinter, BarcodeToModel
+    Amplicon, SAG, DNAFromPureCulture, ReadFile, Container, ContainerType, BarcodePrinter, BarcodeToModel, Job
 
-from lims.import_export_resources import SampleResource, ContainerResource
-
-try:
-    from sh import lpr
-except ImportError:
-    pass
+from lims.import_export_resources import SampleResource, ContainerResource, \
+    import_rows, read_rows, stream_export, openpyxl
+from lims.jobs import enqueue, get_job_pks
+from lims.printing import print_labels
 
 
 def generate_all_fields_admin(classname):
@@ -42,21 +47,40 @@ for model in standard_models:
     admin.site.register(model, generate_all_fields_admin(model))
 
 
+def message_job(modeladmin, request, job, message):
+    modeladmin.message_user(request, format_html(
+        '{0}, see <a href="{1}">job {2}</a>', message,
+        reverse("lims.views.job_status", args=[job.pk]), job.pk))
+
+
 def print_barcode(modeladmin, request, queryset):
-    for q in queryset:
-        ct = ContentType.objects.get_for_model(queryset.model)
-        btm = BarcodeToModel.objects.get(content_type=ct)
-        fields = [getattr(q, f) for f in btm.barcode_fields.split()]
-        print("len: %d" % len(fields), file=sys.stderr)
-        # add extra fields if not enough fields are given
-        if len(fields) < 4:
-            fields += (4 - len(fields)) * [""]
-        out = btm.barcode.template.format(*fields)
-        print(out, file=sys.stderr)
-        lpr("-P", btm.barcode.name, _in=out)
+    nr_labels = queryset.count()
+    if nr_labels >= settings.LIMS_PRINT_BACKGROUND_MIN_LABELS:
+        job = enqueue("print_barcodes", user=request.user,
+                      model=queryset.model._meta.model_name,
+                      pks=get_job_pks(queryset))
+        message_job(modeladmin, request, job,
+                    "Queued printing of %d labels" % nr_labels)
+        return
+    printers, nr_labels = print_labels(queryset)
+    if printers:
+        modeladmin.message_user(request, "Sent %d labels to %s" % (
+            nr_labels, ", ".join(p.name for p in printers)))
+    else:
+        modeladmin.message_user(request, "No barcode printer is linked to %s"
+                                % queryset.model._meta.verbose_name,
+                                level=messages.WARNING)
 print_barcode.short_description = "Print barcode"
 
 
+def export_in_background(modeladmin, request, queryset):
+    job = enqueue("export_file", user=request.user,
+                  model=queryset.model._meta.model_name,
+                  pks=get_job_pks(queryset))
+    message_job(modeladmin, request, job, "Queued the export")
+export_in_background.short_description = "Export as csv in the background"
+
+
 class ContainerInline(generic.GenericTabularInline):
     model = Container
     raw_id_fields = ("parent",)
@@ -95,10 +119,12 @@ class ContainerApparatusFilter(admin.SimpleListFilter):
         return [(ap.id, _(str(ap))) for ap in Apparatus.objects.all()]
 
     def queryset(self, request, queryset):
-        """Only return containers where the apparatus root is set to given value"""
+        """Only return containers where the apparatus root is set to given
+        value. Joins through the materialized root_container of each
+        Container, see Container documentation."""
         if self.value():
-            con_ids = [c.id for c in queryset if c.root_apparatus.id == int(self.value())]
-            return queryset.filter(id__in=con_ids)
+            return queryset.filter(
+                root_container__apparatus_subdivision__apparatus=self.value())
 
 
 class ContainerIsEmptyFilter(admin.SimpleListFilter):
@@ -114,13 +140,141 @@ class ContainerIsEmptyFilter(admin.SimpleListFilter):
         return [(True, _(str(True))), (False, _(str(False)))]
 
     def queryset(self, request, queryset):
-        """If a value is specified only return is_empty with the same value"""
-        if self.value():
-            empty_ids = [c.id for c in queryset if c.is_empty == (self.value() == "True")]
-            return queryset.filter(id__in=empty_ids)
-
-
-class ContainerAdmin(ImportExportModelAdmin, admin.ModelAdmin):
+        """If a value is specified only return is_empty with the same value.
+        A Container only counts as empty if its descendants are empty too."""
+        if self.value() == "True":
+            return queryset.empty()
+        elif self.value() == "False":
+            return queryset.not_empty()
+
+
+IMPORT_TOKEN_RE = re.compile(r"^[0-9a-f]{32}$")
+
+
+def save_import_file(upload):
+    """Store the uploaded file in settings.LIMS_IMPORT_DIR under a random
+    token, so the confirmed import can read it again. Returns the token."""
+    if not os.path.isdir(settings.LIMS_IMPORT_DIR):
+        os.makedirs(settings.LIMS_IMPORT_DIR)
+    token = uuid.uuid4().hex
+    with open(get_import_file_path(token), "wb") as f:
+        for chunk in upload.chunks():
+            f.write(chunk)
+    return token
+
+
+def get_import_file_path(token):
+    """Returns the path of the file saved by save_import_file. Anything but
+    a token is rejected, so no other file can be read or deleted."""
+    if not IMPORT_TOKEN_RE.match(token):
+        raise SuspiciousOperation("Invalid import file %r" % token)
+    return os.path.join(settings.LIMS_IMPORT_DIR, token)
+
+
+class ChunkedImportMixin(object):
+    """Imports the uploaded file in chunks with import_rows instead of
+    loading it in a single dataset. The preview only shows the first rows,
+    but all rows are checked for errors."""
+    def get_import_formats(self):
+        formats = super(ChunkedImportMixin, self).get_import_formats()
+        if openpyxl and base_formats.XLSX not in formats:
+            formats.append(base_formats.XLSX)
+        return formats
+
+    def import_file(self, file_name, input_format, dry_run):
+        resource = self.get_import_resource_class()()
+        with open(file_name, "rb") as f:
+            headers, rows = read_rows(f, input_format)
+            return resource, import_rows(resource, headers, rows,
+                                         dry_run=dry_run)
+
+    def process_import(self, request, *args, **kwargs):
+        """Queue the confirmed import as a background Job"""
+        confirm_form = ConfirmImportForm(request.POST)
+        if confirm_form.is_valid():
+            input_format = self.get_import_formats()[
+                int(confirm_form.cleaned_data['input_format'])]
+            file_name = get_import_file_path(
+                confirm_form.cleaned_data['import_file_name'])
+            try:
+                with open(file_name, "rb") as f:
+                    data = f.read()
+            except IOError:
+                messages.error(request, "The file to import was not found, "
+                               "it may have been imported already")
+            else:
+                job = enqueue("import_file", user=request.user, data=data,
+                              model=self.model._meta.model_name,
+                              input_format=input_format.__name__)
+                os.unlink(file_name)
+                return HttpResponseRedirect(reverse("lims.views.job_status",
+                                                    args=[job.pk]))
+        opts = self.model._meta
+        return HttpResponseRedirect(reverse(
+            'admin:%s_%s_changelist' % (opts.app_label, opts.module_name),
+            current_app=self.admin_site.name))
+
+    def import_action(self, request, *args, **kwargs):
+        context = {}
+        import_formats = self.get_import_formats()
+        form = ImportForm(import_formats, request.POST or None,
+                          request.FILES or None)
+
+        if request.POST and form.is_valid():
+            input_format = import_formats[
+                int(form.cleaned_data['input_format'])]()
+            # write the upload to disk, so process_import can read it again
+            token = save_import_file(form.cleaned_data['import_file'])
+            resource, result = self.import_file(get_import_file_path(token),
+                                                input_format, dry_run=True)
+            context['result'] = result
+            if result.has_errors():
+                os.unlink(get_import_file_path(token))
+            else:
+                context['confirm_form'] = ConfirmImportForm(initial={
+                    'import_file_name': token,
+                    'input_format': form.cleaned_data['input_format'],
+                })
+        else:
+            resource = self.get_import_resource_class()()
+
+        context['form'] = form
+        context['opts'] = self.model._meta
+        context['fields'] = [f.column_name for f in resource.get_fields()]
+        return TemplateResponse(request, [self.import_template_name],
+                                context, current_app=self.admin_site.name)
+
+
+class StreamingExportMixin(object):
+    """Streams csv and tsv exports row by row with stream_export instead of
+    building the whole file in memory"""
+    streaming_formats = {
+        base_formats.CSV: (",", "text/csv"),
+        base_formats.TSV: ("\t", "text/tab-separated-values"),
+    }
+
+    def export_action(self, request, *args, **kwargs):
+        formats = self.get_export_formats()
+        form = ExportForm(formats, request.POST or None)
+        if form.is_valid():
+            file_format = formats[int(form.cleaned_data['file_format'])]
+            if file_format in self.streaming_formats:
+                delimiter, content_type = self.streaming_formats[file_format]
+                response = StreamingHttpResponse(
+                    stream_export(self.get_export_resource_class()(),
+                                  self.get_export_queryset(request),
+                                  delimiter),
+                    content_type=content_type)
+                response['Content-Disposition'] = \
+                    'attachment; filename=%s' % \
+                    self.get_export_filename(file_format())
+                return response
+        return super(StreamingExportMixin, self).export_action(
+            request, *args, **kwargs)
+
+
+class ContainerAdmin(ChunkedImportMixin, StreamingExportMixin,
+                     ImportExportModelAdmin, admin.ModelAdmin):
     resource_class = ContainerResource
     list_filter = [
         'date',
@@ -137,24 +291,32 @@ class ContainerAdmin(ImportExportModelAdmin, admin.ModelAdmin):
         'row',
         'column',
         'parent',
-        'get_nr_children',
+        'nr_children',
         'nr_objects_in_container',
         'is_empty',
         'date',
     ]
+    list_select_related = (
+        'type',
+        'parent__type',
+        'apparatus_subdivision__apparatus',
+        'root_container__apparatus_subdivision__apparatus',
+    )
     #search_fields = ("parent",)
     raw_id_fields = ("parent",)
     list_per_page = 10
     # import_export change template to include csv
     import_template_name = 'import_export/lims_import.html'
+    actions = [export_in_background]
 
-    def get_nr_children(self, obj):
-        return "%s" % str(obj.child.count())
-    get_nr_children.short_description = "No of Children"
+    def get_queryset(self, request):
+        return super(ContainerAdmin, self).get_queryset(request) \
+            .with_counts()
 admin.site.register(Container, ContainerAdmin)
 
 
-class SampleAdmin(ImportExportModelAdmin, admin.ModelAdmin):
+class SampleAdmin(ChunkedImportMixin, StreamingExportMixin,
+                  ImportExportModelAdmin, admin.ModelAdmin):
     resource_class = SampleResource
     editables = [
         'collaborator',
@@ -171,17 +333,32 @@ class SampleAdmin(ImportExportModelAdmin, admin.ModelAdmin):
         'id',
         'uid',
         'barcode',
-    ] + editables
+    ] + editables + [
+        'created_by',
+        'modified_by',
+    ]
+    list_select_related = (
+        'collaborator',
+        'sample_type',
+        'sample_location',
+        'created_by',
+        'modified_by',
+    )
+    readonly_fields = ('created_by', 'modified_by')
     # import_export change template to include csv
     import_template_name = 'import_export/lims_import.html'
     inlines = [
         ContainerInline,
     ]
-    actions = [print_barcode]
+    actions = [print_barcode, export_in_background]
 
     #class Media:
     #    js = ('lims/admin_edit_button.js',)
 
+    def save_model(self, request, obj, form, change):
+        obj.set_user(request.user)
+        super(SampleAdmin, self).save_model(request, obj, form, change)
+
     def response_change(self, request, obj, post_url_continue=None):
         """This makes the response after changing go back to parameterless
         overview (maybe not necessary)."""
@@ -301,6 +478,8 @@ class DNALibraryAdmin(admin.ModelAdmin):
         'i5',
         'sample_name_on_platform',
     ]
+    # the DNA sources are nullable, so select_related() wouldn't follow them
+    list_select_related = ('amplicon', 'metagenome', 'sag', 'pure_culture')
     inlines = [
         ContainerInline,
     ]
@@ -444,3 +623,35 @@ class LogEntryAdmin(admin.ModelAdmin):
         return super(LogEntryAdmin, self).queryset(request) \
             .prefetch_related('content_type')
 admin.site.register(LogEntry, LogEntryAdmin)
+
+
+class JobAdmin(admin.ModelAdmin):
+    list_display = [
+        'id',
+        'name',
+        'status',
+        'progress',
+        'total',
+        'user',
+        'date',
+        'finished',
+    ]
+    list_filter = [
+        'name',
+        'status',
+    ]
+    exclude = ['data']
+    readonly_fields = [
+        'name',
+        'arguments',
+        'user',
+        'progress',
+        'total',
+        'message',
+        'data_name',
+        'date',
+        'started',
+        'heartbeat',
+        'finished',
+    ]
+admin.site.register(Job, JobAdmin)
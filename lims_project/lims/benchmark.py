@@ -0,0 +1,200 @@
+"""
+Benchmarks of the browse, detail, barcode, sample tree and admin changelist
+pages, see the benchmark management command. Every case requests its url
+with the test client a number of times against the configured database and
+records the time of every request, the number of queries and the size of the
+response. Run them on a dataset from generate_dataset. Results are stored as
+JSON, so runs can be compared over time with compare_results.
+"""
+import json
+import platform
+import subprocess
+import time
+import uuid
+
+import django
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import Client
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from lims import tree_cache
+from lims.models import Container, DNALibrary, ReadFile, RegisteredBarcode, \
+    SAG, Sample, UserProfile
+
+# Prefix of the username of the temporary superuser of a run
+BENCHMARK_USER = "benchmark"
+# Barcodes resolved at once in the barcode batch case, a full plate
+BATCH_SIZE = 384
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+class Case(object):
+    """A request to time. With sample_id the cached tree of that Sample is
+    invalidated before every request, to time building the tree instead of
+    its cached copy."""
+    def __init__(self, name, url, data=None, sample_id=None):
+        self.name = name
+        self.url = url
+        self.data = data
+        self.sample_id = sample_id
+
+    def request(self, client):
+        if self.data is None:
+            return client.get(self.url)
+        return client.post(self.url, self.data,
+                           content_type="application/json")
+
+
+def first(queryset):
+    obj = queryset.order_by('pk').first()
+    if obj is None:
+        raise BenchmarkError("No %s found, generate a dataset first" %
+                             queryset.model._meta.verbose_name)
+    return obj
+
+
+def get_cases():
+    """Returns the Cases, using the first objects in the database"""
+    sample = first(Sample.objects.all())
+    well = first(Container.objects.filter(object_id__isnull=False))
+    library = first(DNALibrary.objects.all())
+    barcodes = list(RegisteredBarcode.objects.order_by('pk')
+                    .values_list('barcode', flat=True)[:BATCH_SIZE])
+    cases = []
+    for model in (Sample, Container, DNALibrary, SAG):
+        name = model.__name__.lower()
+        cases.append(Case("browse %s" % name,
+                          reverse("lims.views.browse_list", args=[name])))
+    cases.append(Case("browse sample stream",
+                      reverse("lims.views.browse_list", args=["sample"]) +
+                      "?stream"))
+    for obj in (sample, well, library, first(SAG.objects.all()),
+                first(ReadFile.objects.all())):
+        cases.append(Case("detail %s" % obj._meta.model_name,
+                          obj.get_absolute_url()))
+    cases += [
+        Case("barcode json", reverse("lims.views.barcode_json",
+                                     args=[sample.barcode])),
+        Case("barcode batch", reverse("lims.views.barcode_batch"),
+             data=json.dumps(barcodes)),
+        Case("sample tree", reverse("lims.views.sample_tree_json",
+                                    args=[sample.pk]), sample_id=sample.pk),
+        Case("sample tree cached", reverse("lims.views.sample_tree_json",
+                                           args=[sample.pk])),
+    ]
+    for model in (Sample, Container, DNALibrary):
+        cases.append(Case("admin %s changelist" % model.__name__.lower(),
+                          reverse("admin:lims_%s_changelist" %
+                                  model.__name__.lower())))
+    return cases
+
+
+def create_user():
+    """Returns a temporary superuser for the admin pages and its password"""
+    password = UserProfile.objects.make_random_password()
+    user = UserProfile.objects.create_superuser(
+        "%s-%s" % (BENCHMARK_USER, uuid.uuid4().hex[:8]), "", password)
+    return user, password
+
+
+def get_client(user, password):
+    """Returns a test client logged in as user"""
+    client = Client()
+    client.login(username=user.username, password=password)
+    return client
+
+
+def run_case(client, case, repeat):
+    """Request the case repeat times. Returns the statistics of the timings in
+    milliseconds, with the number of queries and the response size of the
+    last request."""
+    timings = []
+    for i in range(repeat):
+        if case.sample_id is not None:
+            tree_cache.invalidate_sample_tree(case.sample_id)
+        start = time.time()
+        response = case.request(client)
+        # queries of a streaming response run while it is read
+        size = len("".join(response.streaming_content)
+                   if response.streaming else response.content)
+        timings.append((time.time() - start) * 1000)
+        # the queries are reset at the start of every request
+        nr_queries = len(connection.queries)
+    timings.sort()
+    return {
+        'url': case.url,
+        'status': response.status_code,
+        'queries': nr_queries,
+        'bytes': size,
+        'min': timings[0],
+        'median': timings[len(timings) // 2],
+        'mean': sum(timings) / len(timings),
+        'max': timings[-1],
+    }
+
+
+def get_git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=settings.DJANGO_ROOT,
+            stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(repeat=5, log=None):
+    """Run all Cases repeat times. Returns the results with the database,
+    versions and size of the dataset they were measured on."""
+    log = log or (lambda message: None)
+    results = {
+        'date': timezone.now().isoformat(),
+        'revision': get_git_revision(),
+        'database': connection.vendor,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'repeat': repeat,
+        'dataset': dict((model.__name__, model.objects.count()) for model in
+                        (Sample, Container, DNALibrary, SAG, ReadFile)),
+        'cases': {},
+    }
+    cases = get_cases()
+    allowed_hosts = list(settings.ALLOWED_HOSTS) + ["testserver"]
+    use_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    user, password = create_user()
+    try:
+        with override_settings(ALLOWED_HOSTS=allowed_hosts):
+            client = get_client(user, password)
+            for case in cases:
+                results['cases'][case.name] = result = \
+                    run_case(client, case, repeat)
+                log("%-28s %8.1f ms %6d queries" % (case.name,
+                                                    result['median'],
+                                                    result['queries']))
+            client.logout()
+    finally:
+        connection.use_debug_cursor = use_debug_cursor
+        user.delete()
+    return results
+
+
+def compare_results(old, new):
+    """Returns a line per case comparing the median time and the number of
+    queries of two runs"""
+    lines = []
+    for name in sorted(set(old['cases']) | set(new['cases'])):
+        if name not in old['cases'] or name not in new['cases']:
+            lines.append("%-28s only in one run" % name)
+            continue
+        a, b = old['cases'][name], new['cases'][name]
+        lines.append("%-28s %8.1f -> %8.1f ms (%+6.1f%%) %6d -> %6d queries"
+                     % (name, a['median'], b['median'],
+                        100.0 * (b['median'] - a['median']) /
+                        (a['median'] or 1), a['queries'], b['queries']))
+    return lines
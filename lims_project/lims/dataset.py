@@ -0,0 +1,298 @@
+"""
+Synthetic datasets to measure performance with, see the generate_dataset and
+benchmark management commands. Objects are inserted with bulk_create where
+possible, so large datasets only take minutes to generate.
+
+Every Sample gets the same lineage: an ExtractedCell with a SAGPlate, a
+SAGPlateDilution and SAGs in the wells of both, two ExtractedDNAs (one from
+the Sample, one from the ExtractedCell), a Metagenome, an Amplicon and a
+DNAFromPureCulture of the first ExtractedDNA, and a DNALibrary for each of
+those and for every SAG. Libraries are sequenced in SequencingRuns with a
+pair of ReadFiles each. Samples, ExtractedDNAs and DNALibraries are stored
+in the wells of 384 well plates on the shelves of freezers.
+"""
+import random
+import string
+from decimal import Decimal
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+
+from lims import tree_cache
+from lims.models import Amplicon, Apparatus, ApparatusSubdivision, \
+    Collaborator, Container, ContainerType, DNAFromPureCulture, DNALibrary, \
+    ExtractedCell, ExtractedDNA, Metagenome, Primer, Protocol, QPCR, \
+    ReadFile, RegisteredBarcode, RTMDA, SAG, SAGPlate, SAGPlateDilution, \
+    Sample, SampleLocation, SampleType, SequencingRun
+from lims.printing import invalidate_object_labels
+
+UID_CHARACTERS = string.digits + string.ascii_uppercase
+PLATE_ROWS = 16
+PLATE_COLUMNS = 24
+SHELVES_PER_FREEZER = 4
+PLATES_PER_SHELF = 20
+BATCH_SIZE = 500
+
+
+class DatasetError(Exception):
+    pass
+
+
+def make_sample_uid(prefix, i):
+    """Returns the i-th Sample uid, prefix followed by i as four base 36
+    digits"""
+    digits = ""
+    for j in range(4):
+        i, digit = divmod(i, len(UID_CHARACTERS))
+        digits = UID_CHARACTERS[digit] + digits
+    return prefix + digits
+
+
+def well_name(row, column):
+    return "%s%d" % (string.ascii_uppercase[row], column + 1)
+
+
+def bulk_create(model, objects, key='uid'):
+    """Insert the objects in batches and return them as fetched from the
+    database in the same order, looked up on the unique field key"""
+    created = {}
+    for i in range(0, len(objects), BATCH_SIZE):
+        batch = objects[i:i + BATCH_SIZE]
+        model.objects.bulk_create(batch)
+        created.update((getattr(o, key), o) for o in model.objects.filter(
+            **{key + "__in": [getattr(o, key) for o in batch]}))
+    return [created[getattr(o, key)] for o in objects]
+
+
+def bulk_create_by_new_group(model, objects):
+    """Insert IndexByGroup objects of groups that were just created, see
+    IndexByGroupManager.bulk_create_by_group"""
+    return model.objects.bulk_create_by_group(objects, batch_size=BATCH_SIZE,
+                                              new_groups=True)
+
+
+def get_or_create_named(model, names, **defaults):
+    return [model.objects.get_or_create(name=name, defaults=defaults)[0]
+            for name in names]
+
+
+def get_or_create_container_type(name, divisible):
+    container_type = ContainerType.objects.filter(name=name).first()
+    if container_type is None:
+        container_type = ContainerType.objects.create(name=name,
+                                                      divisible=divisible)
+    return container_type
+
+
+def concentration(rnd):
+    return Decimal("%.5f" % rnd.uniform(0.1, 100))
+
+
+def generate_dataset(nr_samples, prefix="Z", sags_per_plate=8,
+                     libraries_per_run=96, seed=0, log=None):
+    """Generate nr_samples Samples with their lineage, storage and sequencing
+    data. Sample uids start with the single character prefix, which should
+    not be in use yet. The values are random, but the same for the same
+    seed. log is called with progress messages. Returns the number of
+    created objects per model name."""
+    if nr_samples < 1:
+        raise DatasetError("Generate at least one Sample")
+    if len(prefix) != 1 or prefix not in UID_CHARACTERS:
+        raise DatasetError("The prefix should be one of %s" % UID_CHARACTERS)
+    if nr_samples > len(UID_CHARACTERS) ** 4:
+        raise DatasetError("At most %d Samples can be generated per prefix" %
+                           len(UID_CHARACTERS) ** 4)
+    if Sample.objects.filter(uid__startswith=prefix).exists():
+        raise DatasetError("There are Samples with prefix %s already, use "
+                           "another prefix" % prefix)
+    log = log or (lambda message: None)
+    rnd = random.Random(seed)
+    counts = {}
+
+    def created(objects):
+        counts[objects[0].__class__.__name__] = \
+            counts.get(objects[0].__class__.__name__, 0) + len(objects)
+        log("Created %d %s" % (len(objects),
+                               unicode(objects[0]._meta.verbose_name_plural)))
+        return objects
+
+    with transaction.atomic():
+        sample_types = get_or_create_named(
+            SampleType, ["soil", "freshwater", "seawater", "sediment"])
+        sample_locations = get_or_create_named(
+            SampleLocation, ["Baltic Sea", "Lake Erken", "Uppsala", "Abisko"])
+        protocol = Protocol.objects.create(
+            name="Synthetic %s" % prefix, revision="1",
+            link="http://example.org/protocol")
+        qpcr = QPCR.objects.create(report="Synthetic %s qPCR" % prefix)
+        rt_mda = RTMDA.objects.create(report="Synthetic %s RT-MDA" % prefix)
+        primers = [Primer.objects.create(sequence=sequence, tmelt=Decimal(60),
+                                         concentration=Decimal(1), stock=100)
+                   for sequence in ["GTGCCAGCMGCCGCGGTAA",
+                                    "GGACTACHVGGGTWTCTAAT"]]
+        collaborators = [Collaborator.objects.create(
+            first_name="Collaborator", last_name="%s%d" % (prefix, i),
+            institution="Synthetic University", address="Uppsala",
+            email="collaborator%d@example.org" % i)
+            for i in range(max(1, nr_samples // 10))]
+
+        # storage: plates of wells on the shelves of freezers
+        plate_type = get_or_create_container_type("384 well plate", True)
+        well_type = get_or_create_container_type("Well", False)
+        nr_stored = nr_samples * (3 + 3 + 2 * sags_per_plate)
+        nr_plates = -(-nr_stored // (PLATE_ROWS * PLATE_COLUMNS))
+        shelves = []
+        for i in range(-(-nr_plates // (SHELVES_PER_FREEZER *
+                                        PLATES_PER_SHELF))):
+            freezer = Apparatus.objects.create(
+                name="Freezer %s%d" % (prefix, i), temperature=Decimal(-80),
+                location="Synthetic lab")
+            shelves += [ApparatusSubdivision.objects.create(
+                name="Shelf %d" % (j + 1), apparatus=freezer)
+                for j in range(SHELVES_PER_FREEZER)]
+
+        samples = created(bulk_create(Sample, [Sample(
+            uid=make_sample_uid(prefix, i),
+            collaborator=rnd.choice(collaborators),
+            sample_type=rnd.choice(sample_types),
+            sample_location=rnd.choice(sample_locations),
+            temperature=Decimal(rnd.randint(-2, 30)),
+            ph=Decimal("%.2f" % rnd.uniform(4, 9)),
+            depth=Decimal(rnd.randint(0, 200)),
+            latitude=Decimal("%.8f" % rnd.uniform(55, 69)),
+            longitude=Decimal("%.8f" % rnd.uniform(11, 24)),
+            status=rnd.choice(["new", "used", "finished"]))
+            for i in range(nr_samples)]))
+        RegisteredBarcode.register_new(samples)
+
+        # The objects returned by bulk_create are fetched from the database,
+        # assign the related objects again so make_uid doesn't have to fetch
+        # them one by one
+        cells = created(bulk_create_by_new_group(ExtractedCell, [
+            ExtractedCell(sample=sample, protocol=protocol)
+            for sample in samples]))
+        for cell, sample in zip(cells, samples):
+            cell.sample = sample
+
+        dnas = created(bulk_create_by_new_group(ExtractedDNA, [
+            ExtractedDNA(protocol=protocol, buffer="TE",
+                         concentration=concentration(rnd), **source)
+            for sample, cell in zip(samples, cells)
+            for source in [{'sample': sample}, {'extracted_cell': cell}]]))
+        for i, (sample, cell) in enumerate(zip(samples, cells)):
+            dnas[2 * i].sample = sample
+            dnas[2 * i + 1].extracted_cell = cell
+
+        sag_plates = created(bulk_create_by_new_group(SAGPlate, [
+            SAGPlate(extracted_cell=cell, protocol=protocol, qpcr=qpcr,
+                     rt_mda=rt_mda, report="SAG plate report",
+                     apparatus_subdivision=rnd.choice(shelves))
+            for cell in cells]))
+        for sag_plate, cell in zip(sag_plates, cells):
+            sag_plate.extracted_cell = cell
+        dilutions = created(bulk_create_by_new_group(SAGPlateDilution, [
+            SAGPlateDilution(sag_plate=sag_plate, qpcr=qpcr, dilution="1:10",
+                             apparatus_subdivision_id=sag_plate
+                             .apparatus_subdivision_id)
+            for sag_plate in sag_plates]))
+
+        new_sags = []
+        for sag_plate, dilution in zip(sag_plates, dilutions):
+            for i in range(sags_per_plate):
+                well = well_name(i // PLATE_COLUMNS, i % PLATE_COLUMNS)
+                for source in [{'sag_plate': sag_plate},
+                               {'sag_plate_dilution': dilution}]:
+                    sag = SAG(well=well, concentration=concentration(rnd),
+                              **source)
+                    sag.uid = sag.make_uid()
+                    new_sags.append(sag)
+        sags = created(bulk_create(SAG, new_sags)) if new_sags else []
+
+        # the group of a Metagenome, Amplicon or DNAFromPureCulture is the
+        # Sample of its ExtractedDNA, so use the ones extracted from a Sample
+        direct_dnas = dnas[::2]
+        metagenomes = created(bulk_create_by_new_group(Metagenome, [
+            Metagenome(extracted_dna=dna, diversity_report="report")
+            for dna in direct_dnas]))
+        amplicons = created(bulk_create_by_new_group(Amplicon, [
+            Amplicon(extracted_dna=dna, diversity_report="report",
+                     buffer="TE")
+            for dna in direct_dnas]))
+        Amplicon.primer.through.objects.bulk_create(
+            [Amplicon.primer.through(amplicon=amplicon, primer=primer)
+             for amplicon in amplicons for primer in primers],
+            batch_size=BATCH_SIZE)
+        pure_cultures = created(bulk_create_by_new_group(DNAFromPureCulture, [
+            DNAFromPureCulture(extracted_dna=dna,
+                               concentration=concentration(rnd))
+            for dna in direct_dnas]))
+
+        sources = [('amplicon', o) for o in amplicons] + \
+            [('metagenome', o) for o in metagenomes] + \
+            [('pure_culture', o) for o in pure_cultures] + \
+            [('sag', o) for o in sags]
+        libraries = created(bulk_create_by_new_group(DNALibrary, [
+            DNALibrary(protocol=protocol, buffer="EB",
+                       i7="N7%02d" % (i % 12 + 1), i5="S5%02d" % (i % 8 + 1),
+                       sample_name_on_platform="%s_LIB%07d" % (prefix, i),
+                       concentration=concentration(rnd), **{source: obj})
+            for i, (source, obj) in enumerate(sources)]))
+
+        runs = []
+        read_files = []
+        for i in range(0, len(libraries), libraries_per_run):
+            run = SequencingRun.objects.create(
+                uid="%s_RUN%05d" % (prefix, len(runs)),
+                sequencing_center="Synthetic center", machine="HiSeq 2500",
+                report="run report", folder="/proj/run%d" % len(runs),
+                notes="", protocol=protocol)
+            run_libraries = libraries[i:i + libraries_per_run]
+            SequencingRun.dna_library.through.objects.bulk_create(
+                [SequencingRun.dna_library.through(sequencingrun=run,
+                                                   dnalibrary=library)
+                 for library in run_libraries], batch_size=BATCH_SIZE)
+            read_files += [ReadFile(
+                folder=run.folder, filename="%s_R%d.fastq.gz" % (library.uid,
+                                                                  pair),
+                pair=pair, lane=j % 8 + 1, read_count=rnd.randint(10 ** 5,
+                                                                  10 ** 7),
+                dna_library=library, sequencing_run=run)
+                for j, library in enumerate(run_libraries) for pair in (1, 2)]
+            runs.append(run)
+        counts['SequencingRun'] = len(runs)
+        ReadFile.objects.bulk_create(read_files, batch_size=BATCH_SIZE)
+        counts['ReadFile'] = len(read_files)
+        log("Created %d sequencing runs with %d read files" %
+            (len(runs), len(read_files)))
+
+        stored = samples + dnas + libraries
+        wells = []
+        for i in range(nr_plates):
+            plate = Container.objects.create(
+                type=plate_type,
+                apparatus_subdivision=shelves[i // PLATES_PER_SHELF])
+            for j in range(PLATE_ROWS * PLATE_COLUMNS):
+                well = Container(type=well_type, parent=plate,
+                                 row=j // PLATE_COLUMNS,
+                                 column=j % PLATE_COLUMNS)
+                k = i * PLATE_ROWS * PLATE_COLUMNS + j
+                if k < len(stored):
+                    well.content_type = ContentType.objects.get_for_model(
+                        stored[k].__class__)
+                    well.object_id = stored[k].pk
+                wells.append(well)
+        Container.objects.bulk_create(wells, batch_size=BATCH_SIZE)
+        new_wells = Container.materialize_new()
+        for i in range(0, len(new_wells), BATCH_SIZE):
+            RegisteredBarcode.register_new(Container.objects.filter(
+                pk__in=new_wells[i:i + BATCH_SIZE]))
+        counts['Container'] = nr_plates + len(wells)
+        log("Created %d plates with %d wells" % (nr_plates, len(wells)))
+
+    # bulk_create doesn't send post_save, invalidate the caches of the new
+    # objects that bulk_create_by_group didn't take care of. They all descend
+    # from the new Samples.
+    tree_cache.invalidate_sample_trees([sample.pk for sample in samples])
+    invalidate_object_labels(Sample, [sample.pk for sample in samples])
+    invalidate_object_labels(Container, new_wells)
+    return counts
@@ -1,57 +1,657 @@
+"""
+Resources for django-import-export. Large files are imported in chunks with
+import_rows, see read_rows for the formats that are read lazily. Exports can
+be streamed as csv with stream_export.
+"""
 from __future__ import print_function
 import sys
+import csv
+import datetime
+import functools
+import itertools
+import traceback
+from copy import deepcopy
 
 import json
+import tablib
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.db.models import Max, Q
+from django.utils import timezone
+from django.utils.encoding import force_text
 from import_export import resources, fields
-from import_export.widgets import Widget
+from import_export.formats import base_formats
+from import_export.results import Error, Result, RowResult
+from import_export.widgets import DateTimeWidget, Widget
 
-from lims.models import Sample, Container
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+from lims import tree_cache
+from lims.models import Sample, Container, RegisteredBarcode, UIDManager, \
+    UserProfile, barcode_models
+from lims.printing import invalidate_dependent_labels, \
+    invalidate_object_labels
+
+
+def iter_csv_rows(f, delimiter=","):
+    """Yields the rows of a utf-8 encoded csv file as lists of unicode"""
+    for row in csv.reader(f, delimiter=delimiter):
+        yield [cell.decode("utf-8") for cell in row]
+
+
+def iter_xlsx_rows(f):
+    """Yields the rows of the first sheet of an xlsx file as lists"""
+    workbook = openpyxl.load_workbook(f, read_only=True)
+    for row in workbook.worksheets[0].iter_rows():
+        yield [cell.value for cell in row]
+
+
+def read_rows(f, input_format):
+    """Returns the headers and an iterator over the rows of the file opened
+    in binary mode. CSV, TSV and XLSX files are read lazily, other formats
+    are loaded in a tablib Dataset first."""
+    if isinstance(input_format, base_formats.CSV):
+        rows = iter_csv_rows(f)
+    elif isinstance(input_format, base_formats.TSV):
+        rows = iter_csv_rows(f, delimiter="\t")
+    elif isinstance(input_format, base_formats.XLSX) and openpyxl:
+        rows = iter_xlsx_rows(f)
+    else:
+        data = f.read()
+        if not input_format.is_binary():
+            data = data.decode("utf-8")
+        dataset = input_format.create_dataset(data)
+        return dataset.headers, (list(row) for row in dataset)
+    headers = next(rows, [])
+    return headers, rows
+
+
+class ChunkedResult(Result):
+    """Result of an import in chunks. Keeps the errors of all rows, but only
+    the first preview_size rows for the preview."""
+    def __init__(self, preview_size, *args, **kwargs):
+        super(ChunkedResult, self).__init__(*args, **kwargs)
+        self.preview_size = preview_size
+        self.errors = []
+        self.nr_rows = 0
+        self.nr_chunks = 0
+        # rows that were committed, stays 0 for a dry run
+        self.nr_imported = 0
+
+    def add(self, result):
+        self.base_errors.extend(result.base_errors)
+        for i, row in enumerate(result.rows):
+            if row.errors:
+                self.errors.append((self.nr_rows + i + 1, row.errors))
+        self.rows.extend(result.rows[:self.preview_size - len(self.rows)])
+        self.nr_rows += len(result.rows)
+        self.nr_chunks += 1
+
+    def row_errors(self):
+        return self.errors
+
+
+class RollbackChunk(Exception):
+    pass
+
+
+def import_rows(resource, headers, rows, dry_run=False, chunk_size=None,
+                progress=None, bulk=None):
+    """Import the rows in chunks of chunk_size rows with the resource.
+    progress is called with the number of processed rows after every chunk.
+    Returns a ChunkedResult.
+
+    With bulk, which defaults to resource.bulk_import, chunks are imported
+    with bulk_import_data and all of them are committed in one transaction.
+    Otherwise every chunk is saved row by row and committed in its own
+    transaction. Unless it is a dry run the import stops at the first chunk
+    with errors."""
+    chunk_size = chunk_size or settings.LIMS_IMPORT_CHUNK_SIZE
+    if bulk is None:
+        bulk = resource.bulk_import
+    result = ChunkedResult(settings.LIMS_IMPORT_PREVIEW_SIZE)
+    headers, rows = resource.prepare_rows(headers, rows)
+    nr_columns = len(headers)
+    # pad or cut rows to the number of headers and skip empty ones
+    rows = ((list(row) + nr_columns * [""])[:nr_columns] for row in rows
+            if any(cell not in ("", None) for cell in row))
+    chunks = iter(lambda: list(itertools.islice(rows, chunk_size)), [])
+
+    def import_chunk(chunk):
+        # diffs are only shown for the preview
+        resource.compute_diffs = len(result.rows) < result.preview_size
+        dataset = tablib.Dataset(*chunk, headers=headers)
+        if bulk:
+            chunk_result = resource.bulk_import_data(dataset, dry_run=dry_run)
+        else:
+            chunk_result = resource.import_data(
+                dataset, dry_run=dry_run, raise_errors=False,
+                use_transactions=False)
+        result.add(chunk_result)
+        if chunk_result.has_errors() and not dry_run:
+            raise RollbackChunk()
+        if progress is not None:
+            progress(result.nr_rows)
+
+    try:
+        if bulk and dry_run:
+            # nothing is written
+            for chunk in chunks:
+                import_chunk(chunk)
+        elif bulk:
+            with transaction.atomic():
+                for chunk in chunks:
+                    import_chunk(chunk)
+        else:
+            for chunk in chunks:
+                with transaction.atomic():
+                    import_chunk(chunk)
+                if not dry_run:
+                    result.nr_imported = result.nr_rows
+    except RollbackChunk:
+        return result
+    if not dry_run:
+        result.nr_imported = result.nr_rows
+    return result
+
+
+def get_natural_key_field(model):
+    """Returns the field to look up objects by natural key, uid for models
+    with a UIDManager or else a unique name field. Returns None if the model
+    has neither."""
+    if isinstance(model._default_manager, UIDManager):
+        return "uid"
+    if any(f.name == "name" and f.unique for f in model._meta.fields):
+        return "name"
+    return None
 
 
 class LIMSForeignKeyWidget(Widget):
     """
     Widget for ``ForeignKey`` model field that represent ForeignKey as
-    integer value.
+    natural key, see get_natural_key_field, or as integer value. A value is
+    looked up as natural key first, so a numeric uid or name is not mistaken
+    for the id of another object.
 
     Requires a positional argument: the class to which the field is related.
+
+    Objects are cached, prefetch loads all values of a dataset with one query
+    so clean does not have to query for every row.
     """
 
     def __init__(self, model, *args, **kwargs):
         self.model = model
+        self.natural_key_field = get_natural_key_field(model)
+        self.cache = {}
         super(LIMSForeignKeyWidget, self).__init__(*args, **kwargs)
 
+    @staticmethod
+    def get_key(value):
+        if value is None:
+            return ""
+        # spreadsheets give numbers as floats
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        return unicode(value).strip()
+
+    def prefetch(self, values):
+        """Load the objects for all values that are not cached yet"""
+        keys = set(self.get_key(v) for v in values) - set(self.cache) - \
+            set([""])
+        if not keys:
+            return
+        query = Q(pk__in=[k for k in keys if k.isdigit()])
+        if self.natural_key_field:
+            query |= Q(**{self.natural_key_field + "__in": list(keys)})
+        by_pk = {}
+        for obj in self.model.objects.filter(query):
+            by_pk[unicode(obj.pk)] = obj
+            if self.natural_key_field:
+                natural_key = getattr(obj, self.natural_key_field)
+                if natural_key in keys:
+                    self.cache[natural_key] = obj
+        # natural keys take precedence over primary keys
+        for key in keys:
+            if key not in self.cache and key in by_pk:
+                self.cache[key] = by_pk[key]
+        # remember unknown keys, so they are not looked up again
+        for key in keys:
+            self.cache.setdefault(key, None)
+
+    def clean(self, value):
+        key = self.get_key(value)
+        if key == "":
+            return None
+        if key not in self.cache:
+            self.prefetch([key])
+        if self.cache[key] is None:
+            raise self.model.DoesNotExist(
+                "%s matching '%s' does not exist" %
+                (self.model._meta.object_name, key))
+        return self.cache[key]
+
+    def render(self, value):
+        if value is None:
+            return ""
+        return value.pk
+
+
+class LIMSDateTimeWidget(DateTimeWidget):
+    """DateTimeWidget for time zone aware datetimes. Values are exported in
+    the current time zone and imported values are made aware in it, so they
+    can be compared with the stored values."""
     def clean(self, value):
-        pk = super(LIMSForeignKeyWidget, self).clean(value)
-        return self.model.objects.get(pk=pk) if pk else None
+        # spreadsheets give datetimes
+        if not isinstance(value, datetime.datetime):
+            value = super(LIMSDateTimeWidget, self).clean(value)
+        if value is not None and settings.USE_TZ and \
+                timezone.is_naive(value):
+            value = timezone.make_aware(value,
+                                        timezone.get_current_timezone())
+        return value
 
     def render(self, value):
         if value is None:
             return ""
-        return str(value) + " (HAHAHA id=%d)" % value.pk
+        if settings.USE_TZ and timezone.is_aware(value):
+            value = timezone.localtime(value)
+        return super(LIMSDateTimeWidget, self).render(value)
+
+
+class Echo(object):
+    """File-like object that returns what is written, so csv.writer returns
+    the lines instead of writing them"""
+    def write(self, value):
+        return value
+
+
+def stream_export(resource, queryset, delimiter=","):
+    """Yields the export of the queryset by the resource as utf-8 encoded csv
+    lines. The objects are read with iterator(), so only one row at a time
+    is kept in memory."""
+    def encode(value):
+        return "" if value is None else force_text(value).encode("utf-8")
+
+    writer = csv.writer(Echo(), delimiter=delimiter)
+    fields = resource.get_fields()
+    yield writer.writerow([encode(h) for h in resource.get_export_headers()])
+    for obj in resource.get_export_queryset(queryset).iterator():
+        yield writer.writerow([encode(resource.export_field(f, obj))
+                               for f in fields])
+
+
+class LIMSModelResource(resources.ModelResource):
+    """ModelResource that can be imported in chunks with import_rows. Foreign
+    keys are resolved with LIMSForeignKeyWidget for all rows of a chunk at
+    once and datetimes are time zone aware, see LIMSDateTimeWidget. Readonly
+    fields, e.g. computed columns, are exported after the model fields."""
+    compute_diffs = True
+    # import with bulk_import_data instead of saving every row
+    bulk_import = False
+    # related objects needed for the exported columns
+    export_select_related = ()
+
+    def __init__(self, user=None):
+        # the widgets cache related objects, copy the fields so the cache
+        # only lasts as long as this resource
+        self.fields = deepcopy(self.fields)
+        # the user that imports, if known
+        self.user = user
 
+    def get_field_name(self, field):
+        for field_name, f in self.fields.items():
+            if f == field:
+                return field_name
+        raise AttributeError("Field %s does not exists in %s resource" %
+                             (field, type(self)))
+
+    @classmethod
+    def widget_from_django_field(cls, f, default=Widget):
+        if f.get_internal_type() in ('ForeignKey', 'OneToOneField'):
+            return functools.partial(LIMSForeignKeyWidget, model=f.rel.to)
+        if f.get_internal_type() == 'DateTimeField':
+            return LIMSDateTimeWidget
+        return super(LIMSModelResource, cls).widget_from_django_field(
+            f, default)
+
+    def before_import(self, dataset, dry_run):
+        for field in self.get_fields():
+            if isinstance(field.widget, LIMSForeignKeyWidget) and \
+                    field.column_name in dataset.headers:
+                pos = dataset.headers.index(field.column_name)
+                field.widget.prefetch(row[pos] for row in dataset)
+
+    def prepare_rows(self, headers, rows):
+        """Override to transform all rows in one pass before they are split
+        into chunks. Returns the new headers and rows."""
+        return headers, rows
+
+    def get_diff(self, original, current, dry_run=False):
+        if not self.compute_diffs:
+            return []
+        return super(LIMSModelResource, self).get_diff(original, current,
+                                                           dry_run)
+
+    def get_export_order(self):
+        if self._meta.export_order:
+            return self._meta.export_order
+        return [name for name, f in self.fields.items() if not f.readonly] + \
+            [name for name, f in self.fields.items() if f.readonly]
+
+    def get_export_queryset(self, queryset):
+        return queryset.select_related(*self.export_select_related)
+
+    def export_field(self, field, obj):
+        # export foreign keys with their id, without loading the object
+        if isinstance(field.widget, LIMSForeignKeyWidget):
+            pk = getattr(obj, field.attribute + "_id")
+            return "" if pk is None else pk
+        return super(LIMSModelResource, self).export_field(field, obj)
+
+    def get_bulk_instances(self, rows):
+        """Returns the existing instance, or None if there is none, for every
+        row. They are loaded with a single query."""
+        id_field = self.fields[self.get_import_id_fields()[0]]
+        ids = [id_field.clean(row) for row in rows]
+        existing = self._meta.model.objects.in_bulk(
+            [pk for pk in ids if pk is not None])
+        return [existing.get(pk) for pk in ids]
+
+    def clean_instance(self, instance):
+        instance.clean()
+
+    def validate_instances(self, instances):
+        """Check the imported instances in memory. Returns a dict of the
+        index of every invalid instance to its ValidationError. Every instance
+        is checked with clean_instance. Unique fields and unique_together
+        fields are checked against each other and against the database with
+        one query per constraint."""
+        errors = {}
+        for i, instance in enumerate(instances):
+            try:
+                self.clean_instance(instance)
+            except ValidationError as e:
+                errors[i] = e
+        opts = self._meta.model._meta
+        constraints = [(f, ) for f in opts.fields
+                       if f.unique and not f.primary_key] + \
+            [tuple(opts.get_field(name) for name in names)
+             for names in opts.unique_together]
+        for fields in constraints:
+            for i, error in self.validate_unique(instances, fields).items():
+                errors.setdefault(i, error)
+        return errors
+
+    def validate_unique(self, instances, fields):
+        """Returns a ValidationError for every instance of which the values
+        of the fields, which are unique together, occur more than once or
+        already exist. Values with a None are not checked, like in the
+        database."""
+        errors = {}
+        names = ", ".join(f.name for f in fields)
+        values = {}
+        for i, instance in enumerate(instances):
+            value = tuple(getattr(instance, f.attname) for f in fields)
+            if None in value:
+                continue
+            if value in values:
+                errors[i] = ValidationError("%s %s occurs more than once" % (
+                    names, ", ".join(unicode(v) for v in value)))
+            values[value] = i
+        if not values:
+            return errors
+        # loads a superset of the existing values, which are matched below
+        lookups = dict((f.name + "__in", list(set(v[j] for v in values)))
+                       for j, f in enumerate(fields))
+        for row in self._meta.model.objects.filter(**lookups).values_list(
+                *([f.attname for f in fields] + ['pk'])):
+            value, pk = row[:-1], row[-1]
+            if value in values and instances[values[value]].pk != pk:
+                errors.setdefault(values[value], ValidationError(
+                    "%s %s already exists" % (
+                        names, ", ".join(unicode(v) for v in value))))
+        return errors
+
+    def bulk_import_data(self, dataset, dry_run=False):
+        """Import the dataset like import_data, but all rows are validated in
+        memory with validate_instances and written with bulk_create and one
+        update per changed row. Nothing is written for a dry run. No signals
+        are sent for the written objects, after_bulk_import takes care of
+        that instead."""
+        result = Result()
+        try:
+            self.before_import(dataset, dry_run)
+            rows = dataset.dict
+            existing = self.get_bulk_instances(rows)
+        except Exception as e:
+            result.base_errors.append(Error(repr(e), traceback.format_exc()))
+            return result
+
+        instances = []
+        originals = []
+        for row, instance in zip(rows, existing):
+            row_result = RowResult()
+            if instance is None:
+                instance = self.init_instance(row)
+                row_result.import_type = RowResult.IMPORT_TYPE_NEW
+            else:
+                row_result.import_type = RowResult.IMPORT_TYPE_UPDATE
+            original = deepcopy(instance)
+            try:
+                self.import_obj(instance, row, dry_run)
+            except Exception as e:
+                row_result.errors.append(Error(repr(e),
+                                               traceback.format_exc()))
+            if row_result.import_type == RowResult.IMPORT_TYPE_UPDATE and \
+                    self.skip_row(instance, original):
+                row_result.import_type = RowResult.IMPORT_TYPE_SKIP
+            result.rows.append(row_result)
+            instances.append(instance)
+            originals.append(original)
+
+        valid = [i for i, row_result in enumerate(result.rows)
+                 if not row_result.errors]
+        for i, error in self.validate_instances(
+                [instances[i] for i in valid]).items():
+            result.rows[valid[i]].errors.append(
+                Error("; ".join(error.messages)))
+        for row_result, original, instance in zip(result.rows, originals,
+                                                  instances):
+            row_result.diff = self.get_diff(original, instance, dry_run)
+        if dry_run or result.has_errors():
+            return result
+
+        new = [instance for instance, row_result in zip(instances,
+                                                        result.rows)
+               if row_result.import_type == RowResult.IMPORT_TYPE_NEW]
+        updated = [(original, instance) for original, instance, row_result
+                   in zip(originals, instances, result.rows)
+                   if row_result.import_type == RowResult.IMPORT_TYPE_UPDATE]
+        try:
+            with transaction.atomic():
+                self.create_instances(new)
+                for original, instance in updated:
+                    self.update_instance(original, instance)
+                self.after_bulk_import(new, updated)
+        except Exception as e:
+            result.base_errors.append(Error(repr(e), traceback.format_exc()))
+        return result
+
+    def create_instances(self, instances):
+        """Insert the new instances with a single bulk_create"""
+        self._meta.model.objects.bulk_create(instances)
+
+    def update_instance(self, original, instance):
+        """Write the fields that changed with a single update"""
+        changed = dict((f.name, getattr(instance, f.attname))
+                       for f in self._meta.model._meta.fields
+                       if not f.primary_key and getattr(original, f.attname)
+                       != getattr(instance, f.attname))
+        if changed:
+            self._meta.model.objects.filter(pk=instance.pk).update(**changed)
+
+    def after_bulk_import(self, new, updated):
+        """Called after bulk_import_data wrote the new instances, which have
+        no primary key yet, and the (original, instance) pairs of the updated
+        ones. Does the work of the skipped signals. New objects can't have
+        cached labels yet, so only the labels of the updated ones and of the
+        models that show them are invalidated."""
+        model = self._meta.model
+        if model in barcode_models and updated:
+            invalidate_object_labels(
+                model, [instance.pk for original, instance in updated])
+        if updated:
+            invalidate_dependent_labels(model)
+
+
+class ContainerResource(LIMSModelResource):
+    bulk_import = True
+    export_select_related = (
+        'apparatus_subdivision__apparatus',
+        'root_container__apparatus_subdivision__apparatus',
+    )
+
+    barcode = fields.Field(attribute='barcode', column_name='barcode',
+                           readonly=True)
+    root_apparatus = fields.Field(column_name='root_apparatus',
+                                  readonly=True)
+    root_apparatus_subdivision = fields.Field(
+        column_name='root_apparatus_subdivision', readonly=True)
+    nr_children = fields.Field(column_name='nr_children', readonly=True)
+    nr_objects_in_container = fields.Field(
+        column_name='nr_objects_in_container', readonly=True)
+
+    def get_export_queryset(self, queryset):
+        return super(ContainerResource, self).get_export_queryset(
+            queryset).with_counts()
+
+    def dehydrate_root_apparatus(self, container):
+        if container.root.apparatus_subdivision_id is None:
+            return ""
+        return container.root_apparatus
+
+    def dehydrate_root_apparatus_subdivision(self, container):
+        if container.root.apparatus_subdivision_id is None:
+            return ""
+        return container.root_apparatus_subdivision
+
+    # The counts are only known for exported Containers, not for the import
+    # preview
+    def dehydrate_nr_children(self, container):
+        return getattr(container, 'annotated_nr_children', "")
+
+    def dehydrate_nr_objects_in_container(self, container):
+        return getattr(container, 'annotated_nr_objects', "")
+
+    def create_instances(self, instances):
+        """bulk_create doesn't set the ids, which are needed to store the
+        paths of the new Containers. The new rows are the ones after the
+        highest id that don't have a path yet, in the order they were
+        inserted."""
+        last_pk = Container.objects.aggregate(last_pk=Max('pk'))['last_pk']
+        super(ContainerResource, self).create_instances(instances)
+        pks = list(Container.objects.filter(pk__gt=last_pk or 0, path="")
+                   .order_by('pk').values_list('pk', flat=True))
+        if len(pks) != len(instances):
+            raise IntegrityError("Expected %d new containers, found %d" %
+                                 (len(instances), len(pks)))
+        for instance, pk in zip(instances, pks):
+            instance.pk = pk
+
+    def after_bulk_import(self, new, updated):
+        super(ContainerResource, self).after_bulk_import(new, updated)
+        Container.materialize_new([c.pk for c in new])
+        RegisteredBarcode.register_new(new)
+        for original, instance in updated:
+            if original.parent_id != instance.parent_id:
+                instance.update_path()
 
-class ContainerResource(resources.ModelResource):
     class Meta:
         model = Container
+        # The materialized hierarchy is derived from parent on save
+        exclude = ('path', 'depth', 'root_container')
+
+
+def load_extra_columns(value):
+    """Returns the dict stored in the extra_columns_json of a Sample"""
+    if not value:
+        return {}
+    extra_columns = json.loads(value)
+    if not isinstance(extra_columns, dict):
+        raise ValueError("extra_columns_json should be a JSON object")
+    return extra_columns
 
 
-class SampleResource(resources.ModelResource):
+class SampleResource(LIMSModelResource):
+    bulk_import = True
+
+    barcode = fields.Field(attribute='barcode', column_name='barcode',
+                           readonly=True)
+    # exported, but set to the importing user by import_obj
+    created_by = fields.Field(attribute='created_by', column_name='created_by',
+                              readonly=True,
+                              widget=LIMSForeignKeyWidget(UserProfile))
+    modified_by = fields.Field(attribute='modified_by',
+                               column_name='modified_by', readonly=True,
+                               widget=LIMSForeignKeyWidget(UserProfile))
     #collaborator = fields.Field(attribute='collaborator', column_name='collaborator', widget=LIMSForeignKeyWidget(Collaborator))
 
-    def before_import(self, dataset, dry_run):
-        nr_core_sample_cols = 17
-        extra_column_data = []
-
-        for row in dataset:
-            ecd_row = {}
-            for i in range(nr_core_sample_cols + 1, len(dataset.headers)):
-                ecd_row[dataset.headers[i]] = row[i]
-            extra_column_data.append(json.dumps(ecd_row))
-
-        #print(dataset['extra_column1'], file=sys.stderr)
-        del dataset['extra_columns_json']
-        dataset.append_col(extra_column_data, header='extra_columns_json')
-        #print(dataset['extra_columns_json'], file=sys.stderr)
+    def prepare_rows(self, headers, rows):
+        """Store the columns after extra_columns_json that are not fields of
+        the resource, e.g. barcode, as JSON in extra_columns_json, together
+        with the JSON in the extra_columns_json column itself"""
+        if 'extra_columns_json' not in headers:
+            return headers, rows
+        pos = headers.index('extra_columns_json')
+        columns = set(f.column_name for f in self.get_fields())
+        keep = [i for i, h in enumerate(headers) if i <= pos or h in columns]
+        extra = [i for i, h in enumerate(headers)
+                 if i > pos and h not in columns]
+
+        def fold(row):
+            row = list(row) + (len(headers) - len(row)) * [""]
+            new_row = [row[i] for i in keep]
+            try:
+                values = json.loads(row[pos]) if row[pos] else {}
+            except ValueError:
+                # left as is, import_obj reports it
+                return new_row
+            if isinstance(values, dict):
+                values.update((headers[i], row[i]) for i in extra)
+                new_row[pos] = json.dumps(values, default=unicode)
+            return new_row
+        return [headers[i] for i in keep], (fold(row) for row in rows)
+
+    def import_obj(self, obj, data, dry_run):
+        extra_columns = obj.extra_columns_json
+        super(SampleResource, self).import_obj(obj, data, dry_run)
+        if obj.extra_columns_json != extra_columns:
+            # merge the imported extra columns into the existing ones
+            merged = load_extra_columns(extra_columns)
+            merged.update(load_extra_columns(obj.extra_columns_json))
+            obj.extra_columns_json = json.dumps(merged, default=unicode) \
+                if merged else ""
+        if self.user is not None:
+            obj.set_user(self.user)
+
+    def clean_instance(self, instance):
+        # the containers of a Sample are not imported, so only check the uid
+        instance.clean_uid()
+
+    def after_bulk_import(self, new, updated):
+        super(SampleResource, self).after_bulk_import(new, updated)
+        new = list(Sample.objects.filter(uid__in=[s.uid for s in new]))
+        RegisteredBarcode.register_new(new)
+        for original, instance in updated:
+            if original.uid != instance.uid:
+                RegisteredBarcode.register(instance)
+        tree_cache.invalidate_sample_trees(
+            [s.pk for s in new] +
+            [instance.pk for original, instance in updated])
 
     class Meta:
         model = Sample
@@ -0,0 +1,157 @@
+"""
+Background jobs. Long imports, exports and print runs are queued as a Job in
+the database instead of running in the web request. The run_jobs management
+command claims queued jobs and calls the function registered under the name
+of the Job with the Job and its arguments. No broker is needed, the worker
+only polls the database.
+
+Job functions can report progress with job.set_progress and return a
+message. They raise JobFailed to fail with a message instead of a traceback.
+Running jobs that stop reporting progress for settings.LIMS_JOB_TIMEOUT
+seconds, e.g. because their worker was killed, are marked as failed.
+"""
+import json
+import os
+import traceback
+from datetime import timedelta
+from StringIO import StringIO
+
+from django.conf import settings
+from django.db.models import get_model
+from django.utils import timezone
+from import_export.formats import base_formats
+
+from lims.import_export_resources import ContainerResource, SampleResource, \
+    import_rows, read_rows, stream_export
+from lims.models import Job
+from lims.printing import print_labels
+
+# Job functions by name
+registry = {}
+
+# Resources that can be imported and exported in a job, by model name
+job_resources = {
+    "container": ContainerResource,
+    "sample": SampleResource,
+}
+
+
+class JobFailed(Exception):
+    pass
+
+
+def job(func):
+    """Decorator to register a job function"""
+    registry[func.__name__] = func
+    return func
+
+
+def enqueue(name, user=None, data=None, data_name="", **arguments):
+    """Queue the job function registered as name. The arguments are stored
+    as JSON, data is the file a job works on."""
+    if name not in registry:
+        raise ValueError("Unknown job %s" % name)
+    return Job.objects.create(name=name, arguments=json.dumps(arguments),
+                              user=user, data=data, data_name=data_name)
+
+
+def fail_stale_jobs():
+    """Mark running Jobs without a heartbeat in the last
+    settings.LIMS_JOB_TIMEOUT seconds as failed. Returns their number."""
+    now = timezone.now()
+    return Job.objects.filter(
+        status=Job.RUNNING,
+        heartbeat__lt=now - timedelta(seconds=settings.LIMS_JOB_TIMEOUT)
+    ).update(status=Job.FAILED, finished=now,
+             message="No progress for %d seconds, the worker was probably "
+                     "stopped" % settings.LIMS_JOB_TIMEOUT)
+
+
+def claim_job():
+    """Returns the oldest queued Job after marking it as running or None if
+    there is none. The status is changed with a conditional update, so a Job
+    is only claimed by one worker. Stale running Jobs are failed first."""
+    fail_stale_jobs()
+    queued = Job.objects.filter(status=Job.QUEUED).order_by('pk')
+    for pk in queued.values_list('pk', flat=True)[:10]:
+        now = timezone.now()
+        if Job.objects.filter(pk=pk, status=Job.QUEUED).update(
+                status=Job.RUNNING, started=now, heartbeat=now):
+            return Job.objects.get(pk=pk)
+    return None
+
+
+def run_job(job):
+    """Run a claimed Job and store its outcome"""
+    try:
+        message = registry[job.name](job, **job.get_arguments())
+    except JobFailed as e:
+        status, message = Job.FAILED, unicode(e)
+    except Exception:
+        status, message = Job.FAILED, traceback.format_exc()
+    else:
+        status = Job.DONE
+    Job.objects.filter(pk=job.pk).update(status=status, message=message or "",
+                                         finished=timezone.now())
+
+
+def get_job_pks(queryset):
+    """Returns the primary keys of the queryset to pass to a job, None if it
+    holds all objects of the model"""
+    pks = list(queryset.values_list('pk', flat=True))
+    if len(pks) == queryset.model._default_manager.count():
+        return None
+    return pks
+
+
+def get_queryset(model, pks):
+    """Returns the objects of the model with the given primary keys or all
+    objects if pks is None"""
+    queryset = get_model("lims", model).objects.all()
+    return queryset if pks is None else queryset.filter(pk__in=pks)
+
+
+@job
+def import_file(job, model, input_format):
+    """Import job.data, a file in one of the base_formats, e.g. CSV"""
+    headers, rows = read_rows(StringIO(bytes(job.data)),
+                              getattr(base_formats, input_format)())
+    resource = job_resources[model](user=job.user)
+    result = import_rows(resource, headers, rows, progress=job.set_progress)
+    if result.has_errors():
+        errors = [error.error for error in result.base_errors] + \
+            ["Line %d: %s" % (line, error.error)
+             for line, errors in result.row_errors() for error in errors]
+        raise JobFailed("Imported %d of %d rows\n%s" % (
+            result.nr_imported, result.nr_rows, "\n".join(errors)))
+    return "Imported %d rows" % result.nr_imported
+
+
+@job
+def export_file(job, model, pks=None, delimiter=","):
+    """Export the objects to a csv file in settings.LIMS_EXPORT_DIR, its
+    name is stored in job.data_name once it is complete"""
+    queryset = get_queryset(model, pks)
+    job.set_progress(0, queryset.count())
+    if not os.path.isdir(settings.LIMS_EXPORT_DIR):
+        os.makedirs(settings.LIMS_EXPORT_DIR)
+    data_name = "%s-%d.%s" % (model, job.pk,
+                              "csv" if delimiter == "," else "tsv")
+    path = os.path.join(settings.LIMS_EXPORT_DIR, data_name)
+    with open(path, "wb") as f:
+        for nr_lines, line in enumerate(stream_export(job_resources[model](),
+                                                      queryset, delimiter)):
+            f.write(line)
+            if nr_lines and nr_lines % 1000 == 0:
+                job.set_progress(nr_lines)
+    Job.objects.filter(pk=job.pk).update(progress=nr_lines,
+                                         data_name=data_name)
+    return "Exported %d rows" % nr_lines
+
+
+@job
+def print_barcodes(job, model, pks):
+    """Print the labels of the objects"""
+    printers, nr_labels = print_labels(get_queryset(model, pks))
+    return "Sent %d labels to %s" % (nr_labels,
+                                     ", ".join(p.name for p in printers))
@@ -0,0 +1,49 @@
+from collections import defaultdict
+
+from django.contrib.admin.models import LogEntry, ADDITION, CHANGE
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from lims.models import Sample
+
+
+def update_users(field, users, chunk_size=500):
+    """Set field to the user for every Sample id in users, where it is not
+    set yet. Samples are updated per user in chunks of chunk_size ids."""
+    by_user = defaultdict(list)
+    for sample_id, user_id in users.items():
+        by_user[user_id].append(sample_id)
+    nr_updated = 0
+    for user_id, sample_ids in by_user.items():
+        for i in range(0, len(sample_ids), chunk_size):
+            nr_updated += Sample.objects.filter(
+                pk__in=sample_ids[i:i + chunk_size],
+                **{field + "__isnull": True}).update(**{field: user_id})
+    return nr_updated
+
+
+class Command(NoArgsCommand):
+    help = ("Fill in created_by and modified_by of Samples that don't have "
+            "them from the admin log.")
+
+    def handle_noargs(self, **options):
+        created_by, modified_by = {}, {}
+        entries = LogEntry.objects.filter(
+            content_type=ContentType.objects.get_for_model(Sample),
+            action_flag__in=[ADDITION, CHANGE]).order_by('action_time', 'pk')
+        for object_id, user_id, action_flag in entries.values_list(
+                'object_id', 'user_id', 'action_flag').iterator():
+            try:
+                sample_id = int(object_id)
+            except ValueError:
+                continue
+            if action_flag == ADDITION:
+                created_by.setdefault(sample_id, user_id)
+            modified_by[sample_id] = user_id
+
+        with transaction.atomic():
+            nr_created = update_users('created_by', created_by)
+            nr_modified = update_users('modified_by', modified_by)
+        self.stdout.write("Set created_by of %d and modified_by of %d Samples"
+                          % (nr_created, nr_modified))
@@ -0,0 +1,39 @@
+import json
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from lims.benchmark import BenchmarkError, compare_results, run_benchmarks
+
+
+class Command(NoArgsCommand):
+    help = ("Time the main pages of the LIMS on the configured database, e.g. "
+            "a dataset from generate_dataset, and store the results as "
+            "JSON.")
+    option_list = NoArgsCommand.option_list + (
+        make_option("--repeat", type="int", dest="repeat", default=5,
+                    help="Number of requests per page"),
+        make_option("--output", dest="output",
+                    help="JSON file for the results, defaults to "
+                         "benchmark-<date>.json"),
+        make_option("--compare", dest="compare",
+                    help="JSON file of an earlier run to compare with"),
+    )
+
+    def handle_noargs(self, **options):
+        try:
+            results = run_benchmarks(options["repeat"],
+                                     log=self.stdout.write)
+        except BenchmarkError as e:
+            raise CommandError(e)
+        output = options["output"] or \
+            time.strftime("benchmark-%Y%m%d-%H%M%S.json")
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        self.stdout.write("Stored the results in %s" % output)
+
+        if options["compare"]:
+            with open(options["compare"]) as f:
+                for line in compare_results(json.load(f), results):
+                    self.stdout.write(line)
@@ -0,0 +1,36 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from lims.dataset import DatasetError, generate_dataset
+
+
+class Command(NoArgsCommand):
+    help = ("Generate a synthetic dataset of Samples with their lineage, "
+            "storage and sequencing data to run benchmarks on.")
+    option_list = NoArgsCommand.option_list + (
+        make_option("--samples", type="int", dest="samples", default=100,
+                    help="Number of Samples to generate"),
+        make_option("--prefix", dest="prefix", default="Z",
+                    help="First character of the Sample uids, should not be "
+                         "in use yet"),
+        make_option("--sags", type="int", dest="sags", default=8,
+                    help="Number of wells with a SAG per SAG plate and per "
+                         "SAG plate dilution"),
+        make_option("--libraries-per-run", type="int",
+                    dest="libraries_per_run", default=96,
+                    help="Number of DNA libraries per sequencing run"),
+        make_option("--seed", type="int", dest="seed", default=0,
+                    help="Seed of the random values"),
+    )
+
+    def handle_noargs(self, **options):
+        try:
+            counts = generate_dataset(
+                options["samples"], prefix=options["prefix"],
+                sags_per_plate=options["sags"],
+                libraries_per_run=options["libraries_per_run"],
+                seed=options["seed"], log=self.stdout.write)
+        except DatasetError as e:
+            raise CommandError(e)
+        self.stdout.write("Created %d objects" % sum(counts.values()))
@@ -0,0 +1,53 @@
+import os
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from import_export.formats import base_formats
+
+from lims.import_export_resources import SampleResource, import_rows, \
+    read_rows
+
+formats = {
+    ".csv": base_formats.CSV,
+    ".tsv": base_formats.TSV,
+    ".xlsx": base_formats.XLSX,
+    ".xls": base_formats.XLS,
+    ".json": base_formats.JSON,
+}
+
+
+class Command(BaseCommand):
+    args = "<file>"
+    help = ("Import Samples from a csv, tsv, xlsx, xls or json file in the "
+            "format of the admin import. Rows are committed in chunks.")
+    option_list = BaseCommand.option_list + (
+        make_option("--chunk-size", type="int", dest="chunk_size",
+                    help="Number of rows per transaction"),
+        make_option("--dry-run", action="store_true", dest="dry_run",
+                    default=False, help="Only check the rows for errors"),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give the file to import")
+        extension = os.path.splitext(args[0])[1].lower()
+        if extension not in formats:
+            raise CommandError("Unknown file format %s" % extension)
+
+        def progress(nr_rows):
+            self.stdout.write("Processed %d rows" % nr_rows)
+
+        with open(args[0], "rb") as f:
+            headers, rows = read_rows(f, formats[extension]())
+            result = import_rows(SampleResource(), headers, rows,
+                                 dry_run=options["dry_run"],
+                                 chunk_size=options["chunk_size"],
+                                 progress=progress)
+
+        for error in result.base_errors:
+            self.stderr.write(error.error)
+        for line, errors in result.row_errors():
+            for error in errors:
+                self.stderr.write("Line %d: %s" % (line, error.error))
+        self.stdout.write("Imported %d of %d rows" % (result.nr_imported,
+                                                       result.nr_rows))
@@ -0,0 +1,11 @@
+from django.core.management.base import NoArgsCommand
+
+from lims.models import RegisteredBarcode
+
+
+class Command(NoArgsCommand):
+    help = "Recreate the barcode registry from all objects with a barcode."
+
+    def handle_noargs(self, **options):
+        nr_barcodes = RegisteredBarcode.rebuild()
+        self.stdout.write("Registered %d barcodes" % nr_barcodes)
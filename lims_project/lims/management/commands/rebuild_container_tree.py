@@ -0,0 +1,12 @@
+from django.core.management.base import NoArgsCommand
+
+from lims.models import Container
+
+
+class Command(NoArgsCommand):
+    help = "Recalculate the materialized path of all Containers. Run this " \
+        "after loading Containers with loaddata or other raw imports."
+
+    def handle_noargs(self, **options):
+        nr_containers = Container.rebuild_tree()
+        self.stdout.write("Rebuilt tree for %d containers" % nr_containers)
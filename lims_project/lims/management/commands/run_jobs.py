@@ -0,0 +1,30 @@
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+from django.db import close_old_connections
+
+from lims.jobs import claim_job, run_job
+
+
+class Command(NoArgsCommand):
+    help = ("Run queued background jobs. Keeps polling for new jobs unless "
+            "--once is given.")
+    option_list = NoArgsCommand.option_list + (
+        make_option("--once", action="store_true", dest="once",
+                    default=False,
+                    help="Exit when there are no queued jobs left"),
+    )
+
+    def handle_noargs(self, **options):
+        while True:
+            job = claim_job()
+            if job is not None:
+                self.stdout.write("Running %s" % job)
+                run_job(job)
+            elif options["once"]:
+                break
+            else:
+                close_old_connections()
+                time.sleep(settings.LIMS_JOB_POLL_INTERVAL)
@@ -0,0 +1,255 @@
+"""
+Per request instrumentation, also in production where debug_toolbar isn't
+installed. MetricsMiddleware records for every request the number of SQL
+queries, the time spent in them, the time spent rendering templates, the
+total time and the size of the response, by the name of the view. The last
+LIMS_METRICS_WINDOW requests of every view are kept to compute percentiles,
+which views.metrics shows in the Prometheus text format. Requests over the
+LIMS_METRICS_SLOW_REQUEST_SECONDS or LIMS_METRICS_SLOW_REQUEST_QUERIES budget
+are logged with their slowest queries.
+
+Template rendering and database cursors are instrumented once when lims.models
+is loaded, see install_instrumentation. They only record anything while the
+current thread handles a request, so queries run while a streaming response
+is sent are not counted. Of the queries only the number, the total time and
+the LIMS_METRICS_SLOW_QUERIES slowest statements are kept. Every process
+keeps its own metrics.
+"""
+import heapq
+import logging
+import math
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db.backends import BaseDatabaseWrapper
+from django.template.base import Template
+
+logger = logging.getLogger(__name__)
+
+# Name and help of every recorded value, in the order of the values passed to
+# RequestMetrics.record
+METRICS = [
+    ("lims_request_seconds", "Time to handle a request."),
+    ("lims_request_queries", "Number of SQL queries of a request."),
+    ("lims_request_sql_seconds", "Time spent in SQL queries."),
+    ("lims_request_render_seconds", "Time spent rendering templates."),
+    ("lims_response_bytes", "Size of the response, without streamed "
+                            "responses."),
+]
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+def percentile(values, q):
+    """Returns the q quantile of the sorted values, nearest rank method"""
+    return values[max(0, int(math.ceil(q * len(values))) - 1)]
+
+
+def format_label(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n") \
+        .replace('"', '\\"')
+
+
+class ViewMetrics(object):
+    """Values recorded for one view. The last window values of every metric
+    are kept for the percentiles, sums and counts are kept since the process
+    started."""
+    def __init__(self, window):
+        self.values = [deque(maxlen=window) for m in METRICS]
+        self.sums = [0] * len(METRICS)
+        self.counts = [0] * len(METRICS)
+
+    def add(self, values):
+        for i, value in enumerate(values):
+            if value is not None:
+                self.values[i].append(value)
+                self.sums[i] += value
+                self.counts[i] += 1
+
+
+class RequestMetrics(object):
+    """ViewMetrics of all views, shared by the threads of a process"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.views = {}
+
+    def record(self, view, values):
+        """Add the values of one request, None if a value is unknown"""
+        with self.lock:
+            if view not in self.views:
+                self.views[view] = ViewMetrics(settings.LIMS_METRICS_WINDOW)
+            self.views[view].add(values)
+
+    def clear(self):
+        with self.lock:
+            self.views = {}
+
+    def render(self):
+        """Returns all metrics in the Prometheus text format"""
+        with self.lock:
+            views = sorted((view, [sorted(values) for values in m.values],
+                            list(m.sums), list(m.counts))
+                           for view, m in self.views.items())
+        lines = []
+        for i, (name, help_text) in enumerate(METRICS):
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s summary" % name)
+            for view, values, sums, counts in views:
+                label = 'view="%s"' % format_label(view)
+                if values[i]:
+                    for q in QUANTILES:
+                        lines.append('%s{%s,quantile="%s"} %r' % (
+                            name, label, q, float(percentile(values[i], q))))
+                lines.append("%s_sum{%s} %r" % (name, label, float(sums[i])))
+                lines.append("%s_count{%s} %d" % (name, label, counts[i]))
+        return "\n".join(lines) + "\n"
+
+
+request_metrics = RequestMetrics()
+
+# The time spent rendering templates and the QueryRecorder of the request of
+# the current thread, None when no request is recorded
+local = threading.local()
+template_render = Template.render
+database_cursor = BaseDatabaseWrapper.cursor
+
+
+def timed_render(self, context):
+    """Template.render that adds the time of the outermost render, so included
+    templates are counted once, to the request of the current thread"""
+    if getattr(local, 'render_time', None) is None or local.rendering:
+        return template_render(self, context)
+    local.rendering = True
+    start = time.time()
+    try:
+        return template_render(self, context)
+    finally:
+        local.rendering = False
+        local.render_time += time.time() - start
+
+
+class QueryRecorder(object):
+    """Number and total time of the queries of one request. Only the
+    nr_slowest slowest statements are kept, as (seconds, sql) tuples."""
+    def __init__(self, nr_slowest):
+        self.nr_slowest = nr_slowest
+        self.count = 0
+        self.time = 0.0
+        self.slowest = []
+
+    def add(self, sql, duration):
+        self.count += 1
+        self.time += duration
+        if len(self.slowest) < self.nr_slowest:
+            heapq.heappush(self.slowest, (duration, sql))
+        elif self.slowest and duration > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (duration, sql))
+
+    def get_slowest(self):
+        return sorted(self.slowest, reverse=True)
+
+
+class TimedCursor(object):
+    """Wraps a database cursor to add its queries to a QueryRecorder"""
+    def __init__(self, cursor, recorder):
+        self.cursor = cursor
+        self.recorder = recorder
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def execute(self, sql, params=None):
+        start = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            self.recorder.add(sql, time.time() - start)
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            self.recorder.add(sql, time.time() - start)
+
+
+def timed_cursor(self):
+    """BaseDatabaseWrapper.cursor that times the queries of the request of
+    the current thread"""
+    cursor = database_cursor(self)
+    recorder = getattr(local, 'queries', None)
+    return cursor if recorder is None else TimedCursor(cursor, recorder)
+
+
+def install_instrumentation():
+    """Instrument Template.render and BaseDatabaseWrapper.cursor for
+    MetricsMiddleware, once per process and only if settings.LIMS_METRICS
+    is on"""
+    if settings.LIMS_METRICS and \
+            Template.__dict__['render'] is not timed_render:
+        Template.render = timed_render
+        BaseDatabaseWrapper.cursor = timed_cursor
+
+
+def get_view_name(request, response):
+    """Returns the name of the view, with the model for the browse views that
+    serve all models. Not found responses are recorded under one name, so
+    requests for made up urls can't add metrics without limit."""
+    # imported here, lims.views uses request_metrics
+    from lims.views import browse_models
+    resolver_match = getattr(request, 'resolver_match', None)
+    if response.status_code == 404:
+        return "not_found"
+    if not resolver_match:
+        return "unresolved"
+    model_name = resolver_match.kwargs.get('model_name')
+    if model_name in browse_models:
+        return "%s.%s" % (resolver_match.view_name, model_name)
+    return resolver_match.view_name
+
+
+def log_slow_request(request, view, values, slowest):
+    duration, nr_queries, sql_time, render_time, size = values
+    logger.warning(
+        "Slow request %s %s (%s): %.3fs, %d queries in %.3fs, rendering "
+        "%.3fs, slowest queries:\n%s", request.method,
+        request.get_full_path(), view, duration, nr_queries, sql_time,
+        render_time, "\n".join("%.3fs %s" % (seconds, sql)
+                               for seconds, sql in slowest))
+
+
+class MetricsMiddleware(object):
+    """Records the metrics of every request in request_metrics. Put it first
+    in MIDDLEWARE_CLASSES to include the time of the other middleware."""
+    def __init__(self):
+        if not settings.LIMS_METRICS:
+            raise MiddlewareNotUsed
+
+    def process_request(self, request):
+        local.queries = QueryRecorder(settings.LIMS_METRICS_SLOW_QUERIES)
+        local.render_time = 0.0
+        local.rendering = False
+        request._metrics_start = time.time()
+
+    def process_response(self, request, response):
+        # process_request didn't run if a middleware before this one returned
+        # a response
+        if not hasattr(request, '_metrics_start'):
+            return response
+        duration = time.time() - request._metrics_start
+        queries, local.queries = local.queries, None
+        render_time, local.render_time = local.render_time, None
+
+        view = get_view_name(request, response)
+        values = (duration, queries.count, queries.time, render_time,
+                  None if response.streaming else len(response.content))
+        request_metrics.record(view, values)
+        if duration > settings.LIMS_METRICS_SLOW_REQUEST_SECONDS or \
+                queries.count > settings.LIMS_METRICS_SLOW_REQUEST_QUERIES:
+            log_slow_request(request, view, values, queries.get_slowest())
+        return response
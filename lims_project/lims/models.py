@@ -1,15 +1,19 @@
 from __future__ import print_function
-import sys
+import os
 import re
+import json
+import string
 
-from django.db import models
+from django.conf import settings
+from django.db import connection, models, transaction, IntegrityError
+from django.db.models.signals import post_save, post_delete
 from django.contrib.auth.models import AbstractUser
 from django.utils import timezone
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
-from django.contrib.admin.models import LogEntry
+from django.core.urlresolvers import reverse
 from django.template.defaultfilters import slugify
 
 
@@ -22,12 +26,34 @@ def property_verbose(description):
     return property_verbose_inner
 
 
+# Detail url formats per model, see Browsable.get_detail_url_format
+detail_url_formats = {}
+
+
+class Browsable(object):
+    """Mixin for models with a detail page in the browser, which shows the
+    attributes in preferred_ordering. The page is found by the model_name of
+    the model, see lims.views.browse_detail."""
+    @classmethod
+    def get_detail_url_format(cls):
+        """Returns the url of the detail page with %d for the id, so reverse()
+        only has to be called once per model."""
+        if cls not in detail_url_formats:
+            url = reverse('lims.views.browse_detail',
+                          args=[cls._meta.model_name, 0])
+            detail_url_formats[cls] = url[:url.rindex("0/")] + "%d/"
+        return detail_url_formats[cls]
+
+    def get_absolute_url(self):
+        return self.get_detail_url_format() % self.pk
+
+
 class UIDManager(models.Manager):
     def get_by_natural_key(self, uid):
         return self.get(uid=uid)
 
 
-class Apparatus(models.Model):
+class Apparatus(Browsable, models.Model):
     """Device that stores physical objects, could be a closet/freezer, etc."""
     name = models.CharField(max_length=100)
     temperature = models.DecimalField(u"Temperature \u00B0C", max_digits=10,
@@ -53,7 +79,7 @@ class Apparatus(models.Model):
         ]
 
 
-class ApparatusSubdivision(models.Model):
+class ApparatusSubdivision(Browsable, models.Model):
     """An apparatus can have multiple shelves or racks. If the machine has only
     one location to store things it should still have a record here, see
     Container documentation."""
@@ -61,6 +87,8 @@ class ApparatusSubdivision(models.Model):
     apparatus = models.ForeignKey(Apparatus)
     date = models.DateTimeField(default=timezone.now, blank=True)
 
+    browse_select_related = ('apparatus',)
+
     def __unicode__(self):
         return unicode("{0} {1}".format(self.apparatus, self.name))
 
@@ -75,6 +103,26 @@ class ApparatusSubdivision(models.Model):
         ]
 
 
+def check_label_template(template, nr_fields=4):
+    """Raise ValueError if the label template can't be formatted with
+    nr_fields positional fields"""
+    auto_index = 0
+    for literal, field_name, format_spec, conversion in \
+            string.Formatter().parse(template):
+        if field_name is None:
+            continue
+        index = re.split(r"[.\[]", field_name, 1)[0]
+        if index == "":
+            index = auto_index
+            auto_index += 1
+        elif not index.isdigit():
+            raise ValueError("Only positional fields like {0} are allowed, "
+                             "not {%s}" % field_name)
+        if int(index) >= nr_fields:
+            raise ValueError("Field {%s} is out of range, there are %d "
+                             "fields" % (field_name, nr_fields))
+
+
 class BarcodePrinter(models.Model):
     name = models.CharField(max_length=100)
     template = models.TextField(blank=True)
@@ -82,6 +130,16 @@ class BarcodePrinter(models.Model):
     def __unicode__(self):
         return unicode(self.name)
 
+    def clean(self):
+        try:
+            # labels are padded to at least four fields
+            check_label_template(self.template,
+                                 min([max(4, len(btm.barcode_fields.split()))
+                                      for btm in
+                                      self.barcodetomodel_set.all()] or [4]))
+        except ValueError as e:
+            raise ValidationError({"template": [unicode(e), ]})
+
 
 class BarcodeToModel(models.Model):
     qlimit = \
@@ -97,16 +155,87 @@ class BarcodeToModel(models.Model):
     barcode = models.ForeignKey(BarcodePrinter)
     barcode_fields = models.TextField(blank=True, help_text="Specify space-separated list of fields")
 
+    browse_select_related = ('barcode', 'content_type')
+
     def __unicode__(self):
         return unicode("{0} - {1}".format(self.barcode, self.content_type))
 
+    def clean(self):
+        if self.barcode_id is None:
+            return
+        try:
+            check_label_template(self.barcode.template,
+                                 max(4, len(self.barcode_fields.split())))
+        except ValueError as e:
+            raise ValidationError({"barcode_fields": [
+                "Template of %s: %s" % (self.barcode, e), ]})
+
+
+class RegisteredBarcode(models.Model):
+    """Registry of the barcodes of all objects that have one, so any barcode
+    can be resolved with a single indexed query. Rows are kept in sync by the
+    post_save and post_delete signals of the models in barcode_models."""
+    barcode = models.CharField(max_length=40, unique=True)
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    content_object = generic.GenericForeignKey('content_type', 'object_id')
+
+    class Meta:
+        unique_together = (("content_type", "object_id"),)
+
+    def __unicode__(self):
+        return unicode(self.barcode)
+
+    @property
+    def model(self):
+        return ContentType.objects.get_for_id(self.content_type_id).model_class()
+
+    @classmethod
+    def register(cls, obj):
+        """Store or update the barcode of obj"""
+        ct = ContentType.objects.get_for_model(obj.__class__)
+        if not cls.objects.filter(content_type=ct, object_id=obj.pk).update(
+                barcode=obj.barcode):
+            cls.objects.create(barcode=obj.barcode, content_type=ct,
+                               object_id=obj.pk)
+
+    @classmethod
+    def register_new(cls, objects):
+        """Store the barcodes of objects that are not registered yet, e.g.
+        after bulk_create"""
+        objects = list(objects)
+        if objects:
+            ct = ContentType.objects.get_for_model(objects[0].__class__)
+            cls.objects.bulk_create(
+                [cls(barcode=o.barcode, content_type=ct, object_id=o.pk)
+                 for o in objects], batch_size=500)
+
+    @classmethod
+    def unregister(cls, obj):
+        cls.objects.filter(
+            content_type=ContentType.objects.get_for_model(obj.__class__),
+            object_id=obj.pk).delete()
+
+    @classmethod
+    def rebuild(cls):
+        """Recreate the registry from all barcode_models. Returns the number
+        of barcodes."""
+        with transaction.atomic():
+            cls.objects.all().delete()
+            for model in barcode_models:
+                ct = ContentType.objects.get_for_model(model)
+                cls.objects.bulk_create(
+                    [cls(barcode=o.barcode, content_type=ct, object_id=o.pk)
+                     for o in model.objects.all().iterator()], batch_size=500)
+        return cls.objects.count()
+
 
 class CanPrintBarcode(object):
     def print_barcode(self):
         return "ola"
 
 
-class ContainerType(models.Model):
+class ContainerType(Browsable, models.Model):
     """The type of container e.g. petri dish, 384 well plate, bag, well,
     etc."""
     name = models.CharField(max_length=100)
@@ -129,7 +258,70 @@ class ContainerType(models.Model):
         ]
 
 
-class Container(models.Model):
+class ContainerQuerySet(models.query.QuerySet):
+    """QuerySet that can check the contents of Containers in the database.
+    A Container is empty if neither the Container itself nor any of its
+    descendants holds an object."""
+    # The descendants of a Container, including itself, are the Containers
+    # in the same tree with a path starting with its path. Paths only hold
+    # digits and slashes, which sort before '~', so this is a range on the
+    # (root_container, path) index instead of a LIKE pattern built per row.
+    descendants_sql = "descendant.root_container_id = " \
+        "{table}.root_container_id AND descendant.path >= {table}.path AND " \
+        "descendant.path < {table}.path || '~'"
+    occupied_sql = "EXISTS (SELECT 1 FROM {table} AS descendant WHERE " + \
+        descendants_sql + " AND descendant.object_id IS NOT NULL)"
+
+    nr_children_sql = "SELECT COUNT(*) FROM {table} AS child WHERE " \
+        "child.parent_id = {table}.id"
+    nr_objects_sql = "SELECT COUNT(*) FROM {table} AS descendant WHERE " + \
+        descendants_sql + " AND descendant.object_id IS NOT NULL"
+
+    def _occupied_sql(self):
+        return self.occupied_sql.format(table=self.model._meta.db_table)
+
+    def empty(self):
+        """Only return Containers without objects in them"""
+        return self.extra(where=["NOT " + self._occupied_sql()])
+
+    def not_empty(self):
+        """Only return Containers with at least one object in them"""
+        return self.extra(where=[self._occupied_sql()])
+
+    def with_is_empty(self):
+        """Annotate annotated_is_empty, used by Container.is_empty"""
+        return self.extra(
+            select={'annotated_is_empty': "NOT " + self._occupied_sql()})
+
+    def with_counts(self):
+        """Annotate annotated_nr_children and annotated_nr_objects, used by
+        Container.nr_children, Container.nr_objects_in_container,
+        Container.is_leaf and Container.is_empty"""
+        table = self.model._meta.db_table
+        return self.extra(select={
+            'annotated_nr_children': self.nr_children_sql.format(table=table),
+            'annotated_nr_objects': self.nr_objects_sql.format(table=table),
+        })
+
+
+class ContainerManager(models.Manager):
+    def get_queryset(self):
+        return ContainerQuerySet(self.model, using=self._db)
+
+    def empty(self):
+        return self.get_queryset().empty()
+
+    def not_empty(self):
+        return self.get_queryset().not_empty()
+
+    def with_is_empty(self):
+        return self.get_queryset().with_is_empty()
+
+    def with_counts(self):
+        return self.get_queryset().with_counts()
+
+
+class Container(Browsable, models.Model):
     """A container can hold samples or other physical objects. They have a
     type, explained in ContainerType. They have a parent and child field used
     to subdivide a Container in multiple Containers, e.g. a 384 well plate
@@ -137,7 +329,15 @@ class Container(models.Model):
     linked to a single ApparatusSubDivision so never to an Apparatus itself.
     The children Containers should leave the apparatus_subdivision field empty
     to avoid redundancy and inconsistencies between the root parent Container
-    and its children."""
+    and its children.
+
+    The hierarchy is also stored as a materialized path. The path of a
+    Container is the path of its parent followed by its own zero padded id,
+    e.g. 00000001/00000012/ for a well 12 in plate 1. Together with depth and
+    root_container this is kept up to date in save() so root, ancestors and
+    descendants can be looked up with a single indexed query."""
+    path_step_format = "%08d/"
+
     type = models.ForeignKey(ContainerType)
     row = models.IntegerField(blank=True, null=True)
     column = models.IntegerField(blank=True, null=True)
@@ -149,6 +349,13 @@ class Container(models.Model):
     notes = models.TextField(blank=True)
     date = models.DateTimeField(default=timezone.now, blank=True)
 
+    # Materialized hierarchy, maintained by save()
+    path = models.CharField(max_length=255, blank=True, editable=False,
+                            db_index=True)
+    depth = models.PositiveIntegerField(default=0, editable=False)
+    root_container = models.ForeignKey('self', blank=True, null=True,
+                                       editable=False, related_name="+")
+
     # Generic relation
     qlimit = models.Q(app_label="lims", model="sample") | \
              models.Q(app_label="lims", model="primer") | \
@@ -160,17 +367,32 @@ class Container(models.Model):
     object_id = models.PositiveIntegerField(blank=True, null=True)
     content_object = generic.GenericForeignKey('content_type', 'object_id')
 
+    objects = ContainerManager()
+
+    browse_select_related = ('type',)
+
     @property
     def barcode(self):
         return "CO:%06d" % (self.pk if self.pk else 0)
 
     @property_verbose("Root")
     def root(self):
-        # Follow Container to root
-        root = self
-        while root.parent is not None:
-            root = root.parent
-        return root
+        if self.parent_id is None:
+            return self
+        if self.root_container_id is None:
+            # Hierarchy not materialized yet, follow Container to root
+            root = self
+            while root.parent is not None:
+                root = root.parent
+            return root
+        # Fetch the root together with its storage location unless it has
+        # already been loaded e.g. by select_related
+        cache_name = self._meta.get_field('root_container').get_cache_name()
+        if not hasattr(self, cache_name):
+            self.root_container = Container.objects.select_related(
+                'apparatus_subdivision__apparatus').get(
+                pk=self.root_container_id)
+        return self.root_container
 
     @property_verbose("Apparatus")
     def root_apparatus(self):
@@ -184,16 +406,130 @@ class Container(models.Model):
             raise(Exception("Database inconsistency! If parent is null, "
                 "apparatus_subdivision should be set"))
 
-    def save(self):
+    def save(self, *args, **kwargs):
         """Saves and checks whether either parent or apparatus_subdivision is
         provided. Only the root Container with parent null should be linked to
-        an apparatus_subdivision."""
+        an apparatus_subdivision. The materialized path of the Container and,
+        when it is moved to another parent, of all its descendants is updated
+        as well."""
         if bool(self.parent) != bool(self.apparatus_subdivision):
-            super(Container, self).save()
+            if self.is_parent_descendant:
+                raise(Exception("A container can't be stored in itself or in "
+                                "one of its descendants."))
+            with transaction.atomic():
+                super(Container, self).save(*args, **kwargs)
+                self.update_path()
         else:
             raise(Exception("The root container should be linked to an "
             "apparatus_subdivision. Child containers not."))
 
+    @property
+    def is_parent_descendant(self):
+        """Check if the parent is this Container or one of its descendants"""
+        if self.pk is None or self.parent is None:
+            return False
+        return self.parent.pk == self.pk or \
+            "/" + self.path_step_format % self.pk in "/" + self.parent.path
+
+    def update_path(self):
+        """Store path, depth and root_container derived from the parent. If
+        the Container moved, the subtree below it is moved along."""
+        old_path, old_depth, old_root_container_id = \
+            Container.objects.filter(pk=self.pk).values_list(
+                'path', 'depth', 'root_container')[0]
+        if self.parent is None:
+            path = self.path_step_format % self.pk
+            depth = 0
+            root_container_id = self.pk
+        else:
+            path = self.parent.path + self.path_step_format % self.pk
+            depth = self.parent.depth + 1
+            root_container_id = self.parent.root_container_id
+
+        if (old_path, old_depth, old_root_container_id) != \
+           (path, depth, root_container_id):
+            Container.objects.filter(pk=self.pk).update(
+                path=path, depth=depth, root_container=root_container_id)
+            if old_path and old_path != path:
+                # rewrite the subtree with a single update, see
+                # ContainerQuerySet.descendants_sql for the path range
+                qn = connection.ops.quote_name
+                connection.cursor().execute(
+                    "UPDATE {table} SET {path} = %s || substr({path}, %s), "
+                    "{depth} = {depth} + %s, {root} = %s WHERE {path} >= %s "
+                    "AND {path} < %s AND {id} != %s".format(
+                        table=qn(Container._meta.db_table), path=qn('path'),
+                        depth=qn('depth'), root=qn('root_container_id'),
+                        id=qn('id')),
+                    [path, len(old_path) + 1, depth - old_depth,
+                     root_container_id, old_path, old_path + "~", self.pk])
+        self.path = path
+        self.depth = depth
+        self.root_container_id = root_container_id
+
+    @classmethod
+    def store_paths(cls, parents, paths):
+        """Store the materialized path of the Containers in parents, a dict
+        of Container id to parent id. paths holds the paths of parents that
+        are not in parents themselves."""
+        def get_path(pk):
+            if pk not in paths:
+                parent = parents[pk]
+                paths[pk] = (get_path(parent) if parent else "") + \
+                    cls.path_step_format % pk
+            return paths[pk]
+
+        rows = []
+        for pk in parents:
+            path = get_path(pk)
+            rows.append((path, path.count("/") - 1, int(path.split("/")[0]),
+                         pk))
+        qn = connection.ops.quote_name
+        sql = "UPDATE %s SET %s = %%s, %s = %%s, %s = %%s WHERE %s = %%s" % (
+            qn(cls._meta.db_table), qn('path'), qn('depth'),
+            qn('root_container_id'), qn('id'))
+        with transaction.atomic():
+            connection.cursor().executemany(sql, rows)
+
+    @classmethod
+    def rebuild_tree(cls):
+        """Recalculate the materialized path of all Containers, e.g. after
+        loading Containers with loaddata. Returns the number of Containers."""
+        parents = dict(cls.objects.values_list('id', 'parent'))
+        cls.store_paths(parents, {})
+        return len(parents)
+
+    @classmethod
+    def materialize_new(cls, pks=None):
+        """Store the materialized path of the Containers with the given ids,
+        e.g. after bulk_create, or of all Containers that don't have one yet
+        if pks is None. Returns the ids of these Containers."""
+        new = cls.objects.filter(path="") if pks is None else \
+            cls.objects.filter(pk__in=pks)
+        parents = dict(new.values_list('id', 'parent'))
+        paths = dict(cls.objects.filter(
+            pk__in=set(parents.values()) - set(parents) - set([None]))
+            .values_list('id', 'path'))
+        cls.store_paths(parents, paths)
+        return list(parents)
+
+    def get_ancestors(self, include_self=False):
+        """Returns the ancestors of this Container ordered from root down"""
+        ids = [int(i) for i in self.path.split("/") if i]
+        if not include_self:
+            ids = ids[:-1]
+        return Container.objects.filter(pk__in=ids).order_by('depth')
+
+    def get_descendants(self, include_self=False):
+        """Returns all Containers below this Container, none if its path is
+        not stored yet"""
+        if not self.path:
+            return Container.objects.none()
+        descendants = Container.objects.filter(path__startswith=self.path)
+        if not include_self:
+            descendants = descendants.exclude(pk=self.pk)
+        return descendants
+
     def __unicode__(self):
         return unicode("%s-%s") % (self.type, self.barcode)
 
@@ -209,6 +545,10 @@ class Container(models.Model):
             apparatus_subdivision."""
             raise ValidationError({"parent": [error_msg, ],
                                    "apparatus_subdivision": [error_msg, ]})
+        elif self.is_parent_descendant:
+            error_msg = """A container can't be stored in itself or in one of
+            its descendants."""
+            raise ValidationError({"parent": [error_msg, ]})
         super(Container, self).clean()
 
     @property
@@ -233,39 +573,77 @@ class Container(models.Model):
     @property
     def is_leaf(self):
         """Check if container is a leaf container"""
-        return len(self.child.all()) == 0
+        return self.nr_children == 0
+
+    @property_verbose("No of Children")
+    def nr_children(self):
+        """Count number of child containers"""
+        if hasattr(self, 'annotated_nr_children'):
+            return self.annotated_nr_children
+        return self.child.count()
 
     def get_objects_in_container(self):
         """Get all objects in the container. If this is not a leaf container,
         also get child objects."""
-        if self.is_leaf:
-            return [] if self.is_empty else [self.content_object]
-        else:
-            objects = []
-            for c in self.child.all():
-                objects.extend(c.get_objects_in_container())
-            return objects
+        return list(self.iter_objects_in_container())
+
+    def iter_objects_in_container(self, chunk_size=1000):
+        """Iterate over all objects in the container and its descendants. The
+        subtree is read in a single query and the objects are loaded per
+        chunk_size Containers with one query per content type, so large racks
+        can be streamed."""
+        stored = self.get_descendants(include_self=True).filter(
+            object_id__isnull=False).order_by('path').values_list(
+            'content_type', 'object_id')
+        chunk = []
+        for ct_id, object_id in stored.iterator():
+            chunk.append((ct_id, object_id))
+            if len(chunk) == chunk_size:
+                for o in self.load_stored_objects(chunk):
+                    yield o
+                chunk = []
+        for o in self.load_stored_objects(chunk):
+            yield o
+
+    @staticmethod
+    def load_stored_objects(stored):
+        """Returns the objects for a list of (content_type_id, object_id)
+        tuples in the same order, using one in_bulk query per content
+        type. Objects that no longer exist are left out."""
+        ids_by_ct = {}
+        for ct_id, object_id in stored:
+            ids_by_ct.setdefault(ct_id, []).append(object_id)
+        objects = {}
+        for ct_id, ids in ids_by_ct.items():
+            model = ContentType.objects.get_for_id(ct_id).model_class()
+            for pk, o in model._default_manager.in_bulk(ids).items():
+                objects[(ct_id, pk)] = o
+        return [objects[s] for s in stored if s in objects]
 
     @property
     def nr_objects_in_container(self):
-        """Count number of objects in the container"""
-        if self.is_leaf:
-            return 0 if self.is_empty else 1
-        else:
-            count = 0
-            for c in self.child.all():
-                if c.is_leaf:
-                    count += 1
-            return count
+        """Count number of objects in the container and its descendants"""
+        if hasattr(self, 'annotated_nr_objects'):
+            return self.annotated_nr_objects
+        return self.get_descendants(include_self=True).filter(
+            object_id__isnull=False).count()
 
     @property
     def is_empty(self):
         """Checks if the container is empty. If the container is not a leaf
         container, also check child containers."""
-        return self.object_id is None
+        if hasattr(self, 'annotated_is_empty'):
+            return bool(self.annotated_is_empty)
+        if hasattr(self, 'annotated_nr_objects'):
+            return self.annotated_nr_objects == 0
+        if self.object_id is not None:
+            return False
+        return not self.get_descendants().filter(
+            object_id__isnull=False).exists()
 
     class Meta:
         unique_together = (("row", "column", "parent"),)
+        index_together = (("root_container", "path"),)
 
 
 class StorablePhysicalObject(models.Model):
@@ -306,30 +684,149 @@ class StorablePhysicalObject(models.Model):
 #
 
 
+class IndexByGroupCounter(models.Model):
+    """Holds the next index_by_group for every group of an IndexByGroup model,
+    so new indexes can be handed out without counting the group. The row of a
+    group is locked while an index is reserved, which prevents concurrent
+    inserts for the same group from getting the same index."""
+    content_type = models.ForeignKey(ContentType, related_name="+")
+    group_content_type = models.ForeignKey(ContentType, related_name="+")
+    group_id = models.PositiveIntegerField()
+    next_index = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = (("content_type", "group_content_type", "group_id"),)
+
+    def __unicode__(self):
+        return unicode("{0} {1} {2}: {3}".format(
+            self.content_type, self.group_content_type, self.group_id,
+            self.next_index))
+
+    @classmethod
+    def reserve(cls, obj, count=1):
+        """Reserve count indexes in the group of the IndexByGroup object obj
+        and return the first one. Should be called inside a transaction that
+        also saves the object(s), the counter is locked until it ends. The
+        counter of a group is initialized from the highest index_by_group
+        stored so far."""
+        key = {
+            'content_type': ContentType.objects.get_for_model(obj.__class__),
+            'group_content_type':
+                ContentType.objects.get_for_model(obj.group.__class__),
+            'group_id': obj.group.pk,
+        }
+        with transaction.atomic():
+            try:
+                counter = cls.objects.select_for_update().get(**key)
+            except cls.DoesNotExist:
+                max_index = obj.get_max_by_group()
+                try:
+                    with transaction.atomic():
+                        counter = cls.objects.create(
+                            next_index=0 if max_index is None else max_index + 1,
+                            **key)
+                except IntegrityError:
+                    # Created concurrently
+                    counter = cls.objects.select_for_update().get(**key)
+            cls.objects.filter(pk=counter.pk).update(
+                next_index=models.F('next_index') + count)
+        return counter.next_index
+
+    @classmethod
+    def create_for_new_groups(cls, objs_by_group):
+        """Create the counters of groups that have no objects yet, for the
+        lists of new IndexByGroup objects of every group in objs_by_group.
+        Their indexes start at 0. Raises IntegrityError if a group has a
+        counter already."""
+        cls.objects.bulk_create([cls(
+            content_type=ContentType.objects.get_for_model(
+                group_objs[0].__class__),
+            group_content_type=ContentType.objects.get_for_model(
+                group_objs[0].group.__class__),
+            group_id=group_objs[0].group.pk,
+            next_index=len(group_objs)) for group_objs in objs_by_group])
+
+
+class IndexByGroupManager(UIDManager):
+    def bulk_create_by_group(self, objs, batch_size=500, new_groups=False):
+        """Create IndexByGroup objects with bulk_create, which does not call
+        save(). The indexes of all new objects in a group are reserved in one
+        step, after which the uids are computed and the objects are inserted
+        batch_size at a time, all in one transaction. With new_groups the
+        groups were just created, so the counters of all groups are created
+        at once instead of reserving indexes group by group. As no post_save
+        is sent, the barcodes of the objects are registered and the sample
+        trees and labels of the objects are invalidated here. Returns the
+        created objects as fetched from the database, in the given order."""
+        objs = list(objs)
+        groups = {}
+        for obj in objs:
+            obj.check_save()
+            key = (obj.group.__class__, obj.group.pk)
+            groups.setdefault(key, []).append(obj)
+
+        with transaction.atomic():
+            if new_groups:
+                IndexByGroupCounter.create_for_new_groups(groups.values())
+            for group_objs in groups.values():
+                first_index = 0 if new_groups else \
+                    IndexByGroupCounter.reserve(group_objs[0], len(group_objs))
+                for i, obj in enumerate(group_objs):
+                    obj.check_index_by_group(first_index + i)
+                    obj.index_by_group = first_index + i
+                    obj.uid = obj.make_uid()
+
+            created = {}
+            for i in range(0, len(objs), batch_size):
+                batch = objs[i:i + batch_size]
+                self.bulk_create(batch)
+                created.update((o.uid, o) for o in self.filter(
+                    uid__in=[obj.uid for obj in batch]))
+            created = [created[obj.uid] for obj in objs]
+            if self.model in barcode_models:
+                RegisteredBarcode.register_new(created)
+
+        # bulk_create doesn't send post_save, invalidate the caches of the
+        # new objects. Imported here as these modules import lims.models.
+        from lims import tree_cache
+        from lims.printing import invalidate_object_labels
+        pks = [obj.pk for obj in created]
+        if self.model in tree_cache.lineage_models:
+            tree_cache.invalidate_sample_trees(
+                tree_cache.get_lineage_sample_ids(self.model, pks))
+        if self.model in barcode_models:
+            invalidate_object_labels(self.model, pks)
+        return created
+
+
 class IndexByGroup(models.Model):
     """IndexByGroup allows one to group a model by another model and get the
     index based on that. An attribute character_list can be given to support a
-    naming scheme that converts the indexes to characters."""
+    naming scheme that converts the indexes to characters. Subclasses set
+    uid_format, the format of the uid with the uid of the group as {group},
+    the index counting from 1 as {number} and the index in the naming scheme
+    as {scheme}."""
+    def get_group_queryset(self):
+        """Returns all objects in the object's group"""
+        return self.__class__.objects.filter(
+            **{self.group_id_keyword: self.group.id})
+
     def get_count_by_group(self):
         """Count the number of objects related to the object's group"""
-        return self.__class__.objects.filter(**{self.group_id_keyword: self.group.id}).count()
+        return self.get_group_queryset().count()
 
     def get_max_by_group(self):
         """Gives the maximum index_by_group."""
-        return self.__class__.objects.filter(
-            **{self.group_id_keyword: self.group.id}).aggregate(
+        return self.get_group_queryset().aggregate(
             models.Max('index_by_group'))['index_by_group__max']
 
     def calc_index_by_group(self):
-        """Returns index_by_group and calculates it if non-existent"""
+        """Returns index_by_group and reserves a new one for a new instance,
+        see IndexByGroupCounter"""
         # calculate if this is a new instance
         if self.pk is None:
-            index_by_group = self.get_count_by_group()
-            if hasattr(self, 'character_list') \
-              and index_by_group >= len(self.character_list):
-                raise(Exception("Too many objects, only %i %s supported by "
-                                "naming scheme" % (len(self.character_list),
-                                                self.__class__)))
+            index_by_group = IndexByGroupCounter.reserve(self)
+            self.check_index_by_group(index_by_group)
             return index_by_group
         else:
             try:
@@ -337,15 +834,40 @@ class IndexByGroup(models.Model):
             except AttributeError:
                 raise(Exception("Object has pk but no index_by_group"))
 
-    def save(self):
-        """Determine index_by_group on save"""
-        if self.pk is None:
-            self.index_by_group = self.calc_index_by_group()
-        super(IndexByGroup, self).save()
+    def check_index_by_group(self, index_by_group):
+        """Checks whether the index is supported by the naming scheme"""
+        if hasattr(self, 'character_list') \
+          and index_by_group >= len(self.character_list):
+            raise(Exception("Too many objects, only %i %s supported by "
+                            "naming scheme" % (len(self.character_list),
+                                            self.__class__)))
+
+    def make_uid(self):
+        """Returns the uid based on group and index_by_group, see
+        uid_format"""
+        scheme = self.index_to_naming_scheme() \
+            if "{scheme}" in self.uid_format else None
+        return self.uid_format.format(group=self.group.uid,
+                                      number=self.index_by_group + 1,
+                                      scheme=scheme)
+
+    def check_save(self):
+        """Raises an Exception if the object can't be saved. Called by save()
+        and IndexByGroupManager.bulk_create_by_group()"""
+        pass
+
+    def save(self, *args, **kwargs):
+        """Determine index_by_group and uid on save. The index is reserved in
+        the same transaction as the insert."""
+        self.check_save()
+        with transaction.atomic():
+            if self.pk is None:
+                self.index_by_group = self.calc_index_by_group()
+                self.uid = self.make_uid()
+            super(IndexByGroup, self).save(*args, **kwargs)
 
     def index_to_naming_scheme(self):
         try:
-            print(self.index_by_group, file=sys.stderr)
             return self.character_list[self.index_by_group]
         except IndexError:
             raise(Exception("Too many objects, only %i %s supported by naming"
@@ -367,7 +889,7 @@ class IndexByGroup(models.Model):
     index_by_group = models.IntegerField(default="Automatically generated")
 
 
-class Collaborator(models.Model):
+class Collaborator(Browsable, models.Model):
     first_name = models.CharField(max_length=100)
     last_name = models.CharField(max_length=100)
     institution = models.CharField(max_length=100)
@@ -386,7 +908,7 @@ class Collaborator(models.Model):
         return [f.attname for f in self._meta.fields]
 
 
-class SampleType(models.Model):
+class SampleType(Browsable, models.Model):
     name = models.CharField(max_length=100, unique=True)
     description = models.TextField(blank=True)
     date = models.DateTimeField(default=timezone.now, blank=True)
@@ -400,7 +922,7 @@ class SampleType(models.Model):
         return [f.attname for f in self._meta.fields]
 
 
-class SampleLocation(models.Model):
+class SampleLocation(Browsable, models.Model):
     name = models.CharField(max_length=100, unique=True)
     description = models.TextField(blank=True)
     date = models.DateTimeField(default=timezone.now, blank=True)
@@ -414,7 +936,7 @@ class SampleLocation(models.Model):
         return [f.attname for f in self._meta.fields]
 
 
-class Sample(StorablePhysicalObject, models.Model):
+class Sample(Browsable, StorablePhysicalObject, models.Model):
     uid = models.CharField("UID", max_length=30, unique=True,
         help_text="UID should consist of five alphanumeric characters. Only capitals allowed.")
 
@@ -447,6 +969,13 @@ class Sample(StorablePhysicalObject, models.Model):
         choices=(('new', 'new'), ('used', 'used'), ('finished', 'finished')), blank=True, null=True)
     notes = models.TextField(blank=True)
     extra_columns_json = models.TextField(blank=True)
+    # set by the admin and imports, see set_user
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, blank=True,
+                                   null=True, editable=False,
+                                   related_name="created_samples")
+    modified_by = models.ForeignKey(settings.AUTH_USER_MODEL, blank=True,
+                                    null=True, editable=False,
+                                    related_name="modified_samples")
 
     objects = UIDManager()
 
@@ -460,10 +989,13 @@ class Sample(StorablePhysicalObject, models.Model):
     def __unicode__(self):
         return unicode("%s" % (self.uid))
 
-    def clean(self):
+    def clean_uid(self):
         if re.match("^[A-Z0-9]{5}$", str(self.uid)) is None:
             error_msg = """UID should consist of five alphanumeric characters. Only capitals allowed."""
             raise(ValidationError({"uid": [error_msg, ]}))
+
+    def clean(self):
+        self.clean_uid()
         super(Sample, self).clean()
 
     @classmethod
@@ -500,12 +1032,21 @@ class Sample(StorablePhysicalObject, models.Model):
             'notes',
             'container',
             'date',
+            'created_by',
+            'modified_by',
         ]
 
+    def set_user(self, user):
+        """Record user as the last editor and, if the Sample is new, as its
+        creator. Call before saving."""
+        if self.pk is None and self.created_by_id is None:
+            self.created_by = user
+        self.modified_by = user
+
     @property
     def username(self):
-        ct = ContentType.objects.get_for_model(self.__class__)
-        return LogEntry.objects.filter(content_type=ct).first().user.username
+        """Username of the user that created the Sample"""
+        return self.created_by.username if self.created_by_id else None
 
 
 class Protocol(models.Model):
@@ -519,7 +1060,7 @@ class Protocol(models.Model):
         return unicode("%s" % (self.name))
 
 
-class ExtractedCell(StorablePhysicalObject, IndexByGroup):
+class ExtractedCell(Browsable, StorablePhysicalObject, IndexByGroup):
     sample = models.ForeignKey(Sample)
     protocol = models.ForeignKey(Protocol)
     notes = models.TextField(blank=True)
@@ -529,7 +1070,7 @@ class ExtractedCell(StorablePhysicalObject, IndexByGroup):
 
     group_id_keyword = "sample__id"
 
-    objects = UIDManager()
+    objects = IndexByGroupManager()
 
     def natural_key(self):
         return self.uid
@@ -542,12 +1083,7 @@ class ExtractedCell(StorablePhysicalObject, IndexByGroup):
     def barcode(self):
         return "EC:%s" % str(self.uid)
 
-    def save(self):
-        """Stores UID on save"""
-        if self.pk is None:
-            self.index_by_group = self.calc_index_by_group()
-            self.uid = "%s_%s" % (self.group.uid, self.index_by_group + 1)
-        super(ExtractedCell, self).save()
+    uid_format = "{group}_{number}"
 
     def __unicode__(self):
         return unicode(self.uid)
@@ -563,7 +1099,7 @@ class ExtractedCell(StorablePhysicalObject, IndexByGroup):
         ]
 
 
-class ExtractedDNA(StorablePhysicalObject, IndexByGroup):
+class ExtractedDNA(Browsable, StorablePhysicalObject, IndexByGroup):
     sample = models.ForeignKey(Sample, null=True, blank=True)
     protocol = models.ForeignKey(Protocol)
     notes = models.TextField(blank=True)
@@ -576,7 +1112,9 @@ class ExtractedDNA(StorablePhysicalObject, IndexByGroup):
     uid = models.CharField("UID", max_length=30, unique=True, default="Automatically generated",
         help_text="UID consists of the sample UID followed by a count i.e. 10Y31_1")
 
-    objects = UIDManager()
+    objects = IndexByGroupManager()
+
+    detail_select_related = ('extracted_cell__sample',)
 
     def natural_key(self):
         return self.uid
@@ -585,6 +1123,13 @@ class ExtractedDNA(StorablePhysicalObject, IndexByGroup):
     def group_id_keyword(self):
         return "sample__id" if self.sample else "extracted_cell__sample__id"
 
+    def get_group_queryset(self):
+        """Extracted DNA of a Sample can be linked directly or through an
+        ExtractedCell, both share the same index"""
+        return self.__class__.objects.filter(
+            models.Q(sample__id=self.group.id) |
+            models.Q(extracted_cell__sample__id=self.group.id))
+
     @property
     def group(self):
         return self.sample if self.sample else self.extracted_cell.sample
@@ -593,17 +1138,14 @@ class ExtractedDNA(StorablePhysicalObject, IndexByGroup):
     def barcode(self):
         return "ED:" + str(self.uid)
 
-    def save(self):
-        """Saves and checks whether either Sample or ExtractedCell is provided.
-        Not both, because this makes it easier to change the Sample on an
+    uid_format = "{group}_{number}"
+
+    def check_save(self):
+        """Checks whether either Sample or ExtractedCell is provided. Not
+        both, because this makes it easier to change the Sample on an
         ExtractedCell for example. Otherwise you would have to change both this
         object and the Extracted Cell."""
-        if bool(self.sample) != bool(self.extracted_cell):
-            if self.pk is None:
-                self.index_by_group = self.calc_index_by_group()
-                self.uid = "%s_%s" % (self.group.uid, self.index_by_group + 1)
-            super(ExtractedDNA, self).save()
-        else:
+        if bool(self.sample) == bool(self.extracted_cell):
             raise(Exception("You have to specify an Extracted cell or"
                             " a Sample, but not both."))
 
@@ -638,7 +1180,7 @@ class ExtractedDNA(StorablePhysicalObject, IndexByGroup):
         ]
 
 
-class QPCR(models.Model):
+class QPCR(Browsable, models.Model):
     report = models.CharField(max_length=100)
     date = models.DateTimeField(default=timezone.now, blank=True)
 
@@ -655,7 +1197,7 @@ class QPCR(models.Model):
         return [f.attname for f in self._meta.fields]
 
 
-class RTMDA(models.Model):
+class RTMDA(Browsable, models.Model):
     report = models.CharField(max_length=100)
     date = models.DateTimeField(default=timezone.now, blank=True)
 
@@ -672,7 +1214,7 @@ class RTMDA(models.Model):
         return [f.attname for f in self._meta.fields]
 
 
-class SAGPlate(IndexByGroup):
+class SAGPlate(Browsable, IndexByGroup):
     """SAGPlate is not a Container because we want to enforce all the same
     samples on the child wells and in addition store information about the
     Plate itself. The storage location is a key to ApparatusSubDivision,
@@ -691,7 +1233,9 @@ class SAGPlate(IndexByGroup):
     group_id_keyword = "extracted_cell__sample__id"
     character_list = [chr(ord('A') + i) for i in range(26)]  # [A-Z]
 
-    objects = UIDManager()
+    objects = IndexByGroupManager()
+
+    detail_select_related = ('extracted_cell__sample',)
 
     def natural_key(self):
         return self.uid
@@ -708,12 +1252,7 @@ class SAGPlate(IndexByGroup):
     def barcode(self):
         return "SP:" + str(self.uid)
 
-    def save(self):
-        """Stores UID on save"""
-        if self.pk is None:
-            self.index_by_group = self.calc_index_by_group()
-            self.uid = self.group.uid + self.index_to_naming_scheme()
-        super(SAGPlate, self).save()
+    uid_format = "{group}{scheme}"
 
     class Meta:
         verbose_name = "SAG plate"
@@ -736,7 +1275,7 @@ class SAGPlate(IndexByGroup):
                 'notes']
 
 
-class SAGPlateDilution(IndexByGroup):
+class SAGPlateDilution(Browsable, IndexByGroup):
     sag_plate = models.ForeignKey(SAGPlate)
     apparatus_subdivision = models.ForeignKey(ApparatusSubdivision)
     dilution = models.CharField(max_length=100)
@@ -746,10 +1285,12 @@ class SAGPlateDilution(IndexByGroup):
     uid = models.CharField("UID", max_length=30, unique=True, default="Automatically generated",
         help_text="UID consists of the sample UID followed by a character or count [a-z0-9] i.e. 10Y31a")
 
-    group_id_keyword = "extracted_cell__sample__id"
+    group_id_keyword = "sag_plate__extracted_cell__sample__id"
     character_list = [chr(ord('a') + i) for i in range(26)] + range(10)  # [a-z0-9]
 
-    objects = UIDManager()
+    objects = IndexByGroupManager()
+
+    detail_select_related = ('sag_plate__extracted_cell__sample',)
 
     def natural_key(self):
         return self.uid
@@ -766,12 +1307,7 @@ class SAGPlateDilution(IndexByGroup):
     def barcode(self):
         return "SD:" + str(self.uid)
 
-    def save(self):
-        """Stores UID on save"""
-        if self.pk is None:
-            self.index_by_group = self.calc_index_by_group()
-            self.uid = self.group.uid + self.index_to_naming_scheme()
-        super(SAGPlateDilution, self).save()
+    uid_format = "{group}{scheme}"
 
     class Meta:
         verbose_name = "SAG plate dilution"
@@ -791,7 +1327,7 @@ class SAGPlateDilution(IndexByGroup):
                 'notes']
 
 
-class Metagenome(IndexByGroup):
+class Metagenome(Browsable, IndexByGroup):
     extracted_dna = models.ForeignKey(ExtractedDNA)
     diversity_report = models.CharField(max_length=100)
     date = models.DateTimeField(default=timezone.now, blank=True)
@@ -801,7 +1337,9 @@ class Metagenome(IndexByGroup):
     group_id_keyword = "extracted_dna__sample__id"
     character_list = ["%02d" % i for i in range(1, 100)]  # [01-99]
 
-    objects = UIDManager()
+    objects = IndexByGroupManager()
+
+    detail_select_related = ('extracted_dna__sample',)
 
     def natural_key(self):
         return self.uid
@@ -817,12 +1355,7 @@ class Metagenome(IndexByGroup):
     def __unicode__(self):
         return unicode(self.uid)
 
-    def save(self):
-        """Stores UID on save"""
-        if self.pk is None:
-            self.index_by_group = self.calc_index_by_group()
-            self.uid = self.group.uid + "A_X" + self.index_to_naming_scheme()
-        super(Metagenome, self).save()
+    uid_format = "{group}A_X{scheme}"
 
     @property
     def preferred_ordering(self):
@@ -832,7 +1365,7 @@ class Metagenome(IndexByGroup):
                 'date']
 
 
-class Primer(StorablePhysicalObject):
+class Primer(Browsable, StorablePhysicalObject):
     sequence = models.TextField()
     tmelt = models.DecimalField(u"tmelt (\u00B0C)", max_digits=10,
                                 decimal_places=2)
@@ -852,7 +1385,7 @@ class Primer(StorablePhysicalObject):
         return [f.attname for f in self._meta.fields]
 
 
-class Amplicon(StorablePhysicalObject, IndexByGroup):
+class Amplicon(Browsable, StorablePhysicalObject, IndexByGroup):
     extracted_dna = models.ForeignKey(ExtractedDNA)
     diversity_report = models.CharField(max_length=100)
     buffer = models.CharField(max_length=100)
@@ -865,7 +1398,9 @@ class Amplicon(StorablePhysicalObject, IndexByGroup):
     group_id_keyword = "extracted_dna__sample__id"
     character_list = ["%02d" % i for i in range(1, 100)]  # [01-99]
 
-    objects = UIDManager()
+    objects = IndexByGroupManager()
+
+    detail_select_related = ('extracted_dna__sample',)
 
     def natural_key(self):
         return self.uid
@@ -882,12 +1417,7 @@ class Amplicon(StorablePhysicalObject, IndexByGroup):
     def barcode(self):
         return "AM:" + str(self.uid)
 
-    def save(self):
-        """Stores UID on save"""
-        if self.pk is None:
-            self.index_by_group = self.calc_index_by_group()
-            self.uid = self.group.uid + "A_Y" + self.index_to_naming_scheme()
-        super(Amplicon, self).save()
+    uid_format = "{group}A_Y{scheme}"
 
     def __unicode__(self):
         return unicode(self.uid)
@@ -898,7 +1428,7 @@ class Amplicon(StorablePhysicalObject, IndexByGroup):
         return [f.attname for f in self._meta.fields]
 
 
-class SAG(models.Model):
+class SAG(Browsable, models.Model):
     sag_plate = models.ForeignKey(SAGPlate, blank=True, null=True)
     sag_plate_dilution = models.ForeignKey(SAGPlateDilution, blank=True, null=True)
     well = models.CharField(max_length=3)
@@ -911,6 +1441,11 @@ class SAG(models.Model):
 
     objects = UIDManager()
 
+    detail_select_related = (
+        'sag_plate__extracted_cell__sample',
+        'sag_plate_dilution__sag_plate__extracted_cell__sample',
+    )
+
     def natural_key(self):
         return self.uid
 
@@ -918,14 +1453,18 @@ class SAG(models.Model):
         if sum((bool(self.sag_plate_dilution),
                 bool(self.sag_plate))) == 1:
             if self.pk is None:
-                sag_plate_uid = self.sag_plate.uid if self.sag_plate else \
-                    self.sag_plate_dilution.uid
-                self.uid = "%s_%s" % (sag_uid, self.well)
+                self.uid = self.make_uid()
             super(SAG, self).save()
         else:
             raise(Exception("You have to specify either a SAGPlate or a "
                             "SAGPlateDilution and not both"))
 
+    def make_uid(self):
+        """Returns the uid based on the SAGPlate or SAGPlateDilution and the
+        well"""
+        return "%s_%s" % ((self.sag_plate or self.sag_plate_dilution).uid,
+                          self.well)
+
     def clean(self):
         if bool(self.sag_plate_dilution) == bool(self.sag_plate):
             error_msg = """You have to specify either an Extracted cell or a
@@ -964,7 +1503,7 @@ class SAG(models.Model):
         ]
 
 
-class DNAFromPureCulture(IndexByGroup):
+class DNAFromPureCulture(Browsable, IndexByGroup):
     extracted_dna = models.ForeignKey(ExtractedDNA)
     concentration = models.DecimalField(u"Concentration (mol L\u207B\u00B9)",
                                         max_length=100, max_digits=10,
@@ -976,7 +1515,9 @@ class DNAFromPureCulture(IndexByGroup):
     group_id_keyword = "extracted_dna__sample__id"
     character_list = ["%02d" % i for i in range(1, 100)]  # [01-99]
 
-    objects = UIDManager()
+    objects = IndexByGroupManager()
+
+    detail_select_related = ('extracted_dna__sample',)
 
     def natural_key(self):
         return self.uid
@@ -989,12 +1530,7 @@ class DNAFromPureCulture(IndexByGroup):
     def group(self):
         return self.extracted_dna.sample
 
-    def save(self):
-        """Stores UID on save"""
-        if self.pk is None:
-            self.index_by_group = self.calc_index_by_group()
-            self.uid = self.group.uid + "A_Z" + self.index_to_naming_scheme()
-        super(DNAFromPureCulture, self).save()
+    uid_format = "{group}A_Z{scheme}"
 
     def __unicode__(self):
         return unicode(self.uid)
@@ -1013,7 +1549,7 @@ class DNAFromPureCulture(IndexByGroup):
         verbose_name = "DNA from pure culture"
 
 
-class DNALibrary(StorablePhysicalObject, IndexByGroup):
+class DNALibrary(Browsable, StorablePhysicalObject, IndexByGroup):
     amplicon = models.ForeignKey(Amplicon, blank=True, null=True)
     metagenome = models.ForeignKey(Metagenome, blank=True, null=True)
     sag = models.ForeignKey(SAG, null=True, blank=True, verbose_name="SAG")
@@ -1034,7 +1570,15 @@ class DNALibrary(StorablePhysicalObject, IndexByGroup):
 
     character_list = [chr(ord('A') + i) for i in range(26)]  # [A-Z]
 
-    objects = UIDManager()
+    objects = IndexByGroupManager()
+
+    detail_select_related = (
+        'amplicon__extracted_dna__sample',
+        'metagenome__extracted_dna__sample',
+        'sag__sag_plate__extracted_cell__sample',
+        'sag__sag_plate_dilution__sag_plate__extracted_cell__sample',
+        'pure_culture__extracted_dna__sample',
+    )
 
     def natural_key(self):
         return self.uid
@@ -1071,16 +1615,13 @@ class DNALibrary(StorablePhysicalObject, IndexByGroup):
     def barcode(self):
         return "DL:" + str(self.uid)
 
-    def save(self):
+    uid_format = "{group}{scheme}"
+
+    def check_save(self):
         if sum((bool(self.amplicon),
                 bool(self.metagenome),
                 bool(self.sag),
-                bool(self.pure_culture))) == 1:
-            if self.pk is None:
-                self.index_by_group = self.calc_index_by_group()
-                self.uid = self.group.uid + self.index_to_naming_scheme()
-            super(DNALibrary, self).save()
-        else:
+                bool(self.pure_culture))) != 1:
             raise(Exception("You have to specify a DNA source from either "
                             "Amplicon, Metagenome, SAG or Pure culture and not "
                             "more than one"))
@@ -1123,7 +1664,7 @@ class DNALibrary(StorablePhysicalObject, IndexByGroup):
         ]
 
 
-class SequencingRun(models.Model):
+class SequencingRun(Browsable, models.Model):
     uid = models.CharField("UID", max_length=100, unique=True)
     sequencing_center = models.CharField(max_length=100)
     machine = models.CharField(max_length=100)
@@ -1148,7 +1689,7 @@ class SequencingRun(models.Model):
         return [f.attname for f in self._meta.fields]
 
 
-class ReadFile(models.Model):
+class ReadFile(Browsable, models.Model):
     folder = models.CharField(max_length=100)
     filename = models.CharField(max_length=100)
     pair = models.PositiveIntegerField(choices=((1, 1), (2, 2)))
@@ -1170,3 +1711,102 @@ class UserProfile(AbstractUser):
 
     #USERNAME_FIELD = 'username'
     #REQUIRED_FIELDS = ['']
+
+
+class Job(models.Model):
+    """Work that runs in the background instead of in the web request, e.g.
+    large imports, exports and print runs. Jobs are queued in the database
+    and run by the run_jobs management command. name refers to a function
+    registered in lims.jobs, which is called with the decoded arguments. data
+    holds the file to import, data_name is the name of the exported file in
+    settings.LIMS_EXPORT_DIR. heartbeat is updated while the Job makes
+    progress, see lims.jobs.fail_stale_jobs."""
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    name = models.CharField(max_length=100)
+    arguments = models.TextField(blank=True)
+    status = models.CharField(max_length=8, default=QUEUED, db_index=True,
+                              choices=((QUEUED, QUEUED), (RUNNING, RUNNING),
+                                       (DONE, DONE), (FAILED, FAILED)))
+    user = models.ForeignKey(UserProfile, blank=True, null=True)
+    progress = models.PositiveIntegerField(default=0)
+    total = models.PositiveIntegerField(blank=True, null=True)
+    message = models.TextField(blank=True)
+    data = models.BinaryField(blank=True, null=True)
+    data_name = models.CharField(max_length=255, blank=True)
+    date = models.DateTimeField(default=timezone.now, blank=True)
+    started = models.DateTimeField(blank=True, null=True)
+    heartbeat = models.DateTimeField(blank=True, null=True)
+    finished = models.DateTimeField(blank=True, null=True)
+
+    def __unicode__(self):
+        return unicode("%s #%d" % (self.name, self.pk))
+
+    def get_export_path(self):
+        return os.path.join(settings.LIMS_EXPORT_DIR, self.data_name)
+
+    def get_arguments(self):
+        return json.loads(self.arguments or "{}")
+
+    def set_progress(self, progress, total=None):
+        """Store the progress without saving the other fields"""
+        self.progress = progress
+        if total is not None:
+            self.total = total
+        self.heartbeat = timezone.now()
+        Job.objects.filter(pk=self.pk).update(progress=self.progress,
+                                              total=self.total,
+                                              heartbeat=self.heartbeat)
+
+    @property
+    def is_finished(self):
+        return self.status in (self.DONE, self.FAILED)
+
+    @property
+    def percentage(self):
+        if self.status == self.DONE:
+            return 100
+        if not self.total:
+            return 0
+        return min(100, 100 * self.progress // self.total)
+
+
+# Models with a barcode, see RegisteredBarcode
+barcode_models = [Sample, ExtractedCell, ExtractedDNA, SAGPlate,
+                  SAGPlateDilution, Amplicon, DNALibrary, Container]
+
+
+def register_barcode(sender, instance, **kwargs):
+    RegisteredBarcode.register(instance)
+
+
+def unregister_barcode(sender, instance, **kwargs):
+    RegisteredBarcode.unregister(instance)
+
+
+for model in barcode_models:
+    post_save.connect(register_barcode, sender=model)
+    post_delete.connect(unregister_barcode, sender=model)
+
+
+def delete_export_file(sender, instance, **kwargs):
+    if instance.data_name:
+        try:
+            os.unlink(instance.get_export_path())
+        except OSError:
+            pass
+
+
+post_delete.connect(delete_export_file, sender=Job)
+
+
+# Connect the signals that invalidate cached sample trees and labels
+import lims.tree_cache
+import lims.printing
+
+# Time templates and queries for lims.metrics.MetricsMiddleware
+from lims.metrics import install_instrumentation
+install_instrumentation()
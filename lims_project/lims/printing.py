@@ -0,0 +1,208 @@
+"""
+Printing of barcode labels. Labels are rendered with the template of a
+BarcodePrinter and the fields given in BarcodeToModel. All labels for one
+printer are sent as a single job to the printer backend configured in
+settings.LIMS_PRINTER_BACKEND.
+
+Templates are checked and compiled once per BarcodePrinter and template
+version. Rendered labels are cached, so reprinting unchanged objects only
+needs their primary keys. Every object has its own label version, which is
+replaced when the object is saved or deleted. Labels can show related objects,
+so saving or deleting an object of a model that a barcode model refers to,
+directly or through other foreign keys, invalidates all labels of that barcode
+model.
+"""
+import hashlib
+import os
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.contrib.contenttypes.models import ContentType
+from django.db.models.signals import post_save, post_delete
+from django.utils.module_loading import import_by_path
+
+from lims.models import BarcodeToModel, barcode_models, check_label_template
+
+LABEL_VERSION_KEY = "lims.labels.version.%s"
+OBJECT_VERSION_KEY = "lims.labels.version.%s.%s"
+LABEL_KEY = "lims.labels.%s.%s.%r.%s.%s"
+
+
+class LprBackend(object):
+    """Sends jobs to the printer with the same name as the BarcodePrinter
+    using lpr"""
+    def print_job(self, printer, data):
+        from sh import lpr
+        lpr("-P", printer.name, _in=data)
+
+
+class FileBackend(object):
+    """Writes every job to a file in settings.LIMS_PRINTER_SPOOL_DIR instead
+    of printing it, e.g. for testing"""
+    def print_job(self, printer, data):
+        filename = "%s-%f.txt" % (printer.name, time.time())
+        with open(os.path.join(settings.LIMS_PRINTER_SPOOL_DIR, filename),
+                  "w") as f:
+            f.write(data.encode("utf-8"))
+
+
+def get_printer_backend():
+    return import_by_path(settings.LIMS_PRINTER_BACKEND)()
+
+
+class LabelTemplate(object):
+    """Compiled template of a BarcodeToModel. The template is checked once,
+    render only has to look up the fields of an object."""
+    def __init__(self, btm):
+        self.printer = btm.barcode
+        self.fields = btm.barcode_fields.split()
+        # add extra fields if not enough fields are given
+        self.padding = max(0, 4 - len(self.fields)) * [""]
+        check_label_template(self.printer.template,
+                             len(self.fields) + len(self.padding))
+        self.format = self.printer.template.format
+        self.version = get_template_version(btm)
+
+    def render(self, obj):
+        return self.format(*([getattr(obj, f) for f in self.fields] +
+                             self.padding))
+
+
+def get_template_version(btm):
+    return hashlib.md5(repr((btm.barcode.template, btm.barcode_fields))
+                       .encode("utf-8")).hexdigest()
+
+
+compiled_templates = {}
+
+
+def get_label_template(btm):
+    """Returns the compiled LabelTemplate of the BarcodeToModel, compiling it
+    the first time a printer and template version is used"""
+    key = (btm.barcode_id, get_template_version(btm))
+    if key not in compiled_templates:
+        compiled_templates[key] = LabelTemplate(btm)
+    return compiled_templates[key]
+
+
+def get_label_version(ct):
+    """Returns the version of the cached labels of a model, starting a new one
+    if it is not in the cache"""
+    key = LABEL_VERSION_KEY % ct.pk
+    version = cache.get(key)
+    if version is None:
+        version = time.time()
+        cache.add(key, version, settings.LIMS_LABEL_CACHE_TIMEOUT)
+        version = cache.get(key, version)
+    return version
+
+
+def get_object_versions(ct, pks):
+    """Returns a dict with the label version of every object, starting new
+    versions for objects that are not in the cache"""
+    keys = dict((pk, OBJECT_VERSION_KEY % (ct.pk, pk)) for pk in pks)
+    versions = cache.get_many(keys.values())
+    new = dict((key, uuid.uuid4().hex) for key in keys.values()
+               if key not in versions)
+    if new:
+        cache.set_many(new, settings.LIMS_LABEL_CACHE_TIMEOUT)
+        versions.update(new)
+    return dict((pk, versions[key]) for pk, key in keys.items())
+
+
+def invalidate_labels(sender, **kwargs):
+    """Invalidates the cached labels of all objects of a model"""
+    cache.set(LABEL_VERSION_KEY % ContentType.objects.get_for_model(sender).pk,
+              time.time(), settings.LIMS_LABEL_CACHE_TIMEOUT)
+
+
+def invalidate_object_labels(model, pks):
+    """Invalidates the cached labels of the objects with the given primary
+    keys"""
+    ct = ContentType.objects.get_for_model(model)
+    cache.delete_many([OBJECT_VERSION_KEY % (ct.pk, pk) for pk in pks])
+
+
+def invalidate_instance_labels(sender, instance, **kwargs):
+    invalidate_object_labels(sender, [instance.pk])
+
+
+def get_related_models(model, related=None):
+    """Returns the models a model refers to through foreign keys, directly or
+    through other related models"""
+    if related is None:
+        related = set()
+    for field in model._meta.fields:
+        if field.rel and field.rel.to not in related:
+            related.add(field.rel.to)
+            get_related_models(field.rel.to, related)
+    return related
+
+
+# related model -> barcode models whose labels can show its objects
+label_dependents = {}
+
+
+def invalidate_dependent_labels(sender, **kwargs):
+    for model in label_dependents.get(sender, ()):
+        invalidate_labels(model)
+
+
+def render_jobs(model, pks):
+    """Returns a list of (BarcodePrinter, data) tuples with the labels of the
+    objects with the given primary keys for every printer that is linked to
+    the model. Only objects without a cached label are loaded."""
+    ct = ContentType.objects.get_for_model(model)
+    templates = [get_label_template(btm) for btm in
+                 BarcodeToModel.objects.filter(content_type=ct)
+                 .select_related('barcode')]
+    if not templates or not pks:
+        return [(t.printer, "") for t in templates]
+    version = get_label_version(ct)
+    object_versions = get_object_versions(ct, pks)
+    keys = dict(((t, pk), LABEL_KEY % (t.printer.pk, t.version, version, pk,
+                                       object_versions[pk]))
+                for t in templates for pk in pks)
+    labels = cache.get_many(keys.values())
+
+    missing = set(pk for (t, pk), key in keys.items() if key not in labels)
+    if missing:
+        objects = model.objects.in_bulk(list(missing))
+        rendered = dict((keys[t, pk], t.render(objects[pk]))
+                        for t in templates for pk in missing
+                        if pk in objects)
+        cache.set_many(rendered, settings.LIMS_LABEL_CACHE_TIMEOUT)
+        labels.update(rendered)
+    return [(t.printer, "\n".join(labels[keys[t, pk]] for pk in pks
+                                  if keys[t, pk] in labels))
+            for t in templates]
+
+
+def send_jobs(jobs):
+    backend = get_printer_backend()
+    for printer, data in jobs:
+        backend.print_job(printer, data)
+
+
+def print_labels(queryset):
+    """Print labels for all objects in the queryset, one job per printer.
+    Large print runs are queued as a background Job by the admin action, see
+    lims.jobs. Returns the printers and the number of labels per printer."""
+    pks = list(queryset.values_list('pk', flat=True))
+    jobs = render_jobs(queryset.model, pks)
+    send_jobs(jobs)
+    return [printer for printer, data in jobs], len(pks)
+
+
+for model in barcode_models:
+    post_save.connect(invalidate_instance_labels, sender=model)
+    post_delete.connect(invalidate_instance_labels, sender=model)
+    for related_model in get_related_models(model):
+        if related_model is not model:
+            label_dependents.setdefault(related_model, []).append(model)
+
+for related_model in label_dependents:
+    post_save.connect(invalidate_dependent_labels, sender=related_model)
+    post_delete.connect(invalidate_dependent_labels, sender=related_model)
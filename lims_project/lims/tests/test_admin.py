@@ -0,0 +1,332 @@
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from django.contrib import admin
+from django.contrib.admin.models import LogEntry, ADDITION, CHANGE
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from lims.admin import ContainerApparatusFilter, ContainerIsEmptyFilter
+from lims.printing import print_labels
+from lims.models import Apparatus, ApparatusSubdivision, BarcodePrinter, \
+    BarcodeToModel, Container, ContainerType, Job, Sample, UserProfile
+from lims.tests.test_models import create_sample
+
+
+def create_plates(subdivision, container_type, nr_plates, nr_wells):
+    """Create nr_plates root Containers with nr_wells child Containers each"""
+    for i in range(nr_plates):
+        plate = Container.objects.create(type=container_type,
+                                         apparatus_subdivision=subdivision)
+        for j in range(nr_wells):
+            Container.objects.create(type=container_type, parent=plate,
+                                     row=j, column=0)
+
+
+class ContainerApparatusFilterTests(TestCase):
+    def setUp(self):
+        self.container_type = ContainerType.objects.create(name="plate")
+        self.freezer = Apparatus.objects.create(name="freezer", location="lab")
+        self.closet = Apparatus.objects.create(name="closet", location="lab")
+        self.freezer_shelf = ApparatusSubdivision.objects.create(
+            name="shelf", apparatus=self.freezer)
+        self.closet_shelf = ApparatusSubdivision.objects.create(
+            name="shelf", apparatus=self.closet)
+        self.model_admin = admin.site._registry[Container]
+
+    def filter_containers(self, apparatus):
+        request = RequestFactory().get("/", {"apparatus": apparatus.id})
+        list_filter = ContainerApparatusFilter(
+            request, dict(request.GET.items()), Container, self.model_admin)
+        return list_filter.queryset(request, Container.objects.all())
+
+    def test_filter(self):
+        create_plates(self.freezer_shelf, self.container_type, 2, 3)
+        create_plates(self.closet_shelf, self.container_type, 1, 3)
+
+        self.assertEqual(self.filter_containers(self.freezer).count(), 8)
+        self.assertEqual(self.filter_containers(self.closet).count(), 4)
+
+    def test_filter_flat_nr_queries(self):
+        """Filtering takes a single query besides the Apparatus lookups
+        independent of the number of Containers"""
+        for nr_wells in (4, 96):
+            create_plates(self.freezer_shelf, self.container_type, 2, nr_wells)
+            with self.assertNumQueries(2):
+                list(self.filter_containers(self.freezer))
+
+
+class ContainerIsEmptyFilterTests(TestCase):
+    def setUp(self):
+        container_type = ContainerType.objects.create(name="plate")
+        apparatus = Apparatus.objects.create(name="freezer", location="lab")
+        subdivision = ApparatusSubdivision.objects.create(name="shelf",
+                                                          apparatus=apparatus)
+        create_plates(subdivision, container_type, 3, 4)
+
+        # Store something in a single well of the first plate
+        self.plate = Container.objects.filter(parent__isnull=True)[0]
+        well = self.plate.child.all()[0]
+        well.content_type = ContentType.objects.get_for_model(Apparatus)
+        well.object_id = apparatus.id
+        well.save()
+
+        self.model_admin = admin.site._registry[Container]
+
+    def filter_containers(self, is_empty):
+        request = RequestFactory().get("/", {"is_empty": is_empty})
+        list_filter = ContainerIsEmptyFilter(
+            request, dict(request.GET.items()), Container, self.model_admin)
+        return list_filter.queryset(request, Container.objects.all())
+
+    def test_filter(self):
+        self.assertEqual(self.filter_containers("True").count(), 13)
+        not_empty = self.filter_containers("False")
+        self.assertEqual(not_empty.count(), 2)
+        self.assertTrue(self.plate in not_empty)
+
+    def test_annotated_is_empty(self):
+        containers = Container.objects.with_is_empty()
+        with self.assertNumQueries(1):
+            self.assertEqual(sum(c.is_empty for c in containers), 13)
+
+    def test_counts(self):
+        self.assertEqual(self.plate.nr_children, 4)
+        self.assertEqual(self.plate.nr_objects_in_container, 1)
+
+        with self.assertNumQueries(1):
+            plate = Container.objects.with_counts().get(pk=self.plate.pk)
+            self.assertEqual(plate.nr_children, 4)
+            self.assertEqual(plate.nr_objects_in_container, 1)
+            self.assertFalse(plate.is_empty)
+            self.assertFalse(plate.is_leaf)
+
+
+class ContainerAdminTests(TestCase):
+    def setUp(self):
+        UserProfile.objects.create_superuser("admin", "admin@lims.org", "admin")
+        self.client.login(username="admin", password="admin")
+
+        self.container_type = ContainerType.objects.create(name="plate")
+        apparatus = Apparatus.objects.create(name="freezer", location="lab")
+        self.subdivision = ApparatusSubdivision.objects.create(
+            name="shelf", apparatus=apparatus)
+
+    def get_nr_queries(self, url):
+        """Returns the number of queries used to render the given url"""
+        with self.settings(DEBUG=True):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            return len(connection.queries)
+
+    def test_changelist_nr_queries(self):
+        """The changelist takes the same number of queries regardless of the
+        plate size"""
+        url = reverse("admin:lims_container_changelist")
+        create_plates(self.subdivision, self.container_type, 10, 4)
+        nr_queries = self.get_nr_queries(url)
+        Container.objects.all().delete()
+        create_plates(self.subdivision, self.container_type, 10, 96)
+        self.assertEqual(self.get_nr_queries(url), nr_queries)
+
+
+class SampleUserTests(TestCase):
+    def setUp(self):
+        self.admin = UserProfile.objects.create_superuser(
+            "admin", "admin@lims.org", "admin")
+        self.editor = UserProfile.objects.create_superuser(
+            "editor", "editor@lims.org", "editor")
+        self.sample = create_sample("10Y30")
+
+    def post_sample(self, url, username, uid):
+        self.client.login(username=username, password=username)
+        prefix = "lims-container-content_type-object_id"
+        response = self.client.post(url, {
+            'uid': uid,
+            'collaborator': self.sample.collaborator_id,
+            'sample_type': self.sample.sample_type_id,
+            'sample_location': self.sample.sample_location_id,
+            'date_received_0': "2014-01-01",
+            'date_received_1': "12:00:00",
+            'date_0': "2014-01-01",
+            'date_1': "12:00:00",
+            prefix + '-TOTAL_FORMS': 0,
+            prefix + '-INITIAL_FORMS': 0,
+            prefix + '-MAX_NUM_FORMS': 1000,
+        })
+        self.assertEqual(response.status_code, 302)
+        return Sample.objects.get(uid=uid)
+
+    def test_admin_sets_users(self):
+        sample = self.post_sample(reverse("admin:lims_sample_add"), "admin",
+                                  "10Y31")
+        self.assertEqual(sample.created_by, self.admin)
+        self.assertEqual(sample.modified_by, self.admin)
+        self.assertEqual(sample.username, "admin")
+
+        sample = self.post_sample(
+            reverse("admin:lims_sample_change", args=[sample.pk]), "editor",
+            "10Y32")
+        self.assertEqual(sample.created_by, self.admin)
+        self.assertEqual(sample.modified_by, self.editor)
+
+    def get_nr_queries(self):
+        with self.settings(DEBUG=True):
+            response = self.client.get(reverse("admin:lims_sample_changelist"))
+            self.assertContains(response, "editor")
+            return len(connection.queries)
+
+    def test_changelist_nr_queries(self):
+        """Showing the users doesn't take a query per Sample"""
+        self.client.login(username="admin", password="admin")
+        Sample.objects.update(created_by=self.admin, modified_by=self.editor)
+        nr_queries = self.get_nr_queries()
+        for i in range(20):
+            sample = create_sample("10Y4%02d" % i)
+            sample.set_user([self.admin, self.editor][i % 2])
+            sample.save()
+        self.assertEqual(self.get_nr_queries(), nr_queries)
+
+    def test_backfill(self):
+        other = create_sample("10Y31")
+        ct = ContentType.objects.get_for_model(Sample)
+        LogEntry.objects.log_action(self.admin.pk, ct.pk, self.sample.pk,
+                                    unicode(self.sample), ADDITION)
+        LogEntry.objects.log_action(self.editor.pk, ct.pk, self.sample.pk,
+                                    unicode(self.sample), CHANGE)
+        LogEntry.objects.log_action(self.editor.pk, ct.pk, other.pk,
+                                    unicode(other), CHANGE)
+        # users that are already set are kept
+        Sample.objects.filter(pk=other.pk).update(modified_by=self.admin)
+
+        call_command("backfill_sample_users", stdout=StringIO())
+        sample = Sample.objects.get(pk=self.sample.pk)
+        self.assertEqual((sample.created_by, sample.modified_by),
+                         (self.admin, self.editor))
+        other = Sample.objects.get(pk=other.pk)
+        self.assertEqual((other.created_by, other.modified_by),
+                         (None, self.admin))
+
+
+class PrintBarcodeTests(TestCase):
+    def setUp(self):
+        UserProfile.objects.create_superuser("admin", "admin@lims.org", "admin")
+        self.client.login(username="admin", password="admin")
+        self.spool_dir = tempfile.mkdtemp()
+        cache.clear()
+
+        self.printer = printer = BarcodePrinter.objects.create(name="labels",
+                                                template="{0} {1}|{2}{3}")
+        BarcodeToModel.objects.create(
+            content_type=ContentType.objects.get_for_model(Sample),
+            barcode=printer, barcode_fields="barcode uid")
+        self.samples = [create_sample("10Y3%d" % i) for i in range(5)]
+
+    def tearDown(self):
+        shutil.rmtree(self.spool_dir)
+
+    def test_print_barcode(self):
+        with self.settings(LIMS_PRINTER_BACKEND="lims.printing.FileBackend",
+                           LIMS_PRINTER_SPOOL_DIR=self.spool_dir):
+            response = self.client.post(
+                reverse("admin:lims_sample_changelist"),
+                {'action': 'print_barcode',
+                 '_selected_action': [s.pk for s in self.samples]},
+                follow=True)
+        self.assertContains(response, "Sent 5 labels to labels")
+
+        jobs = os.listdir(self.spool_dir)
+        self.assertEqual(len(jobs), 1)
+        with open(os.path.join(self.spool_dir, jobs[0])) as f:
+            labels = f.read().splitlines()
+        self.assertEqual(sorted(labels),
+                         ["SA:10Y3%d 10Y3%d|" % (i, i) for i in range(5)])
+
+    def test_print_barcode_queues_large_runs(self):
+        with self.settings(LIMS_PRINTER_BACKEND="lims.printing.FileBackend",
+                           LIMS_PRINTER_SPOOL_DIR=self.spool_dir,
+                           LIMS_PRINT_BACKGROUND_MIN_LABELS=5):
+            response = self.client.post(
+                reverse("admin:lims_sample_changelist"),
+                {'action': 'print_barcode',
+                 '_selected_action': [s.pk for s in self.samples]},
+                follow=True)
+            self.assertContains(response, "Queued printing of 5 labels")
+            self.assertEqual(os.listdir(self.spool_dir), [])
+
+            call_command("run_jobs", once=True, stdout=StringIO())
+        job = Job.objects.get()
+        self.assertEqual(job.status, Job.DONE)
+        self.assertEqual(job.message, "Sent 5 labels to labels")
+        self.assertEqual(len(os.listdir(self.spool_dir)), 1)
+
+    def print_samples(self):
+        with self.settings(LIMS_PRINTER_BACKEND="lims.printing.FileBackend",
+                           LIMS_PRINTER_SPOOL_DIR=self.spool_dir):
+            print_labels(Sample.objects.order_by('uid'))
+        jobs = sorted(os.listdir(self.spool_dir))
+        with open(os.path.join(self.spool_dir, jobs[-1])) as f:
+            return f.read().splitlines()
+
+    def test_reprint_uses_cached_labels(self):
+        self.print_samples()
+        # primary keys and BarcodeToModels, no objects are loaded
+        with self.assertNumQueries(2):
+            labels = self.print_samples()
+        self.assertEqual(labels,
+                         ["SA:10Y3%d 10Y3%d|" % (i, i) for i in range(5)])
+
+    def test_changes_invalidate_labels(self):
+        self.print_samples()
+        self.samples[4].uid = "10Y39"
+        self.samples[4].save()
+        self.assertEqual(self.print_samples()[-1], "SA:10Y39 10Y39|")
+
+        self.printer.template = "{1}"
+        self.printer.save()
+        self.assertEqual(self.print_samples()[0], "10Y30")
+
+    def test_changes_keep_other_labels(self):
+        self.print_samples()
+        # an update without signals shows which labels are rendered again
+        Sample.objects.filter(pk=self.samples[0].pk).update(uid="10Y30A")
+        self.samples[4].uid = "10Y39"
+        self.samples[4].save()
+        labels = self.print_samples()
+        self.assertEqual(labels[0], "SA:10Y30 10Y30|")
+        self.assertEqual(labels[-1], "SA:10Y39 10Y39|")
+
+    def test_related_changes_invalidate_labels(self):
+        btm = BarcodeToModel.objects.get()
+        btm.barcode_fields = "uid sample_type"
+        btm.save()
+        self.assertEqual(self.print_samples()[0], "10Y30 soil|")
+
+        sample_type = self.samples[0].sample_type
+        sample_type.name = "water"
+        sample_type.save()
+        self.assertEqual(self.print_samples()[0], "10Y30 water|")
+
+    def test_check_template(self):
+        self.printer.template = "{0} {4}"
+        self.assertRaises(ValidationError, self.printer.clean)
+        self.printer.template = "{uid}"
+        self.assertRaises(ValidationError, self.printer.clean)
+        self.printer.template = "{0} {3:>5}"
+        self.printer.clean()
+
+        btm = BarcodeToModel(barcode=self.printer,
+                             barcode_fields="a b c d e")
+        self.printer.template = "{4}"
+        self.printer.save()
+        btm.clean()
+        btm.barcode_fields = "a"
+        self.assertRaises(ValidationError, btm.clean)
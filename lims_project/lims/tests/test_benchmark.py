@@ -0,0 +1,90 @@
+import json
+import os
+import tempfile
+from StringIO import StringIO
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase
+
+from lims.dataset import DatasetError, generate_dataset, make_sample_uid
+from lims.models import Container, DNALibrary, ExtractedCell, \
+    IndexByGroupCounter, RegisteredBarcode, SAG, Sample, UserProfile
+
+
+class GenerateDatasetTests(TestCase):
+    def test_make_sample_uid(self):
+        self.assertEqual(make_sample_uid("Z", 0), "Z0000")
+        self.assertEqual(make_sample_uid("Z", 37), "Z0011")
+
+    def test_generate_dataset(self):
+        counts = generate_dataset(2, sags_per_plate=1)
+        self.assertEqual(Sample.objects.count(), 2)
+        # an amplicon, metagenome and pure culture library per Sample and
+        # one for the SAG in the plate and in the dilution
+        self.assertEqual(DNALibrary.objects.count(), 10)
+        self.assertEqual(counts['DNALibrary'], 10)
+        self.assertEqual(counts['ReadFile'], 20)
+        self.assertEqual(sorted(SAG.objects.filter(sag_plate__isnull=False)
+                                .values_list('uid', flat=True)),
+                         ["Z0000A_A1", "Z0001A_A1"])
+
+        # one plate holds the Samples, ExtractedDNAs and DNALibraries
+        self.assertEqual(Container.objects.count(), 385)
+        self.assertEqual(Container.objects.filter(path="").count(), 0)
+        self.assertEqual(Container.objects.filter(
+            object_id__isnull=False).count(), 16)
+        self.assertEqual(RegisteredBarcode.objects.filter(
+            barcode__startswith="CO:").count(), 385)
+        self.assertTrue(RegisteredBarcode.objects.filter(
+            barcode="DL:Z0000A_Y01A").exists())
+
+    def test_new_objects_continue_index(self):
+        generate_dataset(1, sags_per_plate=0)
+        sample = Sample.objects.get()
+        # the counters are stored, no group is counted when an object is added
+        self.assertEqual(IndexByGroupCounter.objects.get(
+            content_type=ContentType.objects.get_for_model(ExtractedCell),
+            group_id=sample.pk).next_index, 1)
+        cell = ExtractedCell.objects.create(
+            sample=sample, protocol=ExtractedCell.objects.get().protocol)
+        self.assertEqual(cell.uid, "Z0000_2")
+
+    def test_prefix_in_use(self):
+        generate_dataset(1, sags_per_plate=0)
+        self.assertRaises(DatasetError, generate_dataset, 1)
+        generate_dataset(1, prefix="Y", sags_per_plate=0)
+        self.assertEqual(Sample.objects.count(), 2)
+
+
+class BenchmarkTests(TestCase):
+    def setUp(self):
+        generate_dataset(2, sags_per_plate=1)
+        self.output = tempfile.mktemp(suffix=".json")
+
+    def tearDown(self):
+        if os.path.exists(self.output):
+            os.unlink(self.output)
+
+    def test_benchmark(self):
+        call_command("benchmark", repeat=1, output=self.output,
+                     stdout=StringIO())
+        with open(self.output) as f:
+            results = json.load(f)
+        self.assertEqual(results['dataset']['Sample'], 2)
+        self.assertIn("admin dnalibrary changelist", results['cases'])
+        for name, case in results['cases'].items():
+            self.assertEqual(case['status'], 200, name)
+        self.assertEqual(results['cases']['sample tree cached']['queries'], 0)
+        self.assertTrue(results['cases']['sample tree']['queries'] > 0)
+        # the temporary superuser is removed
+        self.assertEqual(UserProfile.objects.count(), 0)
+
+        stdout = StringIO()
+        cache.set("other", 1)
+        call_command("benchmark", repeat=1, output=self.output,
+                     compare=self.output, stdout=stdout)
+        self.assertIn("detail sample", stdout.getvalue())
+        # only the tree of the Sample under test is invalidated
+        self.assertEqual(cache.get("other"), 1)
@@ -0,0 +1,375 @@
+import json
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from import_export.formats import base_formats
+
+from lims import tree_cache
+from lims.import_export_resources import ContainerResource, \
+    LIMSForeignKeyWidget, SampleResource, import_rows, read_rows, \
+    stream_export
+from lims.models import Apparatus, ApparatusSubdivision, Container, \
+    ContainerType, RegisteredBarcode, Sample, SampleLocation, SampleType, \
+    UserProfile, Job
+from lims.tests.test_admin import create_plates
+from lims.tests.test_models import create_sample
+
+
+def sample_csv(uids, collaborator_id):
+    lines = ["id,uid,collaborator,sample_type,sample_location,"
+             "extra_columns_json,color,size"]
+    for uid in uids:
+        lines.append(",%s,%d,1,1,,red,%s" % (uid, collaborator_id, uid[-1]))
+    return "\n".join(lines) + "\n"
+
+
+class ImportRowsTests(TestCase):
+    def setUp(self):
+        self.collaborator_id = create_sample("10Y30").collaborator_id
+
+    def import_csv(self, data, **kwargs):
+        headers, rows = read_rows(StringIO(data), base_formats.CSV())
+        return import_rows(SampleResource(), headers, rows, **kwargs)
+
+    def test_import_in_chunks(self):
+        progress = []
+        uids = ["10Y3%d" % i for i in range(1, 6)]
+        result = self.import_csv(sample_csv(uids, self.collaborator_id),
+                                 chunk_size=2, progress=progress.append)
+        self.assertFalse(result.has_errors())
+        self.assertEqual(progress, [2, 4, 5])
+        self.assertEqual((result.nr_chunks, result.nr_imported), (3, 5))
+        self.assertEqual(json.loads(Sample.objects.get(uid="10Y35")
+                                    .extra_columns_json),
+                         {"color": "red", "size": "5"})
+
+    def test_merge_extra_columns(self):
+        self.import_csv(sample_csv(["10Y31"], self.collaborator_id))
+        sample = Sample.objects.get(uid="10Y31")
+        data = "".join(stream_export(SampleResource(),
+                                     Sample.objects.filter(pk=sample.pk)))
+        headers, rows = read_rows(StringIO(data), base_formats.CSV())
+        # the exported barcode column is no extra column
+        self.assertIn("barcode", headers[headers.index("extra_columns_json"):])
+        headers.append("weight")
+        rows = [row + ["12"] for row in rows]
+        result = import_rows(SampleResource(), headers, rows)
+        self.assertFalse(result.has_errors())
+        self.assertEqual(json.loads(Sample.objects.get(pk=sample.pk)
+                                    .extra_columns_json),
+                         {"color": "red", "size": "1", "weight": "12"})
+
+        data = ("id,uid,collaborator,sample_type,sample_location,"
+                "extra_columns_json,shape\n%d,10Y31,%d,1,1,,round\n" %
+                (sample.pk, self.collaborator_id))
+        self.assertFalse(self.import_csv(data).has_errors())
+        self.assertEqual(json.loads(Sample.objects.get(pk=sample.pk)
+                                    .extra_columns_json),
+                         {"color": "red", "size": "1", "weight": "12",
+                          "shape": "round"})
+
+    def test_users_are_not_imported(self):
+        admin = UserProfile.objects.create_superuser("admin", "", "admin")
+        other = UserProfile.objects.create_user("other", "", "other")
+        data = ("id,uid,collaborator,sample_type,sample_location,created_by,"
+                "modified_by\n,10Y31,%d,1,1,%d,%d\n" %
+                (self.collaborator_id, other.pk, other.pk))
+        headers, rows = read_rows(StringIO(data), base_formats.CSV())
+        result = import_rows(SampleResource(user=admin), headers, rows)
+        self.assertFalse(result.has_errors())
+        sample = Sample.objects.get(uid="10Y31")
+        self.assertEqual((sample.created_by, sample.modified_by),
+                         (admin, admin))
+
+    def test_dry_run(self):
+        uids = ["10Y3%d" % i for i in range(1, 6)]
+        with self.settings(LIMS_IMPORT_PREVIEW_SIZE=3):
+            result = self.import_csv(sample_csv(uids, self.collaborator_id),
+                                     chunk_size=2, dry_run=True)
+        self.assertEqual((result.nr_rows, result.nr_imported), (5, 0))
+        self.assertEqual(len(result.rows), 3)
+        self.assertEqual(Sample.objects.count(), 1)
+
+    def test_stop_at_chunk_with_errors(self):
+        data = sample_csv(["10Y31", "10Y32", "10Y33"], self.collaborator_id)
+        data += sample_csv(["10Y34"], 0).split("\n", 1)[1]
+        result = self.import_csv(data, chunk_size=2, bulk=False)
+        self.assertEqual([line for line, errors in result.row_errors()], [4])
+        self.assertEqual(result.nr_imported, 2)
+        self.assertEqual(sorted(Sample.objects.values_list('uid', flat=True)),
+                         ["10Y30", "10Y31", "10Y32"])
+
+    def test_bulk_import_is_all_or_nothing(self):
+        data = sample_csv(["10Y31", "10Y32", "10Y33"], self.collaborator_id)
+        data += sample_csv(["10Y34"], 0).split("\n", 1)[1]
+        result = self.import_csv(data, chunk_size=2, bulk=True)
+        self.assertEqual([line for line, errors in result.row_errors()], [4])
+        self.assertEqual(result.nr_imported, 0)
+        self.assertEqual(Sample.objects.count(), 1)
+
+    def test_bulk_import_validates_in_memory(self):
+        data = sample_csv(["10Y31", "10Y31", "10Y30", "bad"],
+                          self.collaborator_id)
+        # one query per foreign key and one to check the uids
+        with self.assertNumQueries(4):
+            result = self.import_csv(data, dry_run=True, bulk=True)
+        self.assertEqual([line for line, errors in result.row_errors()],
+                         [2, 3, 4])
+        self.assertEqual(len(result.rows[0].diff), len(SampleResource()
+                                                         .get_fields()))
+
+    def test_bulk_import(self):
+        sample = Sample.objects.get()
+        other = create_sample("10Y39")
+        versions = [tree_cache.get_sample_tree_version(s.pk)
+                    for s in (sample, other)]
+        data = ("id,uid,collaborator,sample_type,sample_location,notes\n"
+                "%d,10Y30,%d,1,1,updated\n" % (sample.pk, self.collaborator_id))
+        data += "\n".join(sample_csv(["10Y31", "10Y32"], self.collaborator_id)
+                          .splitlines()[1:]) + "\n"
+        result = self.import_csv(data, bulk=True)
+        self.assertFalse(result.has_errors())
+        self.assertEqual([r.import_type for r in result.rows],
+                         ["update", "new", "new"])
+        self.assertEqual(Sample.objects.get(pk=sample.pk).notes, "updated")
+        self.assertEqual(sorted(RegisteredBarcode.objects.values_list(
+            'barcode', flat=True)),
+            ["SA:10Y30", "SA:10Y31", "SA:10Y32", "SA:10Y39"])
+        # only the trees of the imported Samples are invalidated
+        self.assertNotEqual(tree_cache.get_sample_tree_version(sample.pk),
+                            versions[0])
+        self.assertEqual(tree_cache.get_sample_tree_version(other.pk),
+                         versions[1])
+
+
+class ContainerBulkImportTests(TestCase):
+    def setUp(self):
+        self.container_type = ContainerType.objects.create(name="plate")
+        self.shelf = ApparatusSubdivision.objects.create(
+            name="shelf",
+            apparatus=Apparatus.objects.create(name="freezer", location="lab"))
+        self.plate = Container.objects.create(type=self.container_type,
+                                              apparatus_subdivision=self.shelf)
+
+    def import_csv(self, rows, **kwargs):
+        data = "id,type,row,column,parent,apparatus_subdivision\n" + \
+            "".join(",%d,%s,%s,%s,%s\n" % ((self.container_type.pk, ) + row)
+                    for row in rows)
+        headers, rows = read_rows(StringIO(data), base_formats.CSV())
+        return import_rows(ContainerResource(), headers, rows, **kwargs)
+
+    def test_import_wells(self):
+        result = self.import_csv([(1, i, self.plate.pk, "") for i in range(3)])
+        self.assertFalse(result.has_errors())
+        wells = Container.objects.exclude(pk=self.plate.pk)
+        self.assertEqual(len(wells), 3)
+        for well in wells:
+            self.assertEqual(well.path, self.plate.path +
+                             Container.path_step_format % well.pk)
+            self.assertEqual(well.root_container_id, self.plate.pk)
+        self.assertEqual(RegisteredBarcode.objects.count(), 4)
+
+    def test_only_materialize_imported(self):
+        Container.objects.bulk_create([Container(type=self.container_type,
+                                                 parent=self.plate)])
+        result = self.import_csv([(1, 1, self.plate.pk, "")])
+        self.assertFalse(result.has_errors())
+        self.assertEqual(Container.objects.filter(path="").count(), 1)
+        self.assertEqual(RegisteredBarcode.objects.count(), 2)
+
+    def test_unique_position(self):
+        self.import_csv([(1, 1, self.plate.pk, "")])
+        result = self.import_csv([(1, 1, self.plate.pk, ""),
+                                  (1, 2, self.plate.pk, ""),
+                                  (1, 2, self.plate.pk, "")])
+        self.assertEqual([line for line, errors in result.row_errors()],
+                         [1, 3])
+        self.assertIn("row, column, parent 1, 1, %d already exists" %
+                      self.plate.pk, result.row_errors()[0][1][0].error)
+        self.assertEqual(Container.objects.count(), 2)
+
+    def test_parent_or_apparatus_subdivision(self):
+        result = self.import_csv([(1, 1, self.plate.pk, self.shelf.pk),
+                                  (1, 2, "", ""),
+                                  (1, 3, self.plate.pk, "")])
+        self.assertEqual([line for line, errors in result.row_errors()],
+                         [1, 2])
+        self.assertEqual(Container.objects.count(), 1)
+
+
+class ReimportTests(TestCase):
+    """An exported file can be imported again"""
+    def reimport(self, resource_class, queryset):
+        data = "".join(stream_export(resource_class(), queryset))
+        headers, rows = read_rows(StringIO(data), base_formats.CSV())
+        result = import_rows(resource_class(), headers, rows)
+        self.assertEqual(list(result.row_errors()), [])
+        self.assertFalse(result.has_errors())
+        return result
+
+    def test_samples(self):
+        dates = dict((s.pk, s.date.replace(microsecond=0)) for s in
+                     [create_sample("10Y30"), create_sample("10Y31")])
+        result = self.reimport(SampleResource, Sample.objects.all())
+        self.assertEqual(result.nr_imported, 2)
+        self.assertEqual(dict(Sample.objects.values_list('pk', 'date')), dates)
+
+    def test_containers(self):
+        shelf = ApparatusSubdivision.objects.create(
+            name="shelf",
+            apparatus=Apparatus.objects.create(name="freezer", location="lab"))
+        create_plates(shelf, ContainerType.objects.create(name="plate"), 1, 2)
+        paths = dict(Container.objects.values_list('pk', 'path'))
+        result = self.reimport(ContainerResource, Container.objects.all())
+        self.assertEqual(result.nr_imported, 3)
+        self.assertEqual(dict(Container.objects.values_list('pk', 'path')),
+                         paths)
+
+
+class LIMSForeignKeyWidgetTests(TestCase):
+    def setUp(self):
+        self.sample = create_sample("10Y30")
+        SampleType.objects.create(name="water")
+
+    def test_prefetch(self):
+        widget = LIMSForeignKeyWidget(SampleType)
+        # one query for the names and primary keys
+        with self.assertNumQueries(1):
+            widget.prefetch([self.sample.sample_type_id, "1", "water",
+                             "water", "", None, 2.0])
+        with self.assertNumQueries(0):
+            self.assertEqual(widget.clean("water").name, "water")
+            self.assertEqual(widget.clean(" 1 "), self.sample.sample_type)
+            self.assertEqual(widget.clean(2.0).name, "water")
+            self.assertEqual(widget.clean(""), None)
+
+    def test_natural_keys(self):
+        widget = LIMSForeignKeyWidget(Sample)
+        self.assertEqual(widget.clean("10Y30"), self.sample)
+        self.assertRaises(Sample.DoesNotExist, widget.clean, "10Y31")
+
+    def test_numeric_natural_key(self):
+        """A numeric name is the natural key of its object, not a pk"""
+        other = SampleType.objects.create(name=unicode(self.sample.sample_type_id))
+        widget = LIMSForeignKeyWidget(SampleType)
+        self.assertEqual(widget.clean(self.sample.sample_type_id), other)
+        self.assertEqual(widget.clean(other.pk), other)
+
+    def test_import_by_name(self):
+        data = ("id,uid,collaborator,sample_type,sample_location\n"
+                ",10Y31,%d,water,Sweden\n,10Y32,%d,soil,1\n" %
+                ((self.sample.collaborator_id, ) * 2))
+        headers, rows = read_rows(StringIO(data), base_formats.CSV())
+        result = import_rows(SampleResource(), headers, rows)
+        self.assertFalse(result.has_errors())
+        self.assertEqual(Sample.objects.get(uid="10Y31").sample_type.name,
+                         "water")
+        self.assertEqual(Sample.objects.get(uid="10Y32").sample_location,
+                         SampleLocation.objects.get(name="Sweden"))
+
+
+class SampleAdminImportTests(TestCase):
+    def setUp(self):
+        UserProfile.objects.create_superuser("admin", "admin@lims.org", "admin")
+        self.client.login(username="admin", password="admin")
+        self.collaborator_id = create_sample("10Y30").collaborator_id
+        self.import_dir = tempfile.mkdtemp()
+        self.settings_override = self.settings(LIMS_IMPORT_DIR=self.import_dir)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.import_dir)
+
+    def test_import(self):
+        csv_file = tempfile.NamedTemporaryFile(suffix=".csv")
+        csv_file.write(sample_csv(["10Y31", "10Y32"], self.collaborator_id))
+        csv_file.seek(0)
+        response = self.client.post(reverse("admin:lims_sample_import"),
+                                    {'import_file': csv_file,
+                                     'input_format': 0})
+        self.assertContains(response, "Confirm import")
+        self.assertEqual(Sample.objects.count(), 1)
+
+        confirm_form = response.context['confirm_form']
+        import_file_name = confirm_form.initial['import_file_name']
+        self.assertEqual(os.listdir(self.import_dir), [import_file_name])
+        response = self.client.post(
+            reverse("admin:lims_sample_process_import"),
+            {'import_file_name': import_file_name, 'input_format': 0},
+            follow=True)
+        self.assertEqual(os.listdir(self.import_dir), [])
+        job = Job.objects.get()
+        self.assertContains(response, "Job %d" % job.pk)
+        self.assertEqual(job.status, Job.QUEUED)
+        self.assertEqual(Sample.objects.count(), 1)
+
+        call_command("run_jobs", once=True, stdout=StringIO())
+        job = Job.objects.get()
+        self.assertEqual(job.status, Job.DONE)
+        self.assertEqual(job.message, "Imported 2 rows")
+        self.assertEqual(Sample.objects.count(), 3)
+        self.assertEqual(
+            Sample.objects.get(uid="10Y31").created_by.username, "admin")
+
+
+    def test_only_import_files(self):
+        """Only files saved by the import preview can be imported"""
+        other_file = tempfile.NamedTemporaryFile(suffix=".csv")
+        other_file.write(sample_csv(["10Y31"], self.collaborator_id))
+        other_file.flush()
+        for import_file_name in (other_file.name, "../" + os.path.basename(
+                other_file.name)):
+            response = self.client.post(
+                reverse("admin:lims_sample_process_import"),
+                {'import_file_name': import_file_name, 'input_format': 0})
+            self.assertEqual(response.status_code, 400)
+        self.assertTrue(os.path.exists(other_file.name))
+        self.assertEqual(Job.objects.count(), 0)
+
+
+class StreamingExportTests(TestCase):
+    def setUp(self):
+        UserProfile.objects.create_superuser("admin", "admin@lims.org", "admin")
+        self.client.login(username="admin", password="admin")
+        self.container_type = ContainerType.objects.create(name="plate")
+        self.shelf = ApparatusSubdivision.objects.create(
+            name="shelf",
+            apparatus=Apparatus.objects.create(name="freezer", location="lab"))
+
+    def export_containers(self):
+        response = self.client.post(reverse("admin:lims_container_export"),
+                                    {'file_format': 0})
+        self.assertEqual(response["Content-Type"], "text/csv")
+        return "".join(response.streaming_content).splitlines()
+
+    def test_export(self):
+        create_plates(self.shelf, self.container_type, 1, 2)
+        lines = self.export_containers()
+        self.assertEqual(len(lines), 4)
+        headers = lines[0].split(",")
+        self.assertEqual(sorted(headers[-5:]),
+                         ["barcode", "nr_children", "nr_objects_in_container",
+                          "root_apparatus", "root_apparatus_subdivision"])
+        rows = [dict(zip(headers, line.split(","))) for line in lines[1:]]
+        plate = [row for row in rows if row["parent"] == ""][0]
+        well = [row for row in rows if row["parent"] != ""][0]
+        self.assertEqual(plate["nr_children"], "2")
+        self.assertEqual(well["parent"], plate["id"])
+        self.assertEqual(well["root_apparatus"], "freezer")
+        self.assertEqual(well["barcode"], "CO:%06d" % int(well["id"]))
+
+    def test_export_queries(self):
+        """The number of queries does not depend on the number of rows"""
+        create_plates(self.shelf, self.container_type, 1, 2)
+        self.client.get(reverse("admin:lims_container_changelist"))
+        with self.assertNumQueries(6):
+            self.export_containers()
+        create_plates(self.shelf, self.container_type, 3, 4)
+        with self.assertNumQueries(6):
+            self.assertEqual(len(self.export_containers()), 19)
@@ -0,0 +1,156 @@
+import json
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from django.utils import timezone
+
+from lims.jobs import JobFailed, claim_job, enqueue, job, run_job
+from lims.models import Job, UserProfile
+from lims.tests.test_models import create_sample
+
+
+@job
+def fail(job, message):
+    raise JobFailed(message)
+
+
+@job
+def count(job, to):
+    for i in range(to):
+        job.set_progress(i + 1, to)
+    return "Counted to %d" % to
+
+
+class JobTests(TestCase):
+    def test_unknown_job(self):
+        self.assertRaises(ValueError, enqueue, "unknown")
+
+    def test_claim_job(self):
+        first = enqueue("count", to=3)
+        second = enqueue("count", to=3)
+        self.assertEqual(claim_job(), first)
+        self.assertEqual(claim_job(), second)
+        self.assertEqual(claim_job(), None)
+        self.assertEqual(Job.objects.filter(status=Job.RUNNING).count(), 2)
+
+    def test_fail_stale_jobs(self):
+        stale = enqueue("count", to=3)
+        claim_job()
+        Job.objects.filter(pk=stale.pk).update(
+            heartbeat=timezone.now() - timedelta(seconds=61))
+        running = enqueue("count", to=3)
+        claim_job()
+        queued = enqueue("count", to=3)
+        with self.settings(LIMS_JOB_TIMEOUT=60):
+            self.assertEqual(claim_job(), queued)
+        self.assertEqual(Job.objects.get(pk=stale.pk).status, Job.FAILED)
+        self.assertIn("No progress", Job.objects.get(pk=stale.pk).message)
+        self.assertEqual(Job.objects.get(pk=running.pk).status, Job.RUNNING)
+
+    def test_run_job(self):
+        enqueue("count", to=3)
+        run_job(claim_job())
+        job = Job.objects.get()
+        self.assertEqual(job.status, Job.DONE)
+        self.assertEqual(job.message, "Counted to 3")
+        self.assertEqual((job.progress, job.total), (3, 3))
+        self.assertEqual(job.percentage, 100)
+        self.assertTrue(job.finished)
+
+    def test_failed_job(self):
+        enqueue("fail", message="Out of labels")
+        run_job(claim_job())
+        job = Job.objects.get()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertEqual(job.message, "Out of labels")
+
+    def test_exception_fails_job(self):
+        enqueue("count", to="three")
+        run_job(claim_job())
+        job = Job.objects.get()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertIn("TypeError", job.message)
+
+
+class ExportJobTests(TestCase):
+    def setUp(self):
+        UserProfile.objects.create_superuser("admin", "admin@lims.org", "admin")
+        self.client.login(username="admin", password="admin")
+        self.samples = [create_sample("10Y3%d" % i) for i in range(3)]
+        self.export_dir = tempfile.mkdtemp()
+        self.settings_override = self.settings(
+            LIMS_EXPORT_DIR=os.path.join(self.export_dir, "exports"))
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.export_dir)
+
+    def export(self, samples):
+        response = self.client.post(
+            reverse("admin:lims_sample_changelist"),
+            {'action': 'export_in_background',
+             '_selected_action': [s.pk for s in samples]},
+            follow=True)
+        job = Job.objects.latest('pk')
+        self.assertContains(response, "Queued the export")
+        self.assertContains(response, reverse("lims.views.job_status",
+                                              args=[job.pk]))
+        run_job(claim_job())
+        return job
+
+    def test_export_all(self):
+        job = self.export(self.samples)
+        self.assertEqual(job.get_arguments()['pks'], None)
+        response = self.client.get(reverse("lims.views.job_download",
+                                           args=[job.pk]))
+        lines = "".join(response.streaming_content).splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertIn("uid", lines[0].split(","))
+
+    def test_export_selected(self):
+        job = self.export(self.samples[:1])
+        response = self.client.get(reverse("lims.views.job_download",
+                                           args=[job.pk]))
+        lines = "".join(response.streaming_content).splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertIn("10Y30", lines[1])
+
+    def test_status(self):
+        job = self.export(self.samples)
+        response = self.client.get(reverse("lims.views.job_status",
+                                           args=[job.pk]))
+        self.assertContains(response, "Exported 3 rows")
+        data = json.loads(self.client.get(
+            reverse("lims.views.job_json", args=[job.pk])).content)
+        self.assertEqual(data['status'], Job.DONE)
+        self.assertTrue(data['finished'])
+        self.assertEqual(data['download'],
+                         reverse("lims.views.job_download", args=[job.pk]))
+
+    def test_export_to_file(self):
+        job = self.export(self.samples)
+        job = Job.objects.get(pk=job.pk)
+        self.assertEqual(job.data, None)
+        self.assertEqual(job.data_name, "sample-%d.csv" % job.pk)
+        with open(job.get_export_path()) as f:
+            self.assertEqual(len(f.read().splitlines()), 4)
+
+        job.delete()
+        self.assertEqual(os.listdir(os.path.join(self.export_dir, "exports")),
+                         [])
+
+    def test_download_without_file(self):
+        job = enqueue("count", to=1)
+        response = self.client.get(reverse("lims.views.job_download",
+                                           args=[job.pk]))
+        self.assertEqual(response.status_code, 404)
+
+        Job.objects.filter(pk=job.pk).update(data_name="../settings.py")
+        response = self.client.get(reverse("lims.views.job_download",
+                                           args=[job.pk]))
+        self.assertEqual(response.status_code, 404)
@@ -0,0 +1,102 @@
+import logging
+
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import TestCase
+
+from lims.metrics import QueryRecorder, percentile, request_metrics
+from lims.tests.test_models import create_sample
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        request_metrics.clear()
+
+    def get_metrics(self):
+        response = self.client.get(reverse("lims.views.metrics"))
+        self.assertEqual(response.status_code, 200)
+        return response.content.splitlines()
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(percentile(values, 0.5), 50)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile([3], 0.9), 3)
+
+    def test_query_recorder(self):
+        recorder = QueryRecorder(3)
+        for i in [4, 1, 7, 3, 9, 2]:
+            recorder.add("SELECT %d" % i, i / 10.0)
+        self.assertEqual((recorder.count, recorder.time), (6, 2.6))
+        self.assertEqual([sql for seconds, sql in recorder.get_slowest()],
+                         ["SELECT 9", "SELECT 7", "SELECT 4"])
+
+    def test_queries_are_not_kept(self):
+        create_sample("10Y30")
+        self.client.get(reverse("lims.views.barcode_json", args=["SA:10Y30"]))
+        self.assertEqual(connection.queries, [])
+
+    def test_metrics(self):
+        create_sample("10Y30")
+        url = reverse("lims.views.barcode_json", args=["SA:10Y30"])
+        with self.settings(DEBUG=True):
+            self.client.get(url)
+            nr_queries = len(connection.queries)
+        self.client.get(url)
+        self.client.get(reverse("index"))
+        self.client.get(reverse("lims.views.browse_list", args=["sample"]))
+
+        lines = self.get_metrics()
+        self.assertIn('lims_request_queries_count{view="barcode_json"} 2',
+                      lines)
+        self.assertIn('lims_request_queries{view="barcode_json",'
+                      'quantile="0.5"} %r' % float(nr_queries), lines)
+        self.assertIn('lims_request_seconds_count{view="index"} 1', lines)
+        self.assertIn('lims_request_seconds_count{view="browse_list.sample"} 1',
+                      lines)
+        self.assertIn("# TYPE lims_response_bytes summary", lines)
+        render_time = [l for l in lines if l.startswith(
+            'lims_request_render_seconds_sum{view="index"}')]
+        self.assertTrue(float(render_time[0].split()[-1]) > 0)
+
+    def test_not_found(self):
+        for model_name in ("aaa", "bbb"):
+            response = self.client.get(reverse("lims.views.browse_list",
+                                               args=[model_name]))
+            self.assertEqual(response.status_code, 404)
+        lines = self.get_metrics()
+        self.assertIn('lims_request_seconds_count{view="not_found"} 2', lines)
+        self.assertFalse([l for l in lines if "aaa" in l or "bbb" in l])
+
+    def test_only_local(self):
+        response = self.client.get(reverse("lims.views.metrics"),
+                                   REMOTE_ADDR="10.0.0.1")
+        self.assertEqual(response.status_code, 404)
+
+    def test_log_slow_requests(self):
+        handler = ListHandler()
+        logger = logging.getLogger("lims.metrics")
+        logger.addHandler(handler)
+        logger.propagate = False
+        try:
+            create_sample("10Y30")
+            with self.settings(LIMS_METRICS_SLOW_REQUEST_QUERIES=0):
+                self.client.get(reverse("lims.views.barcode_json",
+                                        args=["SA:10Y30"]))
+            self.client.get(reverse("index"))
+        finally:
+            logger.removeHandler(handler)
+            logger.propagate = True
+        self.assertEqual(len(handler.records), 1)
+        message = handler.records[0].getMessage()
+        self.assertIn("barcode_json", message)
+        self.assertIn("SELECT", message)
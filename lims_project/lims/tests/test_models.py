@@ -1,16 +1,246 @@
+import json
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import IntegrityError, connection
+from django.db.models import get_models
 from django.test import TestCase
 from django.core.urlresolvers import reverse
 
-from lims.models import Apparatus
+import lims.models
+from lims import tree_cache
+from lims.models import Apparatus, ApparatusSubdivision, Collaborator, Container, \
+    ContainerType, ExtractedCell, ExtractedDNA, IndexByGroup, \
+    IndexByGroupCounter, Protocol, Sample, SampleLocation, SampleType
 
 
 class ApparatusTests(TestCase):
     def setUp(self):
         Apparatus.objects.get_or_create(name="apparatus1", location="basement")
 
-        self.create_read_url = reverse("lims.views.browse.apparatus")
+        self.create_read_url = reverse("lims.views.browse_list", args=["apparatus"])
 
     def test_browse(self):
         response = self.client.get(self.create_read_url)
 
         self.assertContains(response, "apparatus1")
+
+
+class ContainerHierarchyTests(TestCase):
+    def setUp(self):
+        apparatus = Apparatus.objects.create(name="freezer1", location="lab")
+        self.subdivision = ApparatusSubdivision.objects.create(
+            name="shelf1", apparatus=apparatus)
+        self.container_type = ContainerType.objects.create(name="rack")
+
+        self.rack = Container.objects.create(
+            type=self.container_type, apparatus_subdivision=self.subdivision)
+        self.plate = Container.objects.create(type=self.container_type,
+                                              parent=self.rack)
+        self.well = Container.objects.create(type=self.container_type,
+                                             parent=self.plate, row=1,
+                                             column=1)
+
+    def test_path(self):
+        self.assertEqual(self.rack.depth, 0)
+        self.assertEqual(self.well.depth, 2)
+        self.assertEqual(self.well.path, "%08d/%08d/%08d/" % (
+            self.rack.id, self.plate.id, self.well.id))
+        self.assertEqual(self.well.root_container_id, self.rack.id)
+
+    def test_root_single_query(self):
+        well = Container.objects.get(pk=self.well.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(well.root, self.rack)
+            self.assertEqual(well.root_apparatus_subdivision, self.subdivision)
+            self.assertEqual(well.root_apparatus.name, "freezer1")
+
+    def test_ancestors_descendants(self):
+        self.assertEqual(list(self.well.get_ancestors()),
+                         [self.rack, self.plate])
+        self.assertEqual(set(self.rack.get_descendants()),
+                         set([self.plate, self.well]))
+
+    def test_reparent(self):
+        rack2 = Container.objects.create(
+            type=self.container_type, apparatus_subdivision=self.subdivision)
+        self.plate.parent = rack2
+        self.plate.save()
+
+        well = Container.objects.get(pk=self.well.pk)
+        self.assertEqual(well.root_container_id, rack2.id)
+        self.assertEqual(well.path, "%08d/%08d/%08d/" % (
+            rack2.id, self.plate.id, self.well.id))
+        self.assertEqual(set(self.rack.get_descendants()), set())
+
+    def test_reparent_queries(self):
+        """The subtree is moved with a constant number of queries"""
+        rack2 = Container.objects.create(
+            type=self.container_type, apparatus_subdivision=self.subdivision)
+        self.plate.parent = rack2
+        with self.settings(DEBUG=True):
+            connection.queries = []
+            self.plate.save()
+            nr_queries = len(connection.queries)
+        for i in range(2, 7):
+            Container.objects.create(type=self.container_type,
+                                     parent=self.plate, row=i, column=1)
+        self.plate.parent = self.rack
+        with self.assertNumQueries(nr_queries):
+            self.plate.save()
+        self.assertEqual(set(c.depth for c in self.rack.get_descendants()
+                             .exclude(pk=self.plate.pk)), set([2]))
+        self.assertEqual(Container.objects.filter(
+            root_container=self.rack).count(), 8)
+
+    def test_descendants_without_path(self):
+        self.assertEqual(list(Container(type=self.container_type)
+                              .get_descendants()), [])
+
+    def test_move_into_descendant(self):
+        self.rack.parent = self.well
+        self.rack.apparatus_subdivision = None
+        self.assertRaises(Exception, self.rack.save)
+
+    def test_get_objects_in_container(self):
+        apparatus_ct = ContentType.objects.get_for_model(Apparatus)
+        subdivision_ct = ContentType.objects.get_for_model(ApparatusSubdivision)
+        self.well.content_type = apparatus_ct
+        self.well.object_id = self.subdivision.apparatus_id
+        self.well.save()
+        for i in range(2, 5):
+            Container.objects.create(type=self.container_type,
+                                     parent=self.plate, row=i, column=1,
+                                     content_type=subdivision_ct,
+                                     object_id=self.subdivision.id)
+
+        # One query for the subtree and one per content type
+        with self.assertNumQueries(3):
+            objects = self.rack.get_objects_in_container()
+        self.assertEqual(objects, [self.subdivision.apparatus] +
+                         3 * [self.subdivision])
+        self.assertEqual(len(list(self.rack.iter_objects_in_container(
+            chunk_size=2))), 4)
+
+    def test_rebuild_tree(self):
+        Container.objects.update(path="", depth=0, root_container=None)
+        Container.rebuild_tree()
+        well = Container.objects.get(pk=self.well.pk)
+        self.assertEqual(well.path, self.well.path)
+        self.assertEqual(well.depth, 2)
+        self.assertEqual(well.root_container_id, self.rack.id)
+
+
+def create_sample(uid):
+    """Create a Sample with all the required foreign keys"""
+    collaborator, created = Collaborator.objects.get_or_create(
+        first_name="John", last_name="Doe", institution="Uppsala University",
+        address="Uppsala", email="john@doe.edu")
+    sample_type, created = SampleType.objects.get_or_create(name="soil")
+    sample_location, created = SampleLocation.objects.get_or_create(
+        name="Sweden")
+    return Sample.objects.create(uid=uid, collaborator=collaborator,
+                                 sample_type=sample_type,
+                                 sample_location=sample_location)
+
+
+class IndexByGroupTests(TestCase):
+    def setUp(self):
+        self.sample = create_sample("10Y31")
+        self.protocol = Protocol.objects.create(name="extraction",
+                                                revision="1", link="")
+
+    def create_extracted_cell(self, sample):
+        ec = ExtractedCell(sample=sample, protocol=self.protocol)
+        ec.save()
+        return ec
+
+    def test_index_by_group(self):
+        ecs = [self.create_extracted_cell(self.sample) for i in range(3)]
+        self.assertEqual([ec.index_by_group for ec in ecs], [0, 1, 2])
+        self.assertEqual([ec.uid for ec in ecs],
+                         ["10Y31_1", "10Y31_2", "10Y31_3"])
+
+        other = self.create_extracted_cell(create_sample("10Y32"))
+        self.assertEqual(other.uid, "10Y32_1")
+
+    def test_index_survives_deletion(self):
+        ecs = [self.create_extracted_cell(self.sample) for i in range(2)]
+        ecs[0].delete()
+        self.assertEqual(self.create_extracted_cell(self.sample).uid,
+                         "10Y31_3")
+
+    def test_counter_initialized_from_existing(self):
+        for i in range(2):
+            self.create_extracted_cell(self.sample)
+        IndexByGroupCounter.objects.all().delete()
+        self.assertEqual(self.create_extracted_cell(self.sample).uid,
+                         "10Y31_3")
+
+    def test_extracted_dna_shares_group(self):
+        ec = self.create_extracted_cell(self.sample)
+        dnas = [ExtractedDNA(sample=self.sample), ExtractedDNA(extracted_cell=ec)]
+        for dna in dnas:
+            dna.protocol = self.protocol
+            dna.concentration = 1
+            dna.buffer = "TE"
+            dna.save()
+        self.assertEqual([dna.uid for dna in dnas], ["10Y31_1", "10Y31_2"])
+
+    def test_uid_formats(self):
+        for model in get_models(app_mod=lims.models):
+            if issubclass(model, IndexByGroup):
+                self.assertIn("{group}", model.uid_format)
+
+    def test_bulk_create_by_group(self):
+        other_sample = create_sample("10Y32")
+        self.create_extracted_cell(self.sample)
+        ecs = [ExtractedCell(sample=sample, protocol=self.protocol)
+               for sample in 3 * [self.sample] + 2 * [other_sample]]
+
+        created = ExtractedCell.objects.bulk_create_by_group(ecs, batch_size=2)
+        self.assertEqual([ec.uid for ec in created],
+                         ["10Y31_2", "10Y31_3", "10Y31_4", "10Y32_1", "10Y32_2"])
+        self.assertTrue(all(ec.pk for ec in created))
+        self.assertEqual(self.create_extracted_cell(other_sample).uid,
+                         "10Y32_3")
+
+    def test_bulk_create_by_group_registers_barcodes(self):
+        tree_url = reverse("lims.views.sample_tree_json", args=[self.sample.pk])
+        self.assertNotContains(self.client.get(tree_url), "10Y31_1")
+
+        created = ExtractedCell.objects.bulk_create_by_group(
+            [ExtractedCell(sample=self.sample, protocol=self.protocol)])
+        response = self.client.get(reverse("lims.views.barcode_json",
+                                           args=[created[0].barcode]))
+        self.assertEqual(json.loads(response.content)['id'], created[0].pk)
+        self.assertContains(self.client.get(tree_url), "10Y31_1")
+
+    def test_bulk_create_by_group_keeps_other_trees(self):
+        other_sample = create_sample("10Y32")
+        versions = [tree_cache.get_sample_tree_version(sample.pk)
+                    for sample in (self.sample, other_sample)]
+        ExtractedCell.objects.bulk_create_by_group(
+            [ExtractedCell(sample=self.sample, protocol=self.protocol)])
+        self.assertNotEqual(tree_cache.get_sample_tree_version(self.sample.pk),
+                            versions[0])
+        self.assertEqual(tree_cache.get_sample_tree_version(other_sample.pk),
+                         versions[1])
+
+    def test_bulk_create_by_group_new_groups(self):
+        other_sample = create_sample("10Y32")
+        created = ExtractedCell.objects.bulk_create_by_group(
+            [ExtractedCell(sample=other_sample, protocol=self.protocol)
+             for i in range(2)], new_groups=True)
+        self.assertEqual([ec.uid for ec in created], ["10Y32_1", "10Y32_2"])
+        self.assertEqual(self.create_extracted_cell(other_sample).uid,
+                         "10Y32_3")
+        self.assertRaises(IntegrityError,
+                          ExtractedCell.objects.bulk_create_by_group,
+                          [ExtractedCell(sample=other_sample,
+                                         protocol=self.protocol)],
+                          new_groups=True)
+
+    def test_bulk_create_by_group_checks_save(self):
+        dna = ExtractedDNA(protocol=self.protocol, concentration=1, buffer="TE")
+        self.assertRaises(Exception, ExtractedDNA.objects.bulk_create_by_group,
+                          [dna])
@@ -0,0 +1,95 @@
+"""
+Query count budgets of the browse pages and the admin changelists. Every page
+is requested on a dataset with a single Sample and again after adding
+Samples with larger lineages. A page has to take the same number of queries
+at both scales and stay within its budget, otherwise it makes queries per
+row.
+"""
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.db.models import get_models
+from django.test import TestCase
+
+import lims.models
+from lims.dataset import generate_dataset
+from lims.models import Browsable, UserProfile
+
+# Queries per page, the admin pages include the session and the user
+BROWSE_LIST_BUDGET = 1
+BROWSE_DETAIL_BUDGET = 1
+SAMPLE_TREE_BUDGET = 22
+ADMIN_CHANGELIST_BUDGETS = {
+    'container': 6,
+    'sample': 4,
+    'dnalibrary': 4,
+}
+
+
+def browse_models():
+    return get_models(app_mod=lims.models)
+
+
+class QueryBudgetTests(TestCase):
+    def setUp(self):
+        UserProfile.objects.create_superuser("admin", "admin@lims.org", "admin")
+        self.client.login(username="admin", password="admin")
+
+    def get_nr_queries(self, url):
+        with self.settings(DEBUG=True):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+            return len(connection.queries)
+
+    def assert_budgets(self, get_urls):
+        """get_urls returns a dict of page name to (url, budget) for the
+        current dataset. Checks the number of queries of every page at two
+        scales, reporting all pages over their budget at once."""
+        generate_dataset(1, sags_per_plate=1)
+        small = dict((name, self.get_nr_queries(url))
+                     for name, (url, budget) in get_urls().items())
+        generate_dataset(4, prefix="Y", sags_per_plate=4)
+        errors = []
+        for name, (url, budget) in sorted(get_urls().items()):
+            nr_queries = self.get_nr_queries(url)
+            if nr_queries != small[name] or nr_queries > budget:
+                errors.append("%s: %d queries with 1 Sample, %d with 5, "
+                              "budget %d" % (name, small[name], nr_queries,
+                                             budget))
+        self.assertEqual(errors, [])
+
+    def test_browse_lists(self):
+        def get_urls():
+            return dict((model.__name__, (
+                reverse("lims.views.browse_list",
+                        args=[model._meta.model_name]),
+                BROWSE_LIST_BUDGET)) for model in browse_models())
+        self.assert_budgets(get_urls)
+
+    def test_browse_details(self):
+        def get_urls():
+            """The detail page of the newest object of every model, which
+            has the larger lineage at the second scale"""
+            urls = {}
+            for model in browse_models():
+                if issubclass(model, Browsable):
+                    obj = model.objects.order_by('-pk').first()
+                    self.assertTrue(obj, "No %s in dataset" % model.__name__)
+                    urls[model.__name__] = (obj.get_absolute_url(),
+                                            BROWSE_DETAIL_BUDGET)
+            return urls
+        self.assert_budgets(get_urls)
+
+    def test_sample_tree(self):
+        def get_urls():
+            sample = lims.models.Sample.objects.order_by('-pk')[0]
+            return {'sample tree': (
+                reverse("lims.views.sample_tree_json", args=[sample.pk]),
+                SAMPLE_TREE_BUDGET)}
+        self.assert_budgets(get_urls)
+
+    def test_admin_changelists(self):
+        def get_urls():
+            return dict((name, (
+                reverse("admin:lims_%s_changelist" % name), budget))
+                for name, budget in ADMIN_CHANGELIST_BUDGETS.items())
+        self.assert_budgets(get_urls)
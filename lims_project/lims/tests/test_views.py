@@ -0,0 +1,269 @@
+import json
+
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+
+from lims.models import Amplicon, Apparatus, ApparatusSubdivision, Container, \
+    ContainerType, ExtractedCell, ExtractedDNA, Protocol, RegisteredBarcode
+from lims.views import generate_related_objects_tree
+from lims.tests.test_models import create_sample
+
+
+class ObjectListTests(TestCase):
+    def setUp(self):
+        apparatus = Apparatus.objects.create(name="freezer", location="lab")
+        self.subdivisions = [ApparatusSubdivision.objects.create(
+            name="shelf%d" % i, apparatus=apparatus) for i in range(5)]
+        self.url = reverse("lims.views.browse_list",
+                           args=["apparatussubdivision"])
+
+    def test_pages(self):
+        response = self.client.get(self.url, {'page_size': 2})
+        self.assertEqual(list(response.context['objects']),
+                         self.subdivisions[:2])
+        self.assertEqual(response.context['next_after'],
+                         self.subdivisions[1].id)
+
+        response = self.client.get(self.url, {
+            'page_size': 2, 'after': self.subdivisions[3].id})
+        self.assertEqual(list(response.context['objects']),
+                         self.subdivisions[4:])
+        self.assertEqual(response.context['next_after'], None)
+
+    def test_invalid_page_size(self):
+        for page_size in ("-5", "0", "a"):
+            response = self.client.get(self.url, {'page_size': page_size})
+            self.assertEqual(response.status_code, 404, page_size)
+
+    def test_single_query(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url)
+        self.assertContains(response, "freezer shelf4")
+
+    def test_stream(self):
+        response = self.client.get(self.url, {'stream': ''})
+        lines = "".join(response.streaming_content).splitlines()
+        self.assertEqual(lines[0], "%d\tfreezer shelf0" %
+                         self.subdivisions[0].id)
+        self.assertEqual(len(lines), 5)
+
+
+class ObjectTableTests(TestCase):
+    def test_container(self):
+        apparatus = Apparatus.objects.create(name="freezer", location="lab")
+        subdivision = ApparatusSubdivision.objects.create(name="shelf",
+                                                          apparatus=apparatus)
+        container_type = ContainerType.objects.create(name="plate")
+        plate = Container.objects.create(type=container_type,
+                                         apparatus_subdivision=subdivision)
+        well = Container.objects.create(type=container_type, parent=plate)
+
+        for container in (plate, well):
+            with self.assertNumQueries(1):
+                response = self.client.get(container.get_absolute_url())
+            self.assertContains(response, "freezer shelf" if container == plate
+                                else unicode(plate))
+
+    def test_extracted_cell(self):
+        ec = ExtractedCell(sample=create_sample("10Y31"),
+                           protocol=Protocol.objects.create(
+                               name="extraction", revision="1", link=""))
+        ec.save()
+        with self.assertNumQueries(1):
+            response = self.client.get(ec.get_absolute_url())
+        self.assertContains(response, "View Sample Tree")
+
+    def test_not_found(self):
+        response = self.client.get(reverse("lims.views.browse_detail",
+                                           args=["container", 1]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_unknown_model(self):
+        for url in (reverse("lims.views.browse_list", args=["nomodel"]),
+                    reverse("lims.views.browse_detail", args=["nomodel", 1]),
+                    reverse("lims.views.browse_detail", args=["protocol", 1])):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 404, url)
+
+
+class SampleTreeTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.sample = create_sample("10Y31")
+        self.protocol = Protocol.objects.create(name="extraction",
+                                                revision="1", link="")
+
+    def add_extractions(self, nr_extractions):
+        for i in range(nr_extractions):
+            ExtractedCell(sample=self.sample, protocol=self.protocol).save()
+            dna = ExtractedDNA(sample=self.sample, protocol=self.protocol,
+                               concentration=1, buffer="TE")
+            dna.save()
+            Amplicon(extracted_dna=dna, diversity_report="",
+                     buffer="TE").save()
+
+    def test_tree(self):
+        self.add_extractions(1)
+        tree = generate_related_objects_tree(self.sample)
+        self.assertEqual(tree["url"], self.sample.get_absolute_url())
+        self.assertEqual(tree["ExtractedCell"].keys(), ["10Y31_1"])
+        dna = tree["ExtractedDNA"]["10Y31_1"]
+        self.assertEqual(dna["url"],
+                         ExtractedDNA.objects.get(uid="10Y31_1").get_absolute_url())
+        self.assertEqual(dna["Amplicon"].keys(), ["10Y31A_Y01"])
+
+    def test_nr_queries(self):
+        """The number of queries depends on the depth of the tree, not on the
+        number of objects in it"""
+        self.add_extractions(1)
+        with self.assertNumQueries(9):
+            self.client.get(reverse("lims.views.sample_tree_json",
+                                    args=[self.sample.id]))
+        self.add_extractions(5)
+        with self.assertNumQueries(9):
+            self.client.get(reverse("lims.views.sample_tree_json",
+                                    args=[self.sample.id]))
+
+    def test_cache(self):
+        url = reverse("lims.views.sample_tree_json", args=[self.sample.id])
+        self.add_extractions(1)
+        response = self.client.get(url)
+        self.assertContains(response, "10Y31_1")
+        with self.assertNumQueries(0):
+            self.client.get(url)
+
+        # Unchanged trees are not sent again
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+        # Adding an object to the lineage invalidates the cached tree
+        self.add_extractions(1)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertContains(response, "10Y31_2")
+
+    def test_cache_move(self):
+        url = reverse("lims.views.sample_tree_json", args=[self.sample.id])
+        self.add_extractions(1)
+        self.assertContains(self.client.get(url), "10Y31A_Y01")
+
+        dna = ExtractedDNA.objects.get(uid="10Y31_1")
+        dna.sample = create_sample("10Y32")
+        dna.save()
+        self.assertNotContains(self.client.get(url), "10Y31A_Y01")
+
+
+    def test_cache_other_samples(self):
+        """Changes only invalidate the tree of their own Sample"""
+        other = create_sample("10Y32")
+        url = reverse("lims.views.sample_tree_json", args=[other.id])
+        self.client.get(url)
+        self.add_extractions(1)
+        amplicon = Amplicon.objects.get()
+        amplicon.buffer = "water"
+        amplicon.save()
+        amplicon.delete()
+        with self.assertNumQueries(0):
+            self.client.get(url)
+
+    def test_save_unmoved(self):
+        """Saving an object that stays in its lineage only loads the ids of
+        its parents and the Sample of its parent for the sample tree, the
+        other queries save the object and its barcode"""
+        self.add_extractions(1)
+        amplicon = Amplicon.objects.get()
+        with self.assertNumQueries(6):
+            amplicon.save()
+
+
+class BarcodeTests(TestCase):
+    def setUp(self):
+        self.sample = create_sample("10Y31")
+
+    def test_registry(self):
+        self.assertEqual(RegisteredBarcode.objects.get(
+            barcode="SA:10Y31").content_object, self.sample)
+
+        self.sample.uid = "10Y32"
+        self.sample.save()
+        self.assertEqual(RegisteredBarcode.objects.get().barcode, "SA:10Y32")
+
+        self.sample.delete()
+        self.assertEqual(RegisteredBarcode.objects.count(), 0)
+
+    def test_rebuild(self):
+        RegisteredBarcode.objects.all().delete()
+        self.assertEqual(RegisteredBarcode.rebuild(), 1)
+        self.assertEqual(RegisteredBarcode.objects.get().barcode, "SA:10Y31")
+
+    def test_barcode_search(self):
+        url = reverse("lims.views.barcode_search", args=["SA:10Y31"])
+        with self.assertNumQueries(2):
+            response = self.client.get(url)
+        self.assertContains(response, "10Y31")
+
+        response = self.client.get(reverse("lims.views.barcode_search",
+                                           args=["SA:XXXXX"]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_barcode_json(self):
+        apparatus = Apparatus.objects.create(name="freezer", location="lab")
+        container = Container.objects.create(
+            type=ContainerType.objects.create(name="plate"),
+            apparatus_subdivision=ApparatusSubdivision.objects.create(
+                name="shelf", apparatus=apparatus))
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse("lims.views.barcode_json",
+                                               args=[container.barcode]))
+        self.assertEqual(json.loads(response.content), {
+            'barcode': container.barcode,
+            'type': 'Container',
+            'id': container.id,
+            'url': container.get_absolute_url(),
+        })
+
+    def test_barcode_batch(self):
+        apparatus = Apparatus.objects.create(name="freezer", location="lab")
+        container_type = ContainerType.objects.create(name="plate")
+        plate = Container.objects.create(
+            type=container_type,
+            apparatus_subdivision=ApparatusSubdivision.objects.create(
+                name="shelf", apparatus=apparatus))
+        well = Container.objects.create(type=container_type, parent=plate,
+                                        row=2, column=3,
+                                        content_object=self.sample)
+
+        url = reverse("lims.views.barcode_batch")
+        barcodes = ["SA:10Y31", well.barcode, "SA:XXXXX"]
+        with self.assertNumQueries(4):
+            response = self.client.post(url, json.dumps(barcodes),
+                                        content_type="application/json")
+        self.assertEqual(json.loads(response.content), [
+            {'barcode': "SA:10Y31", 'type': "Sample", 'id': self.sample.id,
+             'uid': "10Y31", 'container': well.barcode, 'row': 2,
+             'column': 3, 'apparatus': "freezer"},
+            {'barcode': well.barcode, 'type': "Container", 'id': well.id,
+             'uid': None, 'container': well.barcode, 'row': 2, 'column': 3,
+             'apparatus': "freezer"},
+            {'barcode': "SA:XXXXX", 'type': None},
+        ])
+
+        response = self.client.post(url, {'barcodes': "SA:10Y31\nSA:XXXXX"})
+        self.assertEqual([r['type'] for r in json.loads(response.content)],
+                         ["Sample", None])
+
+    def test_barcode_batch_bad_request(self):
+        url = reverse("lims.views.barcode_batch")
+        for data in ['{"barcodes": []}', '["SA:10Y31", 1]', '[["SA:10Y31"]]']:
+            response = self.client.post(url, data,
+                                        content_type="application/json")
+            self.assertEqual(response.status_code, 400)
+
+        with self.settings(LIMS_BARCODE_BATCH_MAX_SIZE=2):
+            response = self.client.post(
+                url, json.dumps(["SA:10Y31", "SA:10Y32", "SA:10Y33"]),
+                content_type="application/json")
+            self.assertEqual(response.status_code, 400)
+            response = self.client.post(
+                url, {'barcodes': "SA:10Y31 SA:10Y32 SA:10Y33"})
+            self.assertEqual(response.status_code, 400)
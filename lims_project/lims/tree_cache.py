@@ -0,0 +1,164 @@
+"""
+Versioned cache keys for the sample tree (see views.sample_tree_json). Every
+Sample has a version, the time its lineage last changed. The version is part
+of the cache key, so changing it invalidates the cached tree. Saving or
+deleting an object in the lineage of a Sample updates the version of that
+Sample, which is found by following the lineage foreign keys of the object
+in the database. The global version invalidates the trees of all Samples,
+e.g. after loaddata.
+"""
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.utils.timezone import utc
+
+from lims.models import Sample, ExtractedCell, ExtractedDNA, SAGPlate, \
+    SAGPlateDilution, SAG, Metagenome, Amplicon, DNAFromPureCulture, \
+    DNALibrary, ReadFile
+
+lineage_models = [Sample, ExtractedCell, ExtractedDNA, SAGPlate,
+                  SAGPlateDilution, SAG, Metagenome, Amplicon,
+                  DNAFromPureCulture, DNALibrary, ReadFile]
+
+GLOBAL_VERSION_KEY = "lims.sample_tree.version"
+SAMPLE_VERSION_KEY = "lims.sample_tree.version.%s"
+TREE_KEY = "lims.sample_tree.%s.%s"
+
+
+def get_version(key):
+    """Returns the version stored under key, starting a new one if it is not
+    in the cache"""
+    version = cache.get(key)
+    if version is None:
+        version = time.time()
+        cache.add(key, version, settings.LIMS_SAMPLE_TREE_CACHE_TIMEOUT)
+        version = cache.get(key, version)
+    return version
+
+
+def get_sample_tree_version(sample_id):
+    """Returns the global and sample version of the sample tree"""
+    return (get_version(GLOBAL_VERSION_KEY),
+            get_version(SAMPLE_VERSION_KEY % sample_id))
+
+
+def get_sample_tree_key(sample_id):
+    return TREE_KEY % (sample_id, "%r.%r" % get_sample_tree_version(sample_id))
+
+
+def get_sample_tree_etag(sample_id):
+    return "%s.%r.%r" % ((sample_id, ) + get_sample_tree_version(sample_id))
+
+
+def get_sample_tree_last_modified(sample_id):
+    return datetime.utcfromtimestamp(
+        max(get_sample_tree_version(sample_id))).replace(tzinfo=utc)
+
+
+def invalidate_sample_tree(sample_id=None):
+    """Invalidate the tree of the given Sample or of all Samples if sample_id
+    is None"""
+    key = GLOBAL_VERSION_KEY if sample_id is None else \
+        SAMPLE_VERSION_KEY % sample_id
+    cache.set(key, time.time(), settings.LIMS_SAMPLE_TREE_CACHE_TIMEOUT)
+
+
+def invalidate_sample_trees(sample_ids):
+    """Invalidate the trees of the given Samples"""
+    version = time.time()
+    cache.set_many(dict((SAMPLE_VERSION_KEY % sample_id, version)
+                        for sample_id in set(sample_ids)),
+                   settings.LIMS_SAMPLE_TREE_CACHE_TIMEOUT)
+
+
+def get_lineage_fields(model):
+    """Returns the foreign keys of the model to its parents in the lineage"""
+    return [f for f in model._meta.fields
+            if f.rel and f.rel.to in lineage_models]
+
+
+def get_sample_lookups(model):
+    """Returns the lookups that lead from the model to the id of the Sample
+    its objects descend from, one for every path through the lineage"""
+    lookups = []
+    for f in get_lineage_fields(model):
+        if f.rel.to is Sample:
+            lookups.append(f.name)
+        else:
+            lookups.extend(f.name + "__" + lookup
+                           for lookup in get_sample_lookups(f.rel.to))
+    return lookups
+
+
+lineage_fields = dict((model, get_lineage_fields(model))
+                      for model in lineage_models)
+sample_lookups = dict((model, get_sample_lookups(model))
+                      for model in lineage_models)
+
+
+def get_lineage_sample_ids(model, pks, chunk_size=500):
+    """Returns the ids of the Samples that the objects of the model with the
+    given ids descend from, with one query per chunk_size objects"""
+    if model is Sample:
+        return set(pks)
+    pks = list(pks)
+    sample_ids = set()
+    for i in range(0, len(pks), chunk_size):
+        for row in model.objects.filter(pk__in=pks[i:i + chunk_size]) \
+                .values_list(*sample_lookups[model]):
+            sample_ids.update(row)
+    sample_ids.discard(None)
+    return sample_ids
+
+
+def get_parent_sample_ids(model, parent_ids):
+    """Returns the ids of the Samples the parents with the given ids descend
+    from, parent_ids is a dict of attname of a lineage foreign key to id"""
+    sample_ids = set()
+    for f in lineage_fields[model]:
+        parent_id = parent_ids.get(f.attname)
+        if parent_id is not None:
+            sample_ids.update(get_lineage_sample_ids(f.rel.to, [parent_id]))
+    return sample_ids
+
+
+def get_instance_parent_ids(instance):
+    return dict((f.attname, getattr(instance, f.attname))
+                for f in lineage_fields[type(instance)])
+
+
+def invalidate_previous_lineage(sender, instance, raw=False, **kwargs):
+    """An object can move to another Sample, so also invalidate the tree of
+    the Sample it belonged to before. Only the ids of its parents are
+    loaded, the Sample is only looked up if they changed."""
+    fields = lineage_fields[sender]
+    if instance.pk is None or raw or not fields:
+        return
+    previous = sender.objects.filter(pk=instance.pk).values_list(
+        *[f.attname for f in fields]).first()
+    if previous is None:
+        return
+    previous_ids = dict(zip([f.attname for f in fields], previous))
+    if previous_ids != get_instance_parent_ids(instance):
+        invalidate_sample_trees(get_parent_sample_ids(sender, previous_ids))
+
+
+def invalidate_lineage(sender, instance, raw=False, **kwargs):
+    """Invalidate the tree of the Sample the object descends from, found
+    through the ids of its parents"""
+    if raw:
+        invalidate_sample_tree()
+    elif sender is Sample:
+        invalidate_sample_tree(instance.pk)
+    else:
+        invalidate_sample_trees(get_parent_sample_ids(
+            sender, get_instance_parent_ids(instance)))
+
+
+for model in lineage_models:
+    pre_save.connect(invalidate_previous_lineage, sender=model)
+    post_save.connect(invalidate_lineage, sender=model)
+    post_delete.connect(invalidate_lineage, sender=model)
@@ -3,14 +3,29 @@ from __future__ import print_function
 import sys
 
 import json
+import operator
+import os
 
-from django.shortcuts import render
-from django.http import Http404
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.cache import cache
+from django.shortcuts import get_object_or_404, render
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Q, get_models
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, \
+    StreamingHttpResponse
+from django.core.servers.basehttp import FileWrapper
 from django.core.urlresolvers import reverse
-from django.template.defaultfilters import slugify
 from django.utils.text import capfirst
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition, require_POST
 
-from lims.models import Amplicon, Container, DNALibrary, Sample, SAGPlate, SAGPlateDilution, ExtractedCell, ExtractedDNA
+import lims.models
+from lims import tree_cache
+from lims.metrics import request_metrics
+
+from lims.models import Browsable, Container, Job, RegisteredBarcode, \
+    Sample
 
 
 def index(request):
@@ -28,73 +43,341 @@ def get_attr_list(obj):
     return [(k, getattr(obj, k)) for k in obj.preferred_ordering()]
 
 
-def default_object_table(obj):
-    def func(request, obj_id):
-        o = obj.objects.get(pk=obj_id)
-        verbose_name = unicode(capfirst(obj._meta.verbose_name))
-        verbose_name_plural = unicode(capfirst(obj._meta.verbose_name_plural))
-        return render(request, 'lims/object.html',
-                      {'objectname': obj.__name__, 'verbose_name':
-                       verbose_name, 'verbose_name_plural':
-                       verbose_name_plural, 'object': o})
-    return func
+# Cache of select_related lookups per model, see get_relation_plan
+relation_plans = {}
 
 
-def default_object_list(obj):
-    def func(request):
-        verbose_name = unicode(capfirst(obj._meta.verbose_name))
-        verbose_name_plural = unicode(capfirst(obj._meta.verbose_name_plural))
-        return render(request, 'lims/object_list.html',
-                      {'objectname': obj.__name__, 'verbose_name':
-                       verbose_name, 'verbose_name_plural':
-                       verbose_name_plural, 'objects':
-                       list(obj.objects.all())})
-    return func
+def get_relation_plan(obj):
+    """Returns the select_related lookups needed to show an object of the
+    model on its detail page. These are the foreign keys in preferred_ordering,
+    the foreign keys needed to display those (their browse_select_related) and
+    the lookups in the model's detail_select_related attribute, which declares
+    the foreign key chains followed by properties such as sample and group."""
+    if obj not in relation_plans:
+        lookups = set(getattr(obj, 'detail_select_related', ()))
+        foreign_keys = dict((f.name, f) for f in obj._meta.fields if f.rel)
+        for name in obj().preferred_ordering:
+            if name in foreign_keys:
+                lookups.add(name)
+                lookups.update(name + "__" + l for l in getattr(
+                    foreign_keys[name].rel.to, 'browse_select_related', ()))
+        relation_plans[obj] = sorted(lookups)
+    return relation_plans[obj]
 
 
-def generate_related_objects_tree(obj):
-    rv = {"url": reverse('lims.views.browse.' + slugify(type(obj).__name__),
-                                                 args=[obj.id])}
+# Models that can be browsed by their model_name, see get_browse_model
+browse_models = {}
 
-    for ro in obj._meta.get_all_related_objects():
-        for o in getattr(obj, ro.get_accessor_name()).all():
-            rv.setdefault(type(o).__name__, {})[str(o)] = generate_related_objects_tree(o)
 
-    return rv
+def get_browse_model(model_name):
+    """Returns the lims model with the given model_name, e.g. sample. The
+    registry is built the first time a model is looked up."""
+    if not browse_models:
+        browse_models.update((model._meta.model_name, model) for model in
+                             get_models(app_mod=lims.models))
+    try:
+        return browse_models[model_name]
+    except KeyError:
+        raise Http404
 
 
-def sample_tree_json(request, sample_id):
-    sample = Sample.objects.get(pk=sample_id)
+def object_table(request, obj, obj_id):
+    o = get_object_or_404(
+        obj.objects.select_related(*get_relation_plan(obj)), pk=obj_id)
+    verbose_name = unicode(capfirst(obj._meta.verbose_name))
+    verbose_name_plural = unicode(capfirst(obj._meta.verbose_name_plural))
+    return render(request, 'lims/object.html',
+                  {'objectname': obj.__name__, 'model_name':
+                   obj._meta.model_name, 'verbose_name': verbose_name,
+                   'verbose_name_plural': verbose_name_plural, 'object': o})
+
+
+def get_browse_queryset(obj):
+    """Returns all objects of the model ordered by id, following the foreign
+    keys in the model's browse_select_related attribute that are needed to
+    display the objects."""
+    return obj.objects.select_related(
+        *getattr(obj, 'browse_select_related', ())).order_by('pk')
+
+
+def stream_object_list(obj):
+    """Yields a line with id and name for every object of the model"""
+    for o in get_browse_queryset(obj).iterator():
+        yield u"%d\t%s\n" % (o.pk, o)
+
+
+def object_list(request, obj):
+    """List objects a page at a time. Pages are selected on id, the GET value
+    after gives the last id of the previous page and page_size the number of
+    objects. With GET value stream all objects are streamed as text."""
+    if 'stream' in request.GET:
+        return StreamingHttpResponse(stream_object_list(obj),
+                                     content_type="text/plain")
+
+    try:
+        page_size = min(int(request.GET.get('page_size',
+                                            settings.LIMS_BROWSE_PAGE_SIZE)),
+                        settings.LIMS_BROWSE_MAX_PAGE_SIZE)
+        after = int(request.GET.get('after', 0))
+    except ValueError:
+        raise Http404
+    if page_size < 1:
+        raise Http404
+    objects = list(get_browse_queryset(obj).filter(pk__gt=after)
+                   [:page_size + 1])
+    next_after = objects[page_size - 1].pk \
+        if len(objects) > page_size else None
+
+    verbose_name = unicode(capfirst(obj._meta.verbose_name))
+    verbose_name_plural = unicode(capfirst(obj._meta.verbose_name_plural))
+    return render(request, 'lims/object_list.html',
+                  {'objectname': obj.__name__, 'model_name':
+                   obj._meta.model_name, 'verbose_name': verbose_name,
+                   'verbose_name_plural': verbose_name_plural, 'objects':
+                   objects[:page_size], 'page_size': page_size,
+                   'after': after, 'next_after': next_after,
+                   'has_detail': issubclass(obj, Browsable)})
+
+
+def browse_list(request, model_name):
+    return object_list(request, get_browse_model(model_name))
+
+
+def browse_detail(request, model_name, obj_id):
+    obj = get_browse_model(model_name)
+    if not issubclass(obj, Browsable):
+        raise Http404
+    return object_table(request, obj, obj_id)
+
+
+def generate_related_objects_tree(obj, chunk_size=500):
+    """Returns a tree of dictionaries with all objects that are related to
+    obj, e.g. the lineage of a Sample. The related objects are fetched level
+    by level, with one query per reverse relation for each model in a level
+    (per chunk_size objects), and the tree is built in memory. An object that
+    is related to multiple objects shares its subtree between them."""
+    nodes = {}
+
+    def get_node(o):
+        key = (type(o), o.pk)
+        if key not in nodes:
+            nodes[key] = {"url": type(o).get_detail_url_format() % o.pk}
+        return nodes[key]
+
+    tree = get_node(obj)
+    level = {type(obj): [obj.pk]}
+    while level:
+        next_level = {}
+        for model, ids in level.items():
+            for ro in model._meta.get_all_related_objects():
+                for i in range(0, len(ids), chunk_size):
+                    for o in ro.model.objects.filter(**{ro.field.name + "__in":
+                                                        ids[i:i + chunk_size]}):
+                        parent_node = nodes[(model, getattr(o, ro.field.attname))]
+                        if (type(o), o.pk) not in nodes:
+                            next_level.setdefault(type(o), []).append(o.pk)
+                        parent_node.setdefault(type(o).__name__, {})[str(o)] = \
+                            get_node(o)
+        level = next_level
+
+    return tree
+
+
+def get_sample_tree_json(sample_id):
+    """Returns the sample tree as JSON. The JSON is cached until an object in
+    the lineage of the Sample changes, see lims.tree_cache."""
+    key = tree_cache.get_sample_tree_key(sample_id)
+    sample_tree = cache.get(key)
+    if sample_tree is None:
+        sample = get_object_or_404(Sample, pk=sample_id)
+
+        response_data = {'Sample': {}}
+        response_data['Sample'][str(sample)] = \
+            generate_related_objects_tree(sample)
+
+        sample_tree = json.dumps(response_data)
+        cache.set(key, sample_tree, settings.LIMS_SAMPLE_TREE_CACHE_TIMEOUT)
+    return sample_tree
+
 
-    response_data = {'Sample': {}}
-    response_data['Sample'][str(sample)] = generate_related_objects_tree(sample)
+def sample_tree_etag(request, sample_id):
+    return tree_cache.get_sample_tree_etag(sample_id)
 
+
+def sample_tree_last_modified(request, sample_id):
+    return tree_cache.get_sample_tree_last_modified(sample_id)
+
+
+@condition(etag_func=sample_tree_etag,
+           last_modified_func=sample_tree_last_modified)
+def sample_tree_json(request, sample_id):
     return render(request, 'lims/sampletree.html',
-                  {'json': json.dumps(response_data)})
+                  {'json': get_sample_tree_json(sample_id)})
 
 
 def barcode_index(request):
     return render(request, 'lims/barcode_index.html')
 
 
+def get_registered_barcode(barcode):
+    try:
+        return RegisteredBarcode.objects.get(barcode=barcode)
+    except RegisteredBarcode.DoesNotExist:
+        raise Http404
+
+
 def barcode_search(request, barcode):
-    #try:
-    barcode_model = {
-        "AM": Amplicon,
-        "SA": Sample,
-        "CO": Container,
-        "EC": ExtractedCell,
-        "ED": ExtractedDNA,
-        "SP": SAGPlate,
-        "SD": SAGPlateDilution,
-        "DL": DNALibrary,
-    }[barcode[:2]]
-    #except KeyError:
-    #    raise Http404
-
-    if barcode.startswith("CO:"):
-        c = Container.objects.get(pk=int(barcode[3:]))
-        return default_object_table(barcode_model)(request, c.id)
+    rb = get_registered_barcode(barcode)
+    return object_table(request, rb.model, rb.object_id)
+
+
+def barcode_json(request, barcode):
+    """Resolves a barcode for scanner clients. Returns the model, id and url
+    of the object as JSON."""
+    rb = get_registered_barcode(barcode)
+    return HttpResponse(json.dumps({
+        'barcode': rb.barcode,
+        'type': rb.model.__name__,
+        'id': rb.object_id,
+        'url': rb.model.get_detail_url_format() % rb.object_id,
+    }), content_type="application/json")
+
+
+def get_barcode_batch(barcodes):
+    """Returns a dictionary for each of the given barcodes with the type, id
+    and uid of the object, the position and barcode of the Container it is
+    stored in (or of the Container itself) and the name of the root
+    Apparatus. Unknown barcodes get type None. Uses one query for the
+    registry, one per model and one for the Containers the objects are
+    stored in."""
+    registered = {}
+    for i in range(0, len(barcodes), 500):
+        registered.update((rb.barcode, rb) for rb in
+                          RegisteredBarcode.objects.filter(
+                              barcode__in=barcodes[i:i + 500]))
+
+    ids_by_model = {}
+    for rb in registered.values():
+        ids_by_model.setdefault(rb.model, []).append(rb.object_id)
+
+    located = ('root_container__apparatus_subdivision__apparatus',
+               'apparatus_subdivision__apparatus')
+    objects = {}
+    containers = {}
+    stored_qs = []
+    for model, ids in ids_by_model.items():
+        qs = model.objects.all()
+        if model is Container:
+            qs = qs.select_related(*located)
+        for pk, o in qs.in_bulk(ids).items():
+            objects[(model, pk)] = o
+            if model is Container:
+                containers[(model, pk)] = o
+        if model is not Container:
+            stored_qs.append(Q(
+                content_type=ContentType.objects.get_for_model(model),
+                object_id__in=ids))
+    if stored_qs:
+        for c in Container.objects.filter(reduce(operator.or_, stored_qs)) \
+                .select_related(*located):
+            model = ContentType.objects.get_for_id(c.content_type_id) \
+                .model_class()
+            containers.setdefault((model, c.object_id), c)
+
+    results = []
+    for barcode in barcodes:
+        rb = registered.get(barcode)
+        o = objects.get((rb.model, rb.object_id)) if rb else None
+        if o is None:
+            results.append({'barcode': barcode, 'type': None})
+            continue
+        c = containers.get((rb.model, rb.object_id))
+        results.append({
+            'barcode': barcode,
+            'type': rb.model.__name__,
+            'id': o.pk,
+            'uid': getattr(o, 'uid', None),
+            'container': c.barcode if c else None,
+            'row': c.row if c else None,
+            'column': c.column if c else None,
+            'apparatus': c.root.apparatus_subdivision.apparatus.name
+            if c else None,
+        })
+    return results
+
+
+@csrf_exempt
+@require_POST
+def barcode_batch(request):
+    """Resolves multiple barcodes at once, e.g. a whole rack read by a rack
+    scanner. Barcodes are posted either as a JSON list or as a whitespace
+    separated barcodes field. Returns a JSON list with the result for each
+    barcode in the same order, see get_barcode_batch. At most
+    settings.LIMS_BARCODE_BATCH_MAX_SIZE barcodes are resolved at once."""
+    if request.META.get('CONTENT_TYPE', '').startswith("application/json"):
+        try:
+            barcodes = json.loads(request.body)
+        except ValueError:
+            return HttpResponseBadRequest("Invalid JSON")
+        if not isinstance(barcodes, list) or \
+                not all(isinstance(b, basestring) for b in barcodes):
+            return HttpResponseBadRequest("Expected a list of barcodes")
     else:
-        o = barcode_model.objects.get(uid=barcode[3:])
-        return default_object_table(barcode_model)(request, o.id)
+        barcodes = request.POST.get('barcodes', '').split()
+    if len(barcodes) > settings.LIMS_BARCODE_BATCH_MAX_SIZE:
+        return HttpResponseBadRequest("At most %d barcodes can be resolved "
+                                      "at once" %
+                                      settings.LIMS_BARCODE_BATCH_MAX_SIZE)
+
+    return HttpResponse(json.dumps(get_barcode_batch(barcodes)),
+                        content_type="application/json")
+
+
+@staff_member_required
+def job_status(request, job_id):
+    """Status page of a background Job, polls job_json until it finished"""
+    return render(request, 'lims/job.html',
+                  {'job': get_object_or_404(Job.objects.defer('data'),
+                                            pk=job_id)})
+
+
+@staff_member_required
+def job_json(request, job_id):
+    job = get_object_or_404(Job.objects.defer('data'), pk=job_id)
+    return HttpResponse(json.dumps({
+        'status': job.status,
+        'progress': job.progress,
+        'total': job.total,
+        'percentage': job.percentage,
+        'message': job.message,
+        'finished': job.is_finished,
+        'download': reverse('lims.views.job_download', args=[job.pk])
+        if job.data_name else None,
+    }), content_type="application/json")
+
+
+@staff_member_required
+def job_download(request, job_id):
+    """Download the file a Job exported"""
+    job = get_object_or_404(Job.objects.defer('data'), pk=job_id)
+    if not job.data_name or os.path.basename(job.data_name) != job.data_name:
+        raise Http404
+    try:
+        f = open(job.get_export_path(), "rb")
+    except IOError:
+        raise Http404
+    response = StreamingHttpResponse(FileWrapper(f),
+                                     content_type="application/octet-stream")
+    response['Content-Disposition'] = 'attachment; filename=%s' % \
+        job.data_name
+    return response
+
+
+def metrics(request):
+    """Request metrics of this process in the Prometheus text format, only
+    shown to settings.LIMS_METRICS_ALLOWED_IPS"""
+    if request.META.get('REMOTE_ADDR') not in \
+            settings.LIMS_METRICS_ALLOWED_IPS:
+        raise Http404
+    return HttpResponse(request_metrics.render(),
+                        content_type="text/plain; version=0.0.4")
@@ -48,6 +48,7 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'lims.metrics.MetricsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -112,3 +113,74 @@ TEMPLATE_CONTEXT_PROCESSORS = (
 
 # Change user model
 AUTH_USER_MODEL = "lims.UserProfile"
+
+# Number of objects per page when browsing the LIMS, can be changed with the
+# page_size GET value up to LIMS_BROWSE_MAX_PAGE_SIZE
+LIMS_BROWSE_PAGE_SIZE = 100
+LIMS_BROWSE_MAX_PAGE_SIZE = 1000
+
+# Most barcodes resolved by one barcode_batch request, a rack scanner reads at
+# most 384 at once. Barcodes are looked up with IN queries, SQLite allows at
+# most 999 parameters per query.
+LIMS_BARCODE_BATCH_MAX_SIZE = 500
+
+# Seconds a sample tree is cached. Cached trees are invalidated when their
+# lineage changes, use a cache shared by all processes (e.g. memcached) in
+# production so this works across workers.
+LIMS_SAMPLE_TREE_CACHE_TIMEOUT = 24 * 60 * 60
+
+# Backend that sends barcode label jobs to the printers, FileBackend writes
+# the jobs to LIMS_PRINTER_SPOOL_DIR instead. Print runs with at least
+# LIMS_PRINT_BACKGROUND_MIN_LABELS labels are queued as a background job.
+LIMS_PRINTER_BACKEND = "lims.printing.LprBackend"
+LIMS_PRINTER_SPOOL_DIR = join(DJANGO_ROOT, "spool")
+LIMS_PRINT_BACKGROUND_MIN_LABELS = 50
+
+# Rendered barcode labels are cached for this many seconds
+LIMS_LABEL_CACHE_TIMEOUT = 24 * 60 * 60
+
+# Bulk imports are processed in chunks of LIMS_IMPORT_CHUNK_SIZE rows, the
+# import preview shows the first LIMS_IMPORT_PREVIEW_SIZE rows. Chunks are
+# looked up with IN queries, SQLite allows at most 999 parameters per query.
+LIMS_IMPORT_CHUNK_SIZE = 500
+LIMS_IMPORT_PREVIEW_SIZE = 100
+# Uploaded files wait in LIMS_IMPORT_DIR until their import is confirmed
+LIMS_IMPORT_DIR = join(DJANGO_ROOT, "imports")
+
+# Seconds the run_jobs worker waits before it checks for new jobs again
+LIMS_JOB_POLL_INTERVAL = 5
+# Running jobs that did not report progress for this many seconds are marked
+# as failed, e.g. after their worker was stopped
+LIMS_JOB_TIMEOUT = 60 * 60
+# Files exported by background jobs are stored in LIMS_EXPORT_DIR
+LIMS_EXPORT_DIR = join(DJANGO_ROOT, "exports")
+
+# Per view request metrics, see lims.metrics. Percentiles are computed over the
+# last LIMS_METRICS_WINDOW requests of a view. They are shown on /_metrics/ to
+# LIMS_METRICS_ALLOWED_IPS only. Requests that take more than
+# LIMS_METRICS_SLOW_REQUEST_SECONDS or LIMS_METRICS_SLOW_REQUEST_QUERIES
+# queries are logged with their LIMS_METRICS_SLOW_QUERIES slowest queries.
+LIMS_METRICS = True
+LIMS_METRICS_WINDOW = 1000
+LIMS_METRICS_ALLOWED_IPS = ("127.0.0.1", "::1")
+LIMS_METRICS_SLOW_REQUEST_SECONDS = 1.0
+LIMS_METRICS_SLOW_REQUEST_QUERIES = 100
+LIMS_METRICS_SLOW_QUERIES = 5
+
+# Log warnings of the lims app, e.g. slow requests, to stderr
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'lims': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+    },
+}